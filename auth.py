@@ -0,0 +1,96 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+import config
+
+
+def jwt_claims(token):
+    """
+    Decodes the payload of a JWT without verifying its signature.
+
+    :param str token: JWT.
+    :return dict: Claims of `token`, empty if it cannot be decoded.
+    """
+
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except (AttributeError, IndexError, ValueError, TypeError):
+        return {}
+    return claims if isinstance(claims, dict) else {}
+
+
+def token_expiry(token):
+    """
+    :param str token: JWT.
+    :return float: Value of the `exp` claim of `token`, or `None` if it cannot be read.
+    """
+
+    exp = jwt_claims(token).get("exp")
+    return exp if isinstance(exp, (int, float)) else None
+
+
+class TokenProvider:
+    """
+    Provides a valid JWT authorization token. The token is cached in a file readable only by its owner and reused
+    across processes until it gets within `config.AUTH_REFRESH_MARGIN` seconds of its `exp` claim, then a new one is
+    obtained by calling `login`. Instances are callable, so they can be passed wherever a token is expected and are
+    asked for the token right before every request - long polling loops thus refresh it on the fly.
+    """
+
+    def __init__(self, login, path=None, margin=None):
+        """
+        :param callable login: Function without arguments returning a new `id_token`.
+        :param str path: Token cache file (default: `token.json` in `config.TEMP_DIR`).
+        :param float margin: Seconds before expiry at which the token is refreshed (default:
+        `config.AUTH_REFRESH_MARGIN`).
+        """
+
+        self.login = login
+        self.path = os.path.join(config.TEMP_DIR, "token.json") if path is None else path
+        self.margin = config.AUTH_REFRESH_MARGIN if margin is None else margin
+        self.lock = threading.Lock()
+        self.account = hashlib.sha256("/".join((config.AUTH["ENDPOINT"], config.AUTH["PAYLOAD"]["client_id"],
+                                                config.AUTH["PAYLOAD"]["username"])).encode()).hexdigest()
+        self.token = None
+        self.expires = 0
+
+    def _valid(self):
+        return self.token is not None and self.expires - self.margin > time.time()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        if cached.get("account") == self.account:
+            self.token, self.expires = cached["id_token"], cached["expires"]
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"account": self.account, "id_token": self.token, "expires": self.expires}, f)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+
+    def __call__(self):
+        """
+        :return str: Valid JWT authorization token.
+        """
+
+        with self.lock:
+            if not self._valid():
+                self._load()
+            if not self._valid():
+                self.token = self.login()
+                expires = token_expiry(self.token)
+                self.expires = time.time() + config.AUTH_DEFAULT_LIFETIME if expires is None else expires
+                self._save()
+            return self.token
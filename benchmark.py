@@ -0,0 +1,197 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import cache
+import config
+import detections
+import instrument
+import sk_ass
+import standin
+import transport
+
+
+STAGES = ("search", "kraken", "download", "blend", "count")
+
+
+def bench(scenes, tiles, map_types=("cars",), input_file="./json/inputs/brisbane_airport_staff_parking_lot.geojson",
+          **server_options):
+    """
+    Measures one end-to-end `sk_ass.run` against a local `standin.StandInServer`, starting with an empty tile cache.
+
+    :param int scenes: Number of scenes served by the stand-in.
+    :param int tiles: Number of tiles of every Kraken pipeline.
+    :param tuple map_types: Map types of the run.
+    :param str input_file: Input geojson of the run.
+    :param server_options: Further options of `standin.StandInServer`, e.g. `pipeline_delay` or `latency`.
+    :return dict: Wall time, scenes per minute and tiles per second of the run, and seconds and items per second of
+    every stage.
+    """
+
+    saved = {name: getattr(config, name) for name in ("TEMP_DIR", "IMG_DIR", "SCENES_LIMIT", "POLL_MIN_INTERVAL",
+                                                      "PROFILE_REPORT", "PROFILE_STAGES")}
+    saved_transport = transport._default
+    work_dir = tempfile.mkdtemp()
+
+    with standin.StandInServer(scenes=scenes, tiles=tiles, **server_options) as server:
+        saved_endpoints = server.configure()
+        try:
+            config.TEMP_DIR = os.path.join(work_dir, "temporary")
+            config.IMG_DIR = os.path.join(work_dir, "img")
+            os.makedirs(config.IMG_DIR)
+            config.SCENES_LIMIT = max(scenes, config.SCENES_LIMIT)
+            config.POLL_MIN_INTERVAL = min(config.POLL_MIN_INTERVAL, server.pipeline_delay / 4 or 0.05)
+            config.PROFILE_REPORT = os.path.join(work_dir, "profile.json")
+            config.PROFILE_STAGES = False
+            # A fresh transport, so that connections and rate limits of the stand-in endpoints are not shared
+            transport._default = None
+
+            started = time.monotonic()
+            sk_ass.profile_run(sk_ass.run, list(map_types), input_file)
+            wall = time.monotonic() - started
+            report = instrument.default().report()
+            served = server.stats()
+        finally:
+            standin.StandInServer.restore(saved_endpoints)
+            for name, value in saved.items():
+                setattr(config, name, value)
+            transport._default = saved_transport
+            shutil.rmtree(work_dir)
+
+    tile_count = scenes * tiles * (len(map_types) + 1)
+    items = {"search": 1, "kraken": scenes * (len(map_types) + 1), "download": tile_count,
+             "blend": scenes * tiles * len(map_types), "count": scenes * tiles * len(map_types)}
+    stages = {}
+    for stage in STAGES:
+        seconds = report["stages"].get(stage, {}).get("seconds", 0.0)
+        stages[stage] = {"seconds": seconds, "items": items[stage],
+                         "items_per_second": items[stage] / seconds if seconds else None}
+
+    return {"scenes": scenes, "tiles": tiles, "map_types": list(map_types), "options": server_options,
+            "wall_seconds": wall, "scenes_per_minute": scenes / wall * 60, "tiles_per_second": tile_count / wall,
+            "requests": served["requests"], "errors": served["errors"], "stages": stages}
+
+
+def bench_parsing(repeat=5, pattern="./json/templates/kraken/*.geojson"):
+    """
+    Measures the CPU time of reading `detections.geojson` files - `detections.tally` of files in memory and of files
+    streamed in chunks as they are downloaded against a baseline of `json.loads` and a sum of the counts, and
+    `detections.iter_detections` with centroids against `json.loads` and `detections.centroid` - as the best of
+    `repeat` passes over all files matching `pattern`. The peak memory allocated while counting is measured for the
+    baseline and the streamed tally.
+
+    :param int repeat: Number of passes.
+    :param str pattern: Glob pattern of the geojson files.
+    :return dict: Seconds of a pass of `"baseline"`, `"tally"`, `"streamed"`, `"baseline_centroids"` and
+    `"centroids"`, `"tally_ratio"`, `"streamed_ratio"` and `"centroids_ratio"` of each to its baseline, and
+    `"baseline_peak_bytes"` and `"streamed_peak_bytes"`.
+    """
+
+    contents = []
+    for file_name in sorted(glob.glob(pattern)):
+        with open(file_name, "rb") as f:
+            contents.append(f.read())
+
+    def baseline():
+        for content in contents:
+            sum(feature["properties"]["count"] for feature in json.loads(content)["features"]
+                if feature["properties"]["class"] == "cars")
+
+    def baseline_centroids():
+        for content in contents:
+            for feature in json.loads(content)["features"]:
+                if feature["properties"]["class"] == "cars":
+                    detections.centroid(feature["geometry"]["coordinates"])
+
+    def tally():
+        for content in contents:
+            detections.tally(content, ["cars"])
+
+    def streamed():
+        for content in contents:
+            detections.tally((content[i:i + cache.CHUNK_SIZE] for i in range(0, len(content), cache.CHUNK_SIZE)),
+                             ["cars"])
+
+    def centroids():
+        for content in contents:
+            for _ in detections.iter_detections(content, ["cars"], centroids=True):
+                pass
+
+    result = {}
+    for name, func in (("baseline", baseline), ("tally", tally), ("streamed", streamed),
+                       ("baseline_centroids", baseline_centroids), ("centroids", centroids)):
+        timings = []
+        for _ in range(repeat):
+            started = time.process_time()
+            func()
+            timings.append(time.process_time() - started)
+        result[name] = min(timings)
+    result["tally_ratio"] = result["tally"] / result["baseline"]
+    result["streamed_ratio"] = result["streamed"] / result["baseline"]
+    result["centroids_ratio"] = result["centroids"] / result["baseline_centroids"]
+
+    for name, func in (("baseline", baseline), ("streamed", streamed)):
+        tracemalloc.start()
+        try:
+            func()
+            result[name + "_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("benchmark",
+                                     description="Measure throughput of sk_ass runs against a local API stand-in.")
+
+    parser.add_argument("--scenes", type=int, nargs="+", default=[5, 20],
+                        help="numbers of scenes to benchmark (default: 5 20)")
+    parser.add_argument("--tiles", type=int, nargs="+", default=[4, 16],
+                        help="numbers of tiles per scene to benchmark (default: 4 16)")
+    parser.add_argument("-m", dest="map_types", nargs="+", default=["cars"],
+                        help="map types of the runs (default: cars)")
+    parser.add_argument("--delay", type=float, default=0.5,
+                        help="seconds until a pipeline is processed (default: 0.5)")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="seconds added to every response (default: 0.01)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of tile requests failing with status 503 (default: 0.0)")
+    parser.add_argument("--parsing", action="store_true",
+                        help="only measure parsing of the detections.geojson fixtures against json.loads and exit")
+    parser.add_argument("-o", dest="output", help="write the results as JSON to the given file")
+
+    args = parser.parse_args()
+
+    if args.parsing:
+        result = bench_parsing()
+        print("baseline [s]  tally [s]  ratio  streamed [s]  ratio  baseline with centroids [s]  centroids [s]  ratio")
+        print("{:12.3f}  {:9.3f}  {:5.2f}  {:12.3f}  {:5.2f}  {:27.3f}  {:13.3f}  {:5.2f}".format(
+            result["baseline"], result["tally"], result["tally_ratio"], result["streamed"], result["streamed_ratio"],
+            result["baseline_centroids"], result["centroids"], result["centroids_ratio"]))
+        print("peak memory of baseline [MiB]  peak memory of streamed [MiB]")
+        print("{:29.1f}  {:29.1f}".format(result["baseline_peak_bytes"] / 1024 ** 2,
+                                          result["streamed_peak_bytes"] / 1024 ** 2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+        raise SystemExit
+
+    results = []
+    print("scenes  tiles  wall [s]  scenes/min  tiles/s  " + "  ".join("{} [s]".format(stage) for stage in STAGES))
+    for scenes, tiles in itertools.product(args.scenes, args.tiles):
+        result = bench(scenes, tiles, args.map_types, pipeline_delay=args.delay, latency=args.latency,
+                       error_rate=args.error_rate)
+        results.append(result)
+        print("{:6d}  {:5d}  {:8.2f}  {:10.1f}  {:7.1f}  ".format(
+            scenes, tiles, result["wall_seconds"], result["scenes_per_minute"], result["tiles_per_second"]) +
+            "  ".join("{:{}.2f}".format(result["stages"][stage]["seconds"], len(stage) + 4) for stage in STAGES))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
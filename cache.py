@@ -0,0 +1,202 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import config
+
+
+DIGEST_SIZE = hashlib.sha256().digest_size
+CHUNK_SIZE = 64 * 1024
+
+
+class TileCache:
+    """
+    Persistent content-addressed cache of downloaded tile artifacts (PNG images, detections.geojson files).
+
+    Entries are addressed by the SHA-256 hash of their key parts (scene, map type, zoom, x, y and artifact name) and
+    stored as files prefixed with the SHA-256 digest of their content, which is verified on every read. Writes are
+    atomic. The total size of the cache is kept under a byte budget by evicting least recently used entries - the
+    modification time of an entry is updated whenever it is read.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, root, max_bytes=None):
+        """
+        :param str root: Cache directory, created if it does not exist.
+        :param int max_bytes: Byte budget of the cache (default: `config.CACHE_MAX_BYTES`). Zero disables the cache.
+        """
+
+        self.root = root
+        self.max_bytes = config.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+        os.makedirs(root, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path in self._entries())
+
+    @classmethod
+    def default(cls):
+        """
+        Returns the shared instance stored in `cache` in `config.TEMP_DIR`.
+
+        :return TileCache: Shared instance.
+        """
+
+        root = os.path.join(config.TEMP_DIR, "cache")
+        with cls._instances_lock:
+            if root not in cls._instances:
+                cls._instances[root] = cls(root)
+            return cls._instances[root]
+
+    @staticmethod
+    def key(*parts):
+        """
+        :param parts: Parts identifying the entry, e.g. `(scene_id, map_type, z, x, y, artifact)`.
+        :return str: Hex digest addressing the entry.
+        """
+
+        return hashlib.sha256("/".join(str(part) for part in parts).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _entries(self):
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                if not file_name.endswith(".tmp"):
+                    yield os.path.join(dir_path, file_name)
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self.lock:
+            self.size -= size
+
+    def get(self, key):
+        """
+        :param str key: Entry address returned by `key`.
+        :return bytes: Content of the entry, or `None` if it is not cached or fails the validity check.
+        """
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+        except OSError:
+            self._count("misses")
+            return None
+
+        digest, data = blob[:DIGEST_SIZE], blob[DIGEST_SIZE:]
+        if len(digest) != DIGEST_SIZE or hashlib.sha256(data).digest() != digest:
+            self._remove(path)
+            self._count("misses")
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._count("hits")
+        return data
+
+    def put(self, key, data):
+        """
+        Atomically stores `data` under `key` and evicts least recently used entries if the budget is exceeded.
+
+        :param str key: Entry address returned by `key`.
+        :param bytes data: Content of the entry.
+        """
+
+        if self.max_bytes <= 0:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(hashlib.sha256(data).digest())
+            f.write(data)
+
+        self._store(path, tmp_path)
+
+    def put_file(self, key, file_path):
+        """
+        Stores the content of `file_path` under `key` without reading it into memory at once, see `put`.
+
+        :param str key: Entry address returned by `key`.
+        :param str file_path: File to store.
+        """
+
+        if self.max_bytes <= 0:
+            return
+
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f, open(file_path, "rb") as src:
+            f.write(digest.digest())
+            shutil.copyfileobj(src, f, CHUNK_SIZE)
+
+        self._store(path, tmp_path)
+
+    def _store(self, path, tmp_path):
+        old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+        new_size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.size += new_size - old_size
+            over_budget = self.size > self.max_bytes
+
+        # One eviction at a time, puts arriving meanwhile do not walk the cache again
+        if over_budget and self.evict_lock.acquire(blocking=False):
+            try:
+                self.evict()
+            finally:
+                self.evict_lock.release()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache shrinks to `config.CACHE_LOW_WATERMARK` of its byte budget,
+        so that a full cache is not walked again on every following `put`.
+        """
+
+        target = self.max_bytes * config.CACHE_LOW_WATERMARK
+
+        entries = []
+        for path in self._entries():
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+
+        for _, path in sorted(entries):
+            with self.lock:
+                if self.size <= target:
+                    return
+            self._remove(path)
+            self._count("evictions")
+
+    def stats(self):
+        """
+        :return dict: Copy of the hit, miss and eviction counters together with the current size in bytes.
+        """
+
+        with self.lock:
+            return dict(self.counters, bytes=self.size)
@@ -0,0 +1,82 @@
+import numpy as np
+
+import config
+import spatial
+
+
+def classify(previous, current, radius=None):
+    """
+    Classifies detections of two scenes of the same area by their centroids - detections of the earlier scene with no
+    counterpart within `radius` in the later one have departed, detections of the later scene with no counterpart in
+    the earlier one have arrived, and the paired ones have stayed.
+
+    :param numpy.ndarray previous: Array of shape `(n, 2)` of `(lon, lat)` centroids of the earlier scene.
+    :param numpy.ndarray current: Array of shape `(m, 2)` of `(lon, lat)` centroids of the later scene.
+    :param float radius: Largest distance in metres of the positions of an object which stayed (default:
+    `config.CHANGE_MATCH_RADIUS`).
+    :return tuple: Boolean arrays of shapes `(n,)` and `(m,)`, `True` for the detections which stayed.
+    """
+
+    radius = config.CHANGE_MATCH_RADIUS if radius is None else radius
+    previous = np.asarray(previous, dtype=np.float64).reshape(-1, 2)
+    current = np.asarray(current, dtype=np.float64).reshape(-1, 2)
+    # One projection for both scenes, so that their distances are comparable
+    points = spatial.to_metres(np.concatenate((previous, current)))
+    return spatial.match_points(points[:len(previous)], points[len(previous):], radius)
+
+
+def _tile_delta(columns, previous, current, radius):
+    # `previous` and `current` are tiles as returned by `store.DetectionStore.tiles`, `None` if without detections
+    centroids, counts = [], []
+    for tile in (previous, current):
+        rows = slice(0, 0) if tile is None else tile[2]
+        centroids.append(np.column_stack((columns["lon"][rows], columns["lat"][rows])))
+        counts.append(np.asarray(columns["count"][rows], dtype=np.int64))
+
+    stayed_previous, stayed_current = classify(centroids[0], centroids[1], radius)
+    return {"arrived": int(counts[1][~stayed_current].sum()), "departed": int(counts[0][~stayed_previous].sum()),
+            "stayed": int(counts[1][stayed_current].sum())}
+
+
+def delta_series(detection_store, since=None, until=None, radius=None):
+    """
+    Compares every scene in `detection_store` with the previous one, tile by tile, and counts the objects which have
+    arrived, departed and stayed (see `classify`). Tiles whose detections have the same digest in both scenes are not
+    read at all - all of their objects have stayed - so the cost grows with the number of changed tiles rather than with
+    the number of scenes.
+
+    :param store.DetectionStore detection_store: Store of detections of one map type.
+    :param str since: Optional start of the period, see `store.DetectionStore.select`.
+    :param str until: Optional end of the period, see `store.DetectionStore.select`.
+    :param float radius: Largest distance in metres of the positions of an object which stayed (default:
+    `config.CHANGE_MATCH_RADIUS`).
+    :return dict: `"extent"` - list of deltas of the whole extent, dicts with `from` and `to` (datetimes of the compared
+    scenes), `arrived`, `departed` and `stayed` fields, oldest first; `"tiles"` - maps `"z/x/y"` keys to lists of deltas
+    of the tile in the same form; `"compared"` and `"skipped"` - numbers of changed and unchanged tiles.
+    """
+
+    scenes = detection_store.select(since, until)
+    columns = {name: detection_store.column(name) for name in ("lon", "lat", "count")}
+    series = {"extent": [], "tiles": {}, "compared": 0, "skipped": 0}
+
+    tiles = detection_store.tiles(scenes[0]) if scenes else {}
+    for previous, current in zip(scenes, scenes[1:]):
+        previous_tiles, tiles = tiles, detection_store.tiles(current)
+        total = {"from": previous["datetime"], "to": current["datetime"], "arrived": 0, "departed": 0, "stayed": 0}
+
+        for key in sorted(set(previous_tiles) | set(tiles)):
+            previous_tile, tile = previous_tiles.get(key), tiles.get(key)
+            if previous_tile is not None and tile is not None and previous_tile[0] == tile[0]:
+                delta = {"arrived": 0, "departed": 0, "stayed": tile[1]}
+                series["skipped"] += 1
+            else:
+                delta = _tile_delta(columns, previous_tile, tile, radius)
+                series["compared"] += 1
+
+            for field, value in delta.items():
+                total[field] += value
+            series["tiles"].setdefault(key, []).append(dict(delta, **{"from": total["from"], "to": total["to"]}))
+
+        series["extent"].append(total)
+
+    return series
@@ -1,12 +1,55 @@
 import datetime
+import os
 
 DEBUG = False
-MAX_ITERS = 40
-INTERVAL_REFRESH_STATUS = 20
+POLL_TIMEOUT = 800
+POLL_MIN_INTERVAL = 2
+POLL_MAX_INTERVAL = 30
+POLL_BACKOFF = 1.5
+POLL_JITTER = 0.25
+POLL_EXPECTED_FRACTION = 0.8
+POLL_STATS_WEIGHT = 0.3
+MAX_CONCURRENT_PIPELINES = 10
+DOWNLOAD_WORKERS = 8
+BLEND_PROCESSES = os.cpu_count()
+PIPELINE_QUEUE_SIZE = 4
 GSD_LIMIT = 0.55
+MAX_CLOUD_COVER = 0.05
+DEDUP_RADIUS = 1.5
+DEDUP_MARGIN = 0.25
+DEDUP_BOX_QUANTILE = 0.9
+CHANGE_MATCH_RADIUS = 3.0
+BATCH_MERGE_DISTANCE = 0.05
 SCENES_LIMIT = 25
+SELECTION_BUCKET_HOURS = 24
+SELECTION_MIN_COVERAGE = 0.5
+SELECTION_SAMPLES = 16
 DAYS_BACK = 365
 MAX_FILENAME_LENGTH = 255
+TEMP_DIR = "./json/temporary"
+IMG_DIR = "./img"
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+CACHE_LOW_WATERMARK = 0.9
+OVERLAY_MODE = "server"
+OVERLAY_COLORS = {"cars": (255, 0, 0, 160), "aircraft": (0, 160, 255, 160)}
+OVERLAY_DEFAULT_COLOR = (255, 255, 0, 160)
+OVERLAY_SHADE_ORIENTATION = False
+MOSAIC = False
+PYRAMID_MIN_ZOOM = 12
+PROFILE_REPORT = None
+PROFILE_STAGES = False
+LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 3
+WORKER_POLL_INTERVAL = 5
+
+HTTP_TIMEOUT = 60
+AUTH_REFRESH_MARGIN = 300
+AUTH_DEFAULT_LIFETIME = 3600
+HTTP_POOL_SIZE = 16
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 1
+RATE_LIMIT = (10, 20)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
 COMMON_HEADERS = {"Content-Type": "application/json",}
 
@@ -14,6 +57,10 @@ AUTH_PATH = "https://spaceknow.auth0.com"
 IMAG_PATH = "https://spaceknow-imagery.appspot.com"
 KRAK_PATH = "https://spaceknow-kraken.appspot.com"
 
+RATE_LIMITS = {
+    "spaceknow-kraken.appspot.com/kraken/grid": (50, 100),
+}
+
 AUTH = {
     "METHOD": "POST",
 
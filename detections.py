@@ -0,0 +1,239 @@
+import codecs
+import collections
+import itertools
+import json
+import re
+
+import exceptions
+
+
+Detection = collections.namedtuple("Detection", ["cls", "count", "area", "orientation", "centroid", "coordinates"])
+
+# A complete string, a brace, a run of array brackets and numbers (coordinates are skipped as a whole), or the opening
+# quote of a string not yet fully received
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}]|[\[\]][\[\]0-9\s,.+\-eE]*|"')
+_SKIP_TO_BRACE = re.compile(r'[^"{}]*(?:"(?:[^"\\]|\\.)*"[^"{}]*)*([{}])')
+_PROPERTIES = re.compile(r'"properties"\s*:\s*')
+_COORDINATES = re.compile(r'"coordinates"\s*:\s*')
+_DECODER = json.JSONDecoder()
+
+
+def iter_features(chunks):
+    """
+    Incrementally splits a geojson `FeatureCollection` into the JSON texts of its features without parsing them. Only
+    strings and brackets are tokenized, so the coordinates of the geometries are never converted to Python objects, and
+    at most one feature is held in memory at a time.
+
+    :param iterable chunks: Content of the geojson file as an iterable of `bytes` chunks.
+    :return generator: Yields the JSON text of each feature in the `features` array.
+
+    :raises exceptions.FieldNotFoundException: Raised as soon as the content is found not to be a JSON object, or if
+    it has no `features` array or ends prematurely.
+    """
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    depth = 0
+    started = False
+    features_key = False
+    in_features = False
+    seen_features = False
+    feature_start = None
+
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        buf += decoder.decode(b"" if final else chunk, final)
+
+        if not started:
+            stripped = buf.lstrip()
+            if not stripped:
+                continue
+            if stripped[0] != "{":
+                raise exceptions.FieldNotFoundException("Invalid detections.geojson file - not a JSON object")
+            started = True
+
+        while True:
+            if feature_start is not None:
+                # Inside a feature only braces matter, everything up to the next one is skipped in a single match
+                m = _SKIP_TO_BRACE.match(buf, pos)
+                if m is None:
+                    break
+                pos = m.end()
+                if m.group(1) == "{":
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 2:
+                        yield buf[feature_start:pos]
+                        feature_start = None
+                continue
+
+            m = _TOKEN.search(buf, pos)
+            if m is None:
+                break
+            token = m.group()
+            if token == '"':
+                break
+
+            pos = m.end()
+            if token == "{":
+                if depth == 2 and in_features:
+                    feature_start = m.start()
+                depth += 1
+            elif token == "}":
+                depth -= 1
+            elif token[0] != '"':
+                if depth == 1 and features_key and token.lstrip().startswith("["):
+                    in_features = seen_features = True
+                depth += token.count("[") - token.count("]")
+                if depth <= 1:
+                    in_features = False
+            if depth < 0:
+                raise exceptions.FieldNotFoundException("Invalid detections.geojson file - unbalanced brackets")
+            features_key = depth == 1 and token == '"features"'
+
+        # Keep only the unfinished feature, or the unprocessed tail of the buffer
+        keep = pos if feature_start is None else feature_start
+        buf = buf[keep:]
+        pos -= keep
+        if feature_start is not None:
+            feature_start = 0
+
+    if not started or depth != 0:
+        raise exceptions.FieldNotFoundException("Invalid detections.geojson file - unexpected end of file")
+    if not seen_features:
+        raise exceptions.FieldNotFoundException("Invalid detections.geojson file - missing features field")
+
+
+def _decode_after(pattern, text):
+    m = pattern.search(text)
+    if m is None:
+        return None
+    return _DECODER.raw_decode(text, m.end())[0]
+
+
+def centroid(coordinates):
+    """
+    :param list coordinates: Coordinates of a `Polygon` or `MultiPolygon`; only the outer ring of the first polygon is
+    considered.
+    :return tuple: Mean `(lon, lat)` of the vertices of the ring.
+    """
+
+    ring = coordinates
+    while isinstance(ring[0][0], list):
+        ring = ring[0]
+    if len(ring) > 1 and ring[0] == ring[-1]:
+        ring = ring[:-1]
+    return sum(p[0] for p in ring) / len(ring), sum(p[1] for p in ring) / len(ring)
+
+
+def _parse_features(data):
+    try:
+        gjson = json.loads(data)
+    except ValueError:
+        raise exceptions.FieldNotFoundException("Invalid detections.geojson file - not valid JSON")
+    if not isinstance(gjson, dict):
+        raise exceptions.FieldNotFoundException("Invalid detections.geojson file - not a JSON object")
+    if not isinstance(gjson.get("features"), list):
+        raise exceptions.FieldNotFoundException("Invalid detections.geojson file - missing features field")
+    return gjson["features"]
+
+
+def _stream_properties(chunks):
+    for feature in iter_features(chunks):
+        try:
+            yield _decode_after(_PROPERTIES, feature), feature
+        except ValueError:
+            yield None, feature
+
+
+def _coordinates(feature):
+    if isinstance(feature, dict):
+        return feature["geometry"]["coordinates"]
+    return _decode_after(_COORDINATES, feature)
+
+
+def bounds(coordinates):
+    """
+    :param list coordinates: Coordinates of a `Polygon` or `MultiPolygon`.
+    :return tuple: Bounding box `(west, south, east, north)` of all vertices.
+    """
+
+    rings = [coordinates] if not isinstance(coordinates[0][0][0], list) else coordinates
+    points = [point for polygon in rings for ring in polygon for point in ring]
+    lons, lats = [p[0] for p in points], [p[1] for p in points]
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+def iter_detections(content, classes=None, centroids=False, geometries=False):
+    """
+    Reads detections from a `detections.geojson` file. A file already in memory is parsed by `json.loads`, which is the
+    fastest way to read it whole; a file arriving in chunks is streamed by `iter_features`, decoding only the
+    `properties` of each feature and, if requested, its coordinates, so that it is never held in memory at once.
+
+    :param content: Content of the geojson file, `bytes`, or an iterable of `bytes` chunks.
+    :param iterable classes: Classes to include, e.g. `["cars"]` (default: all).
+    :param bool centroids: Whether to compute the centroid of each detection.
+    :param bool geometries: Whether to include the coordinates of each detection.
+    :return generator: Yields a `Detection` for each feature of the selected classes; `centroid` and `coordinates` are
+    `None` unless requested.
+
+    :raises exceptions.FieldNotFoundException: Raised if the file or one of its features is malformed.
+    """
+
+    classes = None if classes is None else set(classes)
+
+    if isinstance(content, (bytes, bytearray, str)):
+        features = ((feature.get("properties") if isinstance(feature, dict) else None, feature)
+                    for feature in _parse_features(content))
+    else:
+        features = _stream_properties(content)
+
+    for properties, feature in features:
+        if not isinstance(properties, dict) or "class" not in properties:
+            raise exceptions.FieldNotFoundException("Invalid detections.geojson file - feature without properties: "
+                                                    "\n{}".format(str(feature)[:1000]))
+
+        if classes is not None and properties["class"] not in classes:
+            continue
+
+        point, coordinates = None, None
+        if centroids or geometries:
+            try:
+                coordinates = _coordinates(feature)
+                point = centroid(coordinates) if centroids else None
+            except (ValueError, TypeError, IndexError, KeyError):
+                raise exceptions.FieldNotFoundException("Invalid detections.geojson file - feature without valid "
+                                                        "coordinates: \n{}".format(str(feature)[:1000]))
+
+        yield Detection(properties["class"], properties.get("count", 1), properties.get("area"),
+                        properties.get("orientation"), point, coordinates if geometries else None)
+
+
+def tally(content, classes):
+    """
+    Sums the `count` of detections of each of `classes` in a single pass over a `detections.geojson` file.
+
+    :param content: Content of the geojson file, `bytes`, or an iterable of `bytes` chunks (see `iter_detections`).
+    :param iterable classes: Classes to count, e.g. `["cars", "aircraft"]`.
+    :return dict: Maps each of `classes` to its number of detections.
+
+    :raises exceptions.FieldNotFoundException: Raised if the file or one of its features is malformed.
+    """
+
+    counts = dict.fromkeys(classes, 0)
+    if not isinstance(content, (bytes, bytearray, str)):
+        for detection in iter_detections(content, counts.keys()):
+            counts[detection.cls] += detection.count
+        return counts
+
+    # Counting needs the properties only, so features of a file in memory are read without building `Detection`s
+    for feature in _parse_features(content):
+        properties = feature.get("properties") if isinstance(feature, dict) else None
+        if not isinstance(properties, dict) or "class" not in properties:
+            raise exceptions.FieldNotFoundException("Invalid detections.geojson file - feature without properties: "
+                                                    "\n{}".format(str(feature)[:1000]))
+        if properties["class"] in counts:
+            counts[properties["class"]] += properties.get("count", 1)
+    return counts
@@ -0,0 +1,227 @@
+import bisect
+import collections
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+
+import config
+
+
+class Recorder:
+    """
+    Thread-safe collector of run metrics: wall time of every stage, latency histogram of every endpoint and number of
+    polls of every pipeline. Stages may be profiled with `cProfile` as well; as only one profiler can be active at a
+    time, a stage entered while another one is being profiled (e.g. in another thread) is timed but not profiled.
+    """
+
+    def __init__(self, profile_stages=False):
+        """
+        :param bool profile_stages: Whether to run `cProfile` in every stage.
+        """
+
+        self.profile_stages = profile_stages
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = collections.OrderedDict()
+        self.latencies = collections.OrderedDict()
+        self.polls = collections.OrderedDict()
+        self.profiles = {}
+        self.profiler_lock = threading.Lock()
+
+    @staticmethod
+    def _bucket(seconds):
+        return bisect.bisect_left(config.LATENCY_BUCKETS, seconds)
+
+    def add_time(self, stage, seconds):
+        """
+        :param str stage: Stage name.
+        :param float seconds: Wall time of one execution of the stage.
+        """
+
+        with self.lock:
+            record = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+            record["calls"] += 1
+            record["seconds"] += seconds
+            record["max_seconds"] = max(record["max_seconds"], seconds)
+
+    def add_latency(self, endpoint, seconds):
+        """
+        :param str endpoint: Endpoint key, e.g. `"spaceknow-kraken.appspot.com/kraken/grid"`.
+        :param float seconds: Latency of one request.
+        """
+
+        with self.lock:
+            record = self.latencies.setdefault(endpoint, {"requests": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                          "histogram": [0] * (len(config.LATENCY_BUCKETS) + 1)})
+            record["requests"] += 1
+            record["seconds"] += seconds
+            record["max_seconds"] = max(record["max_seconds"], seconds)
+            record["histogram"][self._bucket(seconds)] += 1
+
+    def add_polls(self, pipeline, polls):
+        """
+        :param str pipeline: Pipeline kind, e.g. `"kraken/cars"`.
+        :param int polls: Number of polls until the pipeline was done.
+        """
+
+        with self.lock:
+            self.polls.setdefault(pipeline, []).append(polls)
+
+    def stage(self, name):
+        """
+        Returns a context manager timing (and optionally profiling) a stage. A stage nested in a stage of the same name
+        is not counted twice.
+
+        :param str name: Stage name, e.g. `"download"`.
+        :return contextmanager: Context manager of the stage.
+        """
+
+        return _Stage(self, name)
+
+    def _profile_stats(self, top=10):
+        stages = {}
+        for name, profile in self.profiles.items():
+            stats = pstats.Stats(profile)
+            functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            stages[name] = [{"function": "{}:{}({})".format(*function), "calls": calls, "total_seconds": total,
+                             "cumulative_seconds": cumulative}
+                            for function, (_, calls, total, cumulative, _) in functions]
+        return stages
+
+    def report(self, **extra):
+        """
+        :param extra: Additional sections of the report, e.g. transport and cache counters.
+        :return dict: Machine-readable report of all metrics recorded so far.
+        """
+
+        with self.lock:
+            report = collections.OrderedDict(wall_seconds=time.monotonic() - self.started)
+            report["stages"] = {name: dict(record) for name, record in self.stages.items()}
+            report["endpoints"] = {endpoint: dict(record, mean_seconds=record["seconds"] / record["requests"],
+                                                  buckets=list(config.LATENCY_BUCKETS) + ["inf"])
+                                   for endpoint, record in self.latencies.items()}
+            report["polls"] = {pipeline: {"pipelines": len(polls), "polls": sum(polls), "max_polls": max(polls),
+                                          "mean_polls": sum(polls) / len(polls)}
+                               for pipeline, polls in self.polls.items()}
+        if self.profiles:
+            report["profiles"] = self._profile_stats()
+        report.update(extra)
+        return report
+
+    def write(self, path, **extra):
+        """
+        Writes the report (see `report`) to `path` as JSON, and the raw `cProfile` data of every profiled stage next to
+        it as `{path}.{stage}.pstats`.
+
+        :param str path: Report file path.
+        :param extra: Additional sections of the report.
+        """
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(**extra), f, indent=2)
+        for name, profile in self.profiles.items():
+            profile.dump_stats("{}.{}.pstats".format(path, name))
+
+
+class _Stage:
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.outermost = False
+        self.profiling = False
+
+    def __enter__(self):
+        active = self.recorder.local.__dict__.setdefault("stages", [])
+        self.outermost = self.name not in active
+        active.append(self.name)
+        if self.outermost and self.recorder.profile_stages and self.recorder.profiler_lock.acquire(blocking=False):
+            self.profiling = True
+            with self.recorder.lock:
+                profile = self.recorder.profiles.setdefault(self.name, cProfile.Profile())
+            profile.enable()
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.monotonic() - self.started
+        if self.profiling:
+            self.recorder.profiles[self.name].disable()
+            self.recorder.profiler_lock.release()
+        self.recorder.local.stages.pop()
+        if self.outermost:
+            self.recorder.add_time(self.name, elapsed)
+        return False
+
+
+_default = Recorder()
+
+
+def default():
+    """
+    :return Recorder: Recorder of the current run.
+    """
+
+    return _default
+
+
+def reset(profile_stages=False):
+    """
+    Starts recording a new run.
+
+    :param bool profile_stages: Whether to run `cProfile` in every stage.
+    :return Recorder: The new recorder.
+    """
+
+    global _default
+    _default = Recorder(profile_stages)
+    return _default
+
+
+def timed(stage):
+    """
+    Decorator recording the wall time of every call of the decorated function as `stage` (see `Recorder.stage`).
+
+    :param str stage: Stage name.
+    :return callable: Decorator.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with default().stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(stage, iterable):
+    """
+    Records the time spent producing the items of `iterable` as one call of `stage`, excluding the time the consumer
+    spends between them.
+
+    :param str stage: Stage name.
+    :param iterable iterable: Iterable to time, e.g. a generator polling pipelines.
+    :return generator: Yields the items of `iterable`.
+    """
+
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.monotonic() - started
+            yield item
+    finally:
+        default().add_time(stage, elapsed)
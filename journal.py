@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import threading
+
+import config
+
+
+class Journal:
+    """
+    Append-only journal of a run, one JSON record per line. Records the search results, every initiated Kraken pipeline
+    and its result, and every scene downloaded, blended and counted, so that an interrupted run can be resumed without
+    repeating finished work or starting pipelines which are still in flight.
+
+    Every record is flushed to disk before `record` returns; a partially written line (e.g. after a crash) is ignored
+    when the journal is read.
+    """
+
+    def __init__(self, path, resume=False):
+        """
+        :param str path: Journal file.
+        :param bool resume: Whether to continue the existing journal; otherwise it is started afresh.
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.scene_ids = None
+        self.initiated = {}
+        self.retrieved = {}
+        self.downloaded = set()
+        self.blended = set()
+        self.counted = {}
+
+        terminated = True
+        if resume and os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    terminated = line.endswith("\n")
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        continue
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a" if resume else "w")
+        if not terminated:
+            self.file.write("\n")
+
+    @classmethod
+    def for_run(cls, extent, map_types, resume=False):
+        """
+        Returns the journal of runs over `extent` for `map_types`, stored in `config.TEMP_DIR`.
+
+        :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
+        :param list map_types: Types of the desired maps, e.g. `["cars", "aircraft"]`.
+        :param bool resume: Whether to continue the existing journal.
+        :return Journal: Journal of the run.
+        """
+
+        digest = hashlib.sha256(json.dumps([extent, sorted(map_types)]).encode()).hexdigest()[:16]
+        return cls(os.path.join(config.TEMP_DIR, "journal_" + digest + ".jsonl"), resume)
+
+    def _apply(self, record):
+        event = record["event"]
+        key = (record.get("scene_id"), record.get("map_type"))
+        if event == "search":
+            self.scene_ids = record["scene_ids"]
+        elif event == "initiated":
+            self.initiated[key] = record["pipeline_id"]
+        elif event == "retrieved":
+            self.retrieved[key] = record["response"]
+        elif event == "downloaded":
+            self.downloaded.add(record["scene_id"])
+        elif event == "blended":
+            self.blended.add(record["scene_id"])
+        elif event == "counted":
+            self.counted[key] = record["count"]
+
+    def record(self, event, **fields):
+        """
+        Appends a record to the journal.
+
+        :param str event: One of `"search"` (`scene_ids`), `"initiated"` (`scene_id`, `map_type`, `pipeline_id`),
+        `"retrieved"` (`scene_id`, `map_type`, `response`), `"downloaded"`, `"blended"` (`scene_id`) and `"counted"`
+        (`scene_id`, `map_type`, `count`).
+        :param fields: Fields of the record.
+        """
+
+        record = dict(fields, event=event)
+        with self.lock:
+            self._apply(record)
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        """Closes the journal file."""
+
+        with self.lock:
+            self.file.close()
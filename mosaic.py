@@ -0,0 +1,200 @@
+import hashlib
+import io
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+import overlay
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class PngWriter:
+    """
+    Writes an 8-bit RGB PNG image row by row through a streaming zlib compressor, so that only the rows being written
+    are held in memory however large the image is. The image is written to a temporary file which replaces `path` once
+    all rows have been written.
+    """
+
+    def __init__(self, path, width, height, level=6):
+        """
+        :param str path: Destination file path.
+        :param int width: Width of the image in pixels.
+        :param int height: Height of the image in pixels.
+        :param int level: zlib compression level.
+        """
+
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.tmp_path = path + ".part"
+        self.file = open(self.tmp_path, "wb")
+        self.compressor = zlib.compressobj(level)
+
+        self.file.write(PNG_SIGNATURE)
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data)
+        self.file.write(struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    def write_rows(self, rows):
+        """
+        :param numpy.ndarray rows: Array of shape `(n, width, 3)` of `uint8` RGB pixels of the next `n` rows.
+        """
+
+        rows = np.asarray(rows, dtype=np.uint8).reshape(-1, self.width * 3)
+        raw = np.zeros((len(rows), 1 + self.width * 3), dtype=np.uint8)  # Filter type 0 (none) before every row
+        raw[:, 1:] = rows
+        self.rows += len(rows)
+        data = self.compressor.compress(raw.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def close(self):
+        """
+        Finishes the image and moves it to its destination.
+
+        :raises ValueError: Raised if fewer or more rows than `height` have been written.
+        """
+
+        try:
+            if self.rows != self.height:
+                raise ValueError("{} rows written to an image of height {}".format(self.rows, self.height))
+            self._chunk(b"IDAT", self.compressor.flush())
+            self._chunk(b"IEND", b"")
+        finally:
+            self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def _open(image):
+    return Image.open(io.BytesIO(image) if isinstance(image, bytes) else image)
+
+
+def write_mosaic(tiles, out_path, size=overlay.TILE_SIZE):
+    """
+    Stitches tiles of one zoom level into a single PNG image using their x/y offsets. The mosaic is written one strip of
+    tiles at a time, so memory use is bounded by a single strip; missing tiles are left black.
+
+    :param dict tiles: Maps `(x, y)` tile coordinates to PNG content or file paths.
+    :param str out_path: Destination file path.
+    :param int size: Size of the tiles in pixels.
+    :return tuple: Size `(width, height)` of the mosaic in pixels.
+    """
+
+    xs = [x for x, _ in tiles]
+    ys = [y for _, y in tiles]
+    x0, y0 = min(xs), min(ys)
+    width, height = (max(xs) - x0 + 1) * size, (max(ys) - y0 + 1) * size
+
+    writer = PngWriter(out_path, width, height)
+    try:
+        for y in range(y0, max(ys) + 1):
+            strip = np.zeros((size, width, 3), dtype=np.uint8)
+            for x in range(x0, max(xs) + 1):
+                if (x, y) in tiles:
+                    image = _open(tiles[(x, y)]).convert("RGB")
+                    if image.size != (size, size):
+                        image = image.resize((size, size), Image.BILINEAR)
+                    strip[:, (x - x0) * size:(x - x0 + 1) * size] = np.asarray(image)
+            writer.write_rows(strip)
+        writer.close()
+    except BaseException:
+        writer.file.close()
+        if os.path.isfile(writer.tmp_path):
+            os.remove(writer.tmp_path)
+        raise
+
+    return width, height
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _save(image, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".part"
+    image.save(tmp_path, "PNG")
+    os.replace(tmp_path, path)
+
+
+def build_pyramid(tiles, root, min_zoom, size=overlay.TILE_SIZE):
+    """
+    Writes tiles into a standard `{z}/{x}/{y}.png` directory in `root` which a local map viewer can serve, and builds
+    every lower zoom level down to `min_zoom` by downsampling the four child tiles of each tile.
+
+    Digests of all tiles are kept in `manifest.json` in `root`; a tile is only written if its content, or the content
+    of any of its children, has changed since the last build.
+
+    :param dict tiles: Maps `(z, x, y)` tile coordinates to PNG content or file paths.
+    :param str root: Root directory of the pyramid.
+    :param int min_zoom: Lowest zoom level to build.
+    :param int size: Size of the tiles in pixels.
+    :return int: Number of tiles written.
+    """
+
+    manifest_path = os.path.join(root, "manifest.json")
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    def tile_path(z, x, y):
+        return os.path.join(root, str(z), str(x), str(y) + ".png")
+
+    def changed(key, digest, path):
+        return manifest.get(key) != digest or not os.path.isfile(path)
+
+    written = 0
+    level = {}
+    for (z, x, y), tile in tiles.items():
+        if isinstance(tile, bytes):
+            data = tile
+        else:
+            with open(tile, "rb") as f:
+                data = f.read()
+        key, digest, path = "{}/{}/{}".format(z, x, y), _digest(data), tile_path(z, x, y)
+        if changed(key, digest, path):
+            _save(_open(data), path)
+            written += 1
+        manifest[key] = digest
+        level.setdefault(z, {})[(x, y)] = digest
+
+    for z in range(max(level, default=min_zoom), min_zoom, -1):
+        if z not in level:
+            continue
+        parents = {}
+        for x, y in level[z]:
+            parents.setdefault((x // 2, y // 2), None)
+        for px, py in parents:
+            children = [(2 * px + dx, 2 * py + dy) for dy in (0, 1) for dx in (0, 1)]
+            # A parent depends on all its children, including those built earlier or by other scenes of the pyramid
+            digests = [level[z].get(child) or manifest.get("{}/{}/{}".format(z, *child), "") for child in children]
+            key, digest, path = "{}/{}/{}".format(z - 1, px, py), _digest("".join(digests).encode()), \
+                tile_path(z - 1, px, py)
+            if changed(key, digest, path):
+                canvas = Image.new("RGBA", (2 * size, 2 * size), (0, 0, 0, 0))
+                for (cx, cy), child_digest in zip(children, digests):
+                    if child_digest:
+                        child = Image.open(tile_path(z, cx, cy)).convert("RGBA")
+                        canvas.paste(child.resize((size, size)), ((cx - 2 * px) * size, (cy - 2 * py) * size))
+                _save(canvas.resize((size, size), Image.LANCZOS), path)
+                written += 1
+            manifest[key] = digest
+            level.setdefault(z - 1, {})[(px, py)] = digest
+
+    os.makedirs(root, exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+    return written
@@ -0,0 +1,80 @@
+import colorsys
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import detections
+
+
+TILE_SIZE = 256
+
+
+def to_pixels(coordinates, z, x, y, size=TILE_SIZE):
+    """
+    Projects `(lon, lat)` points to pixel coordinates within a Web Mercator (slippy map) tile.
+
+    :param numpy.ndarray coordinates: Array of shape `(n, 2)` of `(lon, lat)` points.
+    :param int z: Zoom level of the tile.
+    :param int x: Column of the tile.
+    :param int y: Row of the tile.
+    :param int size: Size of the tile in pixels.
+    :return numpy.ndarray: Array of shape `(n, 2)` of `(column, row)` pixel coordinates, possibly outside the tile.
+    """
+
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    n = 2 ** z
+    lat = np.radians(coordinates[:, 1])
+    px = ((coordinates[:, 0] + 180.0) / 360.0 * n - x) * size
+    py = ((1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0 * n - y) * size
+    return np.column_stack((px, py))
+
+
+def shade(color, orientation):
+    """
+    :param tuple color: RGBA colour.
+    :param float orientation: Orientation of the detection in degrees.
+    :return tuple: `color` with its hue rotated by the orientation - a half turn of the object is a full turn of hue.
+    """
+
+    h, s, v = colorsys.rgb_to_hsv(*(c / 255.0 for c in color[:3]))
+    r, g, b = colorsys.hsv_to_rgb((h + (orientation % 180.0) / 180.0) % 1.0, s, v)
+    return int(round(r * 255)), int(round(g * 255)), int(round(b * 255)), color[3]
+
+
+def render_tile(background, gjson, tile, cls, color, out_path, shade_orientation=False):
+    """
+    Draws the detections of class `cls` from a `detections.geojson` file of `tile` over the truecolor image of the
+    tile and writes the result to `out_path`, instead of downloading and blending the overlay rendered by the server.
+    The geojson is parsed once, both for drawing and for counting.
+
+    :param bytes background: PNG content of the truecolor tile.
+    :param bytes gjson: Content of the `detections.geojson` file of the tile.
+    :param list tile: Tile coordinates `[z, x, y]`.
+    :param str cls: Class of the detections to draw, e.g. `"cars"`.
+    :param tuple color: RGBA colour of the detections.
+    :param str out_path: Destination file path.
+    :param bool shade_orientation: Whether to vary the hue of every detection with its orientation.
+    :return list: Detections of the tile as tuples of the fields of `store.DETECTION_DTYPE`.
+
+    :raises exceptions.FieldNotFoundException: Raised if unable to parse the geojson.
+    """
+
+    image = Image.open(io.BytesIO(background)).convert("RGBA")
+    layer = Image.new("RGBA", image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+
+    rows = []
+    for detection in detections.iter_detections(gjson, [cls], centroids=True, geometries=True):
+        fill = shade(color, detection.orientation or 0.0) if shade_orientation else tuple(color)
+        polygons = detection.coordinates if isinstance(detection.coordinates[0][0][0], list) \
+            else [detection.coordinates]
+        for polygon in polygons:
+            points = to_pixels(polygon[0], *tile, size=image.size[0])
+            draw.polygon([tuple(point) for point in points.tolist()], fill=fill)
+        rows.append((tile[0], tile[1], tile[2], detection.centroid[0], detection.centroid[1],
+                     detection.area or 0.0, detection.orientation or 0.0, detection.count, detection.cls) +
+                    detections.bounds(detection.coordinates))
+
+    Image.alpha_composite(image, layer).convert("RGB").save(out_path)
+    return rows
@@ -0,0 +1,163 @@
+import json
+import os
+import random
+import threading
+import time
+
+import config
+import exceptions
+import instrument
+
+
+class PollStats:
+    """
+    Persistent record of how long pipelines of a given kind (e.g. `"search"`, `"kraken/cars"`) typically take to
+    complete. Kept as an exponentially weighted moving average per key in a small JSON file, so that subsequent runs can
+    start polling around the time a pipeline is expected to finish.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stats = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, "r") as f:
+                    self.stats = json.load(f)
+            except ValueError:
+                self.stats = {}
+
+    @classmethod
+    def default(cls):
+        """
+        Returns the shared instance backed by `poll_stats.json` in `config.TEMP_DIR`.
+
+        :return PollStats: Shared instance.
+        """
+
+        path = os.path.join(config.TEMP_DIR, "poll_stats.json")
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def expected(self, key):
+        """
+        :param str key: Pipeline kind.
+        :return float: Expected completion time in seconds, or `None` if nothing has been recorded yet.
+        """
+
+        with self.lock:
+            entry = self.stats.get(key)
+            return entry["mean"] if entry else None
+
+    def record(self, key, elapsed):
+        """
+        Updates the moving average of `key` with a new completion time and saves the stats.
+
+        :param str key: Pipeline kind.
+        :param float elapsed: Observed completion time in seconds.
+        """
+
+        with self.lock:
+            entry = self.stats.get(key)
+            if entry is None:
+                entry = {"mean": elapsed, "n": 0}
+            else:
+                entry["mean"] += config.POLL_STATS_WEIGHT * (elapsed - entry["mean"])
+            entry["n"] += 1
+            self.stats[key] = entry
+
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(self.stats, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class Poller:
+    """
+    Poll schedule of a single pipeline. The first poll is timed shortly before the learned completion time of pipelines
+    of the same kind, subsequent polls wait for the rest of that time and then back off exponentially with jitter, and
+    the whole schedule is bounded by a single deadline.
+
+    Can be used either blocking via `poll`, or non-blocking via `due_at`/`reschedule`/`done` when many pipelines are
+    polled in one loop.
+    """
+
+    def __init__(self, key, timeout=None, stats=None):
+        """
+        :param str key: Pipeline kind, e.g. `"search"` or `"kraken/cars"`.
+        :param float timeout: Seconds after which polling gives up (default: `config.POLL_TIMEOUT`).
+        :param PollStats stats: Completion time statistics (default: `PollStats.default()`).
+        """
+
+        self.key = key
+        self.timeout = config.POLL_TIMEOUT if timeout is None else timeout
+        self.stats = PollStats.default() if stats is None else stats
+        self.started = time.monotonic()
+        self.deadline = self.started + self.timeout
+        self.polls = 0
+
+        self.expected = self.stats.expected(key)
+        self._next_interval = config.POLL_MIN_INTERVAL
+        first = config.POLL_MIN_INTERVAL if self.expected is None else max(
+            self.expected * config.POLL_EXPECTED_FRACTION, config.POLL_MIN_INTERVAL)
+        self.due_at = self.started + min(first, config.POLL_MAX_INTERVAL)
+
+    def reschedule(self):
+        """
+        Schedules the next poll after an unsuccessful one.
+
+        :raises exceptions.FatalException: Raised if the deadline has passed.
+        """
+
+        self.polls += 1
+        now = time.monotonic()
+        if now >= self.deadline:
+            raise exceptions.FatalException("Pipeline processing timeout after {:.0f} s ({} polls)".format(
+                now - self.started, self.polls))
+
+        remaining = 0 if self.expected is None else self.expected - (now - self.started)
+        if remaining > config.POLL_MIN_INTERVAL:
+            # Not expected to be done yet - wait for the rest of the learned completion time instead of backing off
+            # from the shortest interval
+            interval = min(remaining, config.POLL_MAX_INTERVAL)
+        else:
+            interval = self._next_interval
+            self._next_interval = min(self._next_interval * config.POLL_BACKOFF, config.POLL_MAX_INTERVAL)
+        interval *= random.uniform(1 - config.POLL_JITTER, 1 + config.POLL_JITTER)
+        self.due_at = min(now + interval, self.deadline)
+
+    def done(self):
+        """Records the completion time of the pipeline."""
+
+        self.polls += 1
+        self.stats.record(self.key, time.monotonic() - self.started)
+        instrument.default().add_polls(self.key, self.polls)
+
+    def poll(self, retrieve):
+        """
+        Calls `retrieve` according to the schedule until it stops raising `exceptions.NotProcessedException`.
+
+        :param callable retrieve: Function without arguments returning the pipeline result.
+        :return: Return value of `retrieve`.
+
+        :raises exceptions.FatalException: Raised if the deadline has passed.
+        """
+
+        while True:
+            time.sleep(max(self.due_at - time.monotonic(), 0))
+            try:
+                result = retrieve()
+            except exceptions.NotProcessedException:
+                self.reschedule()
+                if config.DEBUG:
+                    print("Pipeline not done processing yet... Trying again in {:.1f} s".format(
+                        self.due_at - time.monotonic()))
+                continue
+            self.done()
+            return result
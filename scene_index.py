@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+
+import config
+import exceptions
+import spatial
+
+
+class SceneIndex:
+    """
+    Persistent index of the scenes found by `/imagery/search` for one extent. Besides the scenes themselves it records
+    the earliest start of a completed search (`searched_from`) and the datetime of the newest scene seen
+    (`high_water_mark`), so that subsequent searches only need to cover the time since then.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.scenes = {}
+        self.searched_from = None
+        self.high_water_mark = None
+
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            self.scenes = data["scenes"]
+            self.searched_from = data["searched_from"]
+            self.high_water_mark = data["high_water_mark"]
+
+    @classmethod
+    def for_extent(cls, extent):
+        """
+        Returns the index of `extent` stored in `scenes` in `config.TEMP_DIR`.
+
+        :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
+        :return SceneIndex: Index of the extent.
+        """
+
+        digest = hashlib.sha256(json.dumps(extent).encode()).hexdigest()[:16]
+        return cls(os.path.join(config.TEMP_DIR, "scenes", digest + ".json"))
+
+    def search_start(self, start):
+        """
+        Returns the start of the search needed to bring the index up to date for a window starting at `start`.
+
+        :param str start: Start of the requested window, `"%Y-%m-%d %H:%M:%S"`.
+        :return str: `start` if the window has not been searched yet, the high-water mark otherwise.
+        """
+
+        if self.searched_from is None or start < self.searched_from or self.high_water_mark is None:
+            return start
+        return max(start, self.high_water_mark)
+
+    def merge(self, results):
+        """
+        Adds scenes from a `/imagery/search/retrieve` response to the index.
+
+        :param list results: `results` field of the response.
+
+        :raises exceptions.FieldNotFoundException: Raised if a result has no `sceneId`.
+        """
+
+        for result in results:
+            if not result.get("sceneId"):
+                raise exceptions.FieldNotFoundException("sceneId field not found in /search/retrieve response!")
+
+            self.scenes[result["sceneId"]] = {
+                "sceneId": result["sceneId"],
+                "datetime": result["datetime"],
+                "cloudCover": result.get("cloudCover"),
+                "gsd": result["bands"][0]["gsd"] if result.get("bands") else None,
+                "footprint": result.get("footprint"),
+                "offNadir": result.get("offNadir"),
+                "sunElevation": result.get("sunElevation"),
+            }
+            if self.high_water_mark is None or result["datetime"] > self.high_water_mark:
+                self.high_water_mark = result["datetime"]
+
+    def complete(self, start):
+        """
+        Marks the window from `start` on as fully searched and saves the index.
+
+        :param str start: Start of the completed search, `"%Y-%m-%d %H:%M:%S"`.
+        """
+
+        if self.searched_from is None or start < self.searched_from:
+            self.searched_from = start
+        self.save()
+
+    def save(self):
+        """Atomically writes the index to its file."""
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"searched_from": self.searched_from, "high_water_mark": self.high_water_mark,
+                       "scenes": self.scenes}, f)
+        os.replace(tmp_path, self.path)
+
+    def eligible(self, start, end, gsd_limit=None, max_cloud_cover=None, extent=None):
+        """
+        Returns scenes in the window from `start` to `end` with cloud coverage and GSD under the limits, newest first.
+
+        :param str start: Start of the window, `"%Y-%m-%d %H:%M:%S"`.
+        :param str end: End of the window, `"%Y-%m-%d %H:%M:%S"`.
+        :param float gsd_limit: Maximum GSD (default: `config.GSD_LIMIT`).
+        :param float max_cloud_cover: Maximum cloud cover (default: `config.MAX_CLOUD_COVER`).
+        :param list extent: Optional extent coordinates; only scenes whose footprint intersects it are returned (scenes
+        without a footprint are kept).
+        :return list: Records of eligible scenes.
+        """
+
+        gsd_limit = config.GSD_LIMIT if gsd_limit is None else gsd_limit
+        max_cloud_cover = config.MAX_CLOUD_COVER if max_cloud_cover is None else max_cloud_cover
+
+        scenes = [scene for scene in self.scenes.values()
+                  if start <= scene["datetime"] <= end and
+                  isinstance(scene["cloudCover"], (int, float)) and scene["cloudCover"] < max_cloud_cover and
+                  scene["gsd"] is not None and scene["gsd"] < gsd_limit and
+                  (extent is None or not scene["footprint"] or
+                   spatial.intersects(scene["footprint"]["coordinates"], extent))]
+
+        return sorted(scenes, key=lambda scene: scene["datetime"], reverse=True)
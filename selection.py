@@ -0,0 +1,90 @@
+import math
+
+import numpy as np
+
+import config
+import spatial
+import store
+
+
+def sample_points(extent, samples=None):
+    """
+    :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
+    :param int samples: Number of grid points along each side of the bounding box of `extent` (default:
+    `config.SELECTION_SAMPLES`).
+    :return numpy.ndarray: Array of shape `(n, 2)` of the `(lon, lat)` points of a regular grid lying inside `extent`.
+    """
+
+    samples = config.SELECTION_SAMPLES if not samples else samples
+    west, south, east, north = spatial.bounds(extent)
+    # Cell centres, so that no point falls on the boundary of the extent
+    lon = west + (np.arange(samples) + 0.5) * (east - west) / samples
+    lat = south + (np.arange(samples) + 0.5) * (north - south) / samples
+    points = np.column_stack((np.repeat(lon, samples), np.tile(lat, samples)))
+    return points[spatial.points_in_polygon(points, extent)]
+
+
+def coverage(footprint, points):
+    """
+    :param dict footprint: Footprint of a scene, a geojson `Polygon` or `MultiPolygon`, or `None` if not known.
+    :param numpy.ndarray points: Sample points of the extent, see `sample_points`.
+    :return float: Fraction of `points` covered by `footprint`; 1.0 if the footprint is not known.
+    """
+
+    if not footprint or not len(points):
+        return 1.0
+    inside = np.zeros(len(points), dtype=bool)
+    for polygon in spatial.multipolygon(footprint["coordinates"]):
+        inside |= spatial.points_in_polygon(points, polygon)
+    return float(inside.mean())
+
+
+def quality(scene):
+    """
+    Scores how useful a scene is for detection: the covered fraction of the extent, discounted by the off-nadir angle
+    (objects are seen at a slant and partly hidden) and by a low sun (long shadows). Missing angles are not penalized.
+
+    :param dict scene: Scene record of `scene_index.SceneIndex` with a `coverage` field.
+    :return float: Score in range [0.0, 1.0], higher is better.
+    """
+
+    score = scene["coverage"]
+    if isinstance(scene.get("offNadir"), (int, float)):
+        score *= math.cos(math.radians(min(scene["offNadir"], 90.0)))
+    if isinstance(scene.get("sunElevation"), (int, float)):
+        score *= math.sin(math.radians(max(min(scene["sunElevation"], 90.0), 0.0)))
+    return score
+
+
+def select_scenes(scenes, extent, limit=None, bucket_hours=None, min_coverage=None):
+    """
+    Prunes redundant scenes before any Kraken pipeline is started. Scenes covering less than `min_coverage` of `extent`
+    are dropped, only the best scene (see `quality`) of every time bucket is kept, and the best `limit` of the rest
+    are selected.
+
+    :param list scenes: Scene records of `scene_index.SceneIndex`, e.g. returned by `eligible`.
+    :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
+    :param int limit: Maximum number of selected scenes (default: `config.SCENES_LIMIT`).
+    :param float bucket_hours: Length of the time buckets, `0` keeps all scenes (default:
+    `config.SELECTION_BUCKET_HOURS`).
+    :param float min_coverage: Minimum covered fraction of the extent (default: `config.SELECTION_MIN_COVERAGE`).
+    :return list: Selected scene records with added `coverage` and `quality` fields, newest first.
+    """
+
+    limit = config.SCENES_LIMIT if limit is None else limit
+    bucket_hours = config.SELECTION_BUCKET_HOURS if bucket_hours is None else bucket_hours
+    min_coverage = config.SELECTION_MIN_COVERAGE if min_coverage is None else min_coverage
+
+    points = sample_points(extent)
+    best = {}
+    for i, scene in enumerate(scenes):
+        scene = dict(scene, coverage=coverage(scene.get("footprint"), points))
+        if scene["coverage"] < min_coverage:
+            continue
+        scene["quality"] = quality(scene)
+        bucket = store.to_timestamp(scene["datetime"]) // int(bucket_hours * 3600) if bucket_hours else i
+        if bucket not in best or scene["quality"] > best[bucket]["quality"]:
+            best[bucket] = scene
+
+    selected = sorted(best.values(), key=lambda scene: scene["quality"], reverse=True)[:limit]
+    return sorted(selected, key=lambda scene: scene["datetime"], reverse=True)
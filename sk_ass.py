@@ -1,13 +1,42 @@
 import argparse
+import collections
+import concurrent.futures
+import copy
+import datetime
+import hashlib
+import io
+import itertools
 import os
 import json
+import multiprocessing
+import queue
 import requests
+import shutil
+import socket
+import tempfile
+import threading
 import time
 
+import numpy as np
 from PIL import Image
 
+import auth
+import cache
+import changes
 import config
+import detections
 import exceptions
+import instrument
+import journal
+import mosaic
+import overlay
+import polling
+import scene_index
+import selection
+import spatial
+import store
+import transport
+import workqueue
 
 
 def read_extent(input_file):
@@ -37,10 +66,58 @@ def read_extent(input_file):
         return gjson["geometries"][0]["coordinates"]
 
 
+def read_extents(source):
+    """
+    Reads the extents of a batch from `source`, which is either a directory of geojson input files (see `read_extent`),
+    or a JSONL manifest with one extent per line in form `{"name": ..., "file": ...}` or
+    `{"name": ..., "coordinates": ...}`. Relative paths in the manifest are relative to the manifest itself.
+
+    :param str source: Directory or manifest path.
+    :return collections.OrderedDict: Maps extent names (file names without extension, unless given in the manifest) to
+    extent coordinates, in order of `source`.
+
+    :raises exceptions.FatalExceptions: Raised if `source` or a file it refers to is not found.
+    :raises exceptions.FieldNotFoundExceptions: Raised if unable to process the manifest or an input file.
+    """
+
+    extents = collections.OrderedDict()
+    if os.path.isdir(source):
+        for file_name in sorted(os.listdir(source)):
+            if file_name.endswith(".geojson"):
+                extents[file_name.rpartition(".")[0]] = read_extent(os.path.join(source, file_name))
+    elif os.path.isfile(source):
+        with open(source, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    raise exceptions.FieldNotFoundException("Unable to parse manifest line: \n{}".format(line))
+                if "coordinates" in entry:
+                    extent = entry["coordinates"]
+                elif "file" in entry:
+                    extent = read_extent(os.path.join(os.path.dirname(source), entry["file"]))
+                else:
+                    raise exceptions.FieldNotFoundException("Manifest line has neither file nor coordinates field: "
+                                                            "\n{}".format(line))
+                name = entry.get("name") or os.path.basename(entry.get("file", "")).rpartition(".")[0]
+                if not name:
+                    raise exceptions.FieldNotFoundException("Manifest line has no name field: \n{}".format(line))
+                extents[name] = extent
+    else:
+        raise exceptions.FatalException("Batch input {} not found".format(source))
+
+    if not extents:
+        raise exceptions.FatalException("No extents found in {}".format(source))
+    return extents
+
+
 def get_response(conf, headers=None, payload=None, suffix=None):
     """
     Generic method used to communicate with an API endpoint. Configuration for the request is defined in `conf` and
-    can be modified by the optional arguments. If debug mode is on, it prints both request and response body.
+    can be modified by the optional arguments. `/retrieve` calls are read-only and retried on transient errors like GET
+    requests (see `transport.Transport.request`). If debug mode is on, it prints both request and response body.
 
     :param dict conf: A dict description of the API endpoint. It must contain the following keys: `"HEADERS"`,
     `"PAYLOAD"`, `"METHOD"`, `"ENDPOINT"`.
@@ -59,7 +136,9 @@ def get_response(conf, headers=None, payload=None, suffix=None):
     suffix = "" if not suffix else suffix
     endpoint = conf["ENDPOINT"]+suffix
 
-    response = requests.request(conf["METHOD"], endpoint, headers=headers, json=payload)
+    # Retrieving the result of a pipeline does not change anything, it can be retried even though it is a POST
+    response = transport.default().request(conf["METHOD"], endpoint, retriable=True if suffix == "/retrieve" else None,
+                                           headers=headers, json=payload)
 
     if config.DEBUG:
         print("REQUEST: {}".format(endpoint))
@@ -78,30 +157,53 @@ def get_response(conf, headers=None, payload=None, suffix=None):
     return response.json()
 
 
+def bearer(auth_token):
+    """
+    :param auth_token: JWT authorization token, or a callable returning one (e.g. `auth.TokenProvider`).
+    :return str: Value of the `Authorization` header.
+    """
+
+    return "Bearer " + (auth_token() if callable(auth_token) else auth_token)
+
+
+@instrument.timed("search")
 def get_scenes(extent, auth_token):
     """
     Returns a list of `sceneId`s of all scenes with no cloud coverage and GSD under limit specified in the
     configuration file.
 
+    Scenes found for `extent` are kept in a persistent `scene_index.SceneIndex`, so only the part of the search window
+    after the newest scene already seen is searched, and the eligibility filters are applied to the local index.
+    Redundant scenes are then pruned by `selection.select_scenes`, so Kraken pipelines are only started for scenes
+    adding information.
+
     :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
-    :param str auth_token: JWT authorization token.
-    :return list: List of `sceneId` of eligible scenes.
+    :param auth_token: JWT authorization token, or a callable returning one.
+    :return list: List of `sceneId` of selected scenes, newest first.
 
     :raises exceptions.InitiateException: Raised if pipeline initialization fails.
     :raises exceptions.FatalException: Raised if pipeline processing times out.
     :raises exceptions.FieldNotFoundException: Raised if a required field not found.
     """
 
-    headers = config.SEARCH["HEADERS"].copy()
-    headers["Authorization"] = "Bearer " + auth_token
+    def headers():
+        search_headers = config.SEARCH["HEADERS"].copy()
+        search_headers["Authorization"] = bearer(auth_token)
+        return search_headers
+
+    start = config.SEARCH["PAYLOAD"]["startDatetime"]
+    end = config.SEARCH["PAYLOAD"]["endDatetime"]
+
+    index = scene_index.SceneIndex.for_extent(extent)
+    search_start = index.search_start(start)
 
-    init_payload = config.SEARCH["PAYLOAD"].copy()
+    init_payload = copy.deepcopy(config.SEARCH["PAYLOAD"])
     init_payload["extent"]["geometries"][0]["coordinates"] = extent
+    init_payload["startDatetime"] = search_start
 
     cursor = "first"
-    scene_ids = []
     while cursor is not None:
-        response = get_response(config.SEARCH, headers, init_payload, "/initiate")
+        response = get_response(config.SEARCH, headers(), init_payload, "/initiate")
 
         if "pipelineId" not in response.keys():
             raise exceptions.InitiateException("Failed to initiate pipeline - no pipelineId in response body: \n{}"
@@ -111,44 +213,74 @@ def get_scenes(extent, auth_token):
 
         search_payload = {"pipelineId": pipeline_id}
 
-        iters = 0
-        retrieved = False
-        while not retrieved:
-            try:
-                response = get_response(config.SEARCH, headers, search_payload, "/retrieve")
-                retrieved = True
-            except exceptions.NotProcessedException:
-                if iters >= config.MAX_ITERS:
-                    raise exceptions.FatalException("Pipeline processing timeout after {} s".format(
-                        config.MAX_ITERS*config.INTERVAL_REFRESH_STATUS))
-                iters += 1
-                time.sleep(config.INTERVAL_REFRESH_STATUS)
-
-        for result in response["results"]:
-            if not result['sceneId']:
-                raise exceptions.FieldNotFoundException("sceneId field not found in /search/retrieve response!")
+        response = polling.Poller("search").poll(
+            lambda: get_response(config.SEARCH, headers(), search_payload, "/retrieve"))
 
-            is_scene_eligible = type(result["cloudCover"] == int) and result["cloudCover"] < 0.05 and \
-                result["bands"][0]["gsd"] < config.GSD_LIMIT
-
-            if is_scene_eligible:
-                scene_ids.append(result["sceneId"])
+        index.merge(response["results"])
 
         cursor = response["cursor"]
         init_payload["cursor"] = cursor
 
-        if len(scene_ids) > config.SCENES_LIMIT:
-            break
+    index.complete(search_start)
+
+    return [scene["sceneId"] for scene in selection.select_scenes(index.eligible(start, end), extent)]
 
-    return scene_ids
 
+def _kraken_headers(auth_token):
+    headers = config.KRAKEN["HEADERS"].copy()
+    headers["Authorization"] = bearer(auth_token)
+    return headers
+
+
+def initiate_pipeline(extent, auth_token, scene_id, map_type):
+    """
+    Initiates a Kraken pipeline for a scene given by `scene_id` and map type given by `map_type`.
 
+    :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`, or `MultiPolygon` coordinates.
+    :param auth_token: JWT authorization token, or a callable returning one.
+    :param str scene_id: Hash identifying the scene to get tiles for.
+    :param str map_type: Type of the desired map, e.g. 'cars', 'aircraft', 'cows', etc.
+    :return str: `pipelineId` of the initiated pipeline.
+
+    :raises exceptions.InitiateException: Raised if pipeline initialization fails.
+    """
+
+    payload = config.KRAKEN["PAYLOAD"].copy()
+    payload["extent"] = {"type": "MultiPolygon", "coordinates": spatial.multipolygon(extent)}
+    payload['sceneId'] = scene_id
+
+    response = get_response(config.KRAKEN, _kraken_headers(auth_token), payload, "/" + map_type + "/geojson/initiate")
+
+    if "pipelineId" not in response.keys():
+        raise exceptions.InitiateException("Failed to initiate pipeline - no pipelineId in response body: \n{}".format(
+            json.dumps(response, indent=2)))
+
+    return response["pipelineId"]
+
+
+def retrieve_pipeline(auth_token, pipeline_id, map_type):
+    """
+    Retrieves the result of a Kraken pipeline initiated by `initiate_pipeline`.
+
+    :param auth_token: JWT authorization token, or a callable returning one.
+    :param str pipeline_id: `pipelineId` returned by `initiate_pipeline`.
+    :param str map_type: Map type the pipeline was initiated for.
+    :return dict: Item with `mapId` and `tiles` fields.
+
+    :raises exceptions.NotProcessedException: Raised if the pipeline is still processing.
+    """
+
+    payload = {"pipelineId": pipeline_id}
+    return get_response(config.KRAKEN, _kraken_headers(auth_token), payload, "/" + map_type + "/geojson/retrieve")
+
+
+@instrument.timed("kraken")
 def collect_tiles(extent, auth_token, scene_id, map_type):
     """
     Collects Kraken tiles for a scene given by `scene_id` and map type given by `map_type`.
 
     :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
-    :param str auth_token: JWT authorization token.
+    :param auth_token: JWT authorization token, or a callable returning one.
     :param str scene_id: Hash identifying the scene to get tiles for.
     :param str map_type: Type of the desired map, e.g. 'cars', 'aircraft', 'cows', etc.
     :return list: List of items with `mapId` and `tiles` fields.
@@ -157,62 +289,409 @@ def collect_tiles(extent, auth_token, scene_id, map_type):
     :raises exceptions.FatalException: Raised if pipeline processing times out.
     """
 
-    payload = config.KRAKEN["PAYLOAD"].copy()
-    payload["extent"]["coordinates"] = [extent]
-    payload['sceneId'] = scene_id
+    pipeline_id = initiate_pipeline(extent, auth_token, scene_id, map_type)
 
-    headers = config.KRAKEN["HEADERS"].copy()
-    headers["Authorization"] = "Bearer " + auth_token
+    return polling.Poller("kraken/" + map_type).poll(lambda: retrieve_pipeline(auth_token, pipeline_id, map_type))
 
-    response = get_response(config.KRAKEN, headers, payload, "/" + map_type + "/geojson/initiate")
 
-    if "pipelineId" not in response.keys():
-        raise exceptions.InitiateException("Failed to initiate pipeline - no pipelineId in response body: \n{}".format(
-            json.dumps(response, indent=2)))
+def collect_all_tiles(extent, auth_token, scene_ids, map_types, max_pending=None, exclude=None, pipeline_ids=None,
+                      on_initiate=None):
+    """
+    Collects Kraken tiles for every combination of `scene_ids` and `map_types` concurrently. Up to `max_pending`
+    pipelines are kept in flight at once; all of them are polled in a single loop and each result is yielded as soon as
+    it is ready, so the total wait is close to the latency of the slowest pipeline rather than the sum of all of them.
+
+    :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`, or `MultiPolygon` coordinates.
+    :param auth_token: JWT authorization token, or a callable returning one.
+    :param list scene_ids: Hashes identifying the scenes to get tiles for.
+    :param list map_types: Types of the desired maps, e.g. `["cars", "imagery"]`.
+    :param int max_pending: Maximum number of pipelines in flight (default: `config.MAX_CONCURRENT_PIPELINES`).
+    :param set exclude: Optional `(scene_id, map_type)` combinations to skip, e.g. because they are already collected.
+    :param dict pipeline_ids: Optional mapping of `(scene_id, map_type)` to `pipelineId`s of pipelines initiated
+    earlier, which are polled instead of initiating new ones.
+    :param callable on_initiate: Optional function called with `scene_id`, `map_type` and `pipeline_id` of every newly
+    initiated pipeline.
+    :return generator: Yields tuples `(scene_id, map_type, response)` in order of completion, where `response` is an
+    item with `mapId` and `tiles` fields.
+
+    :raises exceptions.InitiateException: Raised if pipeline initialization fails.
+    :raises exceptions.FatalException: Raised if pipeline processing times out.
+    """
 
-    payload = {"pipelineId": response["pipelineId"]}
+    max_pending = config.MAX_CONCURRENT_PIPELINES if not max_pending else max_pending
+
+    exclude = set() if exclude is None else exclude
+    pipeline_ids = {} if pipeline_ids is None else pipeline_ids
+
+    jobs = [(scene_id, map_type) for scene_id in scene_ids for map_type in map_types
+            if (scene_id, map_type) not in exclude]
+    # Pipelines already in flight go first
+    jobs = collections.deque(sorted(jobs, key=lambda job: job not in pipeline_ids))
+    # Keyed by job sequence number - pipelineIds are not guaranteed to be unique across map types
+    pending = {}
+    seq = 0
+
+    while jobs or pending:
+        while jobs and len(pending) < max_pending:
+            scene_id, map_type = jobs.popleft()
+            poller = polling.Poller("kraken/" + map_type)
+            if (scene_id, map_type) in pipeline_ids:
+                pipeline_id = pipeline_ids[(scene_id, map_type)]
+                poller.due_at = time.monotonic()
+            else:
+                pipeline_id = initiate_pipeline(extent, auth_token, scene_id, map_type)
+                if on_initiate is not None:
+                    on_initiate(scene_id, map_type, pipeline_id)
+            pending[seq] = {"scene_id": scene_id, "map_type": map_type, "pipeline_id": pipeline_id, "poller": poller}
+            seq += 1
+
+        time.sleep(max(min(job["poller"].due_at for job in pending.values()) - time.monotonic(), 0))
+
+        now = time.monotonic()
+        for key in list(pending.keys()):
+            job = pending[key]
+            if job["poller"].due_at > now:
+                continue
+            try:
+                response = retrieve_pipeline(auth_token, job["pipeline_id"], job["map_type"])
+            except exceptions.NotProcessedException:
+                job["poller"].reschedule()
+                continue
 
-    iters = 0
-    retrieved = False
-    while not retrieved:
-        try:
-            response = get_response(config.KRAKEN, headers, payload, "/" + map_type + "/geojson/retrieve")
-            retrieved = True
-        except exceptions.NotProcessedException:
-            if iters >= config.MAX_ITERS:
-                raise exceptions.FatalException("Pipeline processing timeout after {} s".format(
-                    config.MAX_ITERS*config.INTERVAL_REFRESH_STATUS))
-            iters += 1
-            print("Pipeline not done processing yet... Trying again {}/{}".format(iters, config.MAX_ITERS))
-            time.sleep(config.INTERVAL_REFRESH_STATUS)
+            job["poller"].done()
+            del pending[key]
+            yield job["scene_id"], job["map_type"], response
+
+
+def tile_url(item, tile, artifact):
+    """
+    :param dict item: Item with `mapId` and `tiles` fields; response of Kraken API.
+    :param list tile: Tile coordinates `[z, x, y]`.
+    :param str artifact: File name of the artifact, e.g. `"cars.png"` or `"detections.geojson"`.
+    :return str: URL of the artifact of `tile`.
+    """
 
-    return response
+    return "/".join((config.KRAK_PATH + "/kraken/grid", item["mapId"], "-", str(tile[0]), str(tile[1]), str(tile[2]),
+                     artifact))
 
 
-def download_images(tiles, map_type):
+def map_scene(item):
     """
-    Downloads images corresponding to collected tiles in PNG format and writes them to `./img/`.
+    Reads the scene and map type from the `mapId` of a Kraken response. The `mapId` is a JWT whose payload carries both;
+    if it cannot be decoded, the whole `mapId` is used in place of the scene.
+
+    :param dict item: Item with `mapId` and `tiles` fields; response of Kraken API.
+    :return tuple: `(scene, map_type)`, `map_type` may be `None`.
+    """
+
+    claims = auth.jwt_claims(item["mapId"])
+    if "mapId" not in claims:
+        return item["mapId"], None
+    return claims["mapId"], claims.get("mapType")
+
+
+def map_expired(item):
+    """
+    :param dict item: Item with `mapId` and `tiles` fields; response of Kraken API.
+    :return bool: Whether the `exp` claim of the `mapId` JWT has passed, i.e. its tiles can no longer be downloaded.
+    """
+
+    exp = auth.token_expiry(item["mapId"])
+    return exp is not None and exp <= time.time()
+
+
+def tile_key(item, tile, artifact):
+    """
+    Returns the tile cache key of an artifact of `tile`. The key consists of the scene and map type of `item`, the
+    `geometryId` and `version` claims of its `mapId` - Kraken clips the content of a tile to the requested geometry, so
+    the same tile of a scene differs between extents - the tile coordinates and `artifact`. Unlike the `mapId` itself,
+    the key stays valid after the `mapId` expires.
+
+    :param dict item: Item with `mapId` and `tiles` fields; response of Kraken API.
+    :param list tile: Tile coordinates `[z, x, y]`.
+    :param str artifact: File name of the artifact, e.g. `"cars.png"` or `"detections.geojson"`.
+    :return str: Cache key of the artifact.
+    """
+
+    claims = auth.jwt_claims(item["mapId"])
+    return cache.TileCache.key(*(map_scene(item) + (claims.get("geometryId"), claims.get("version")) + tuple(tile) +
+                                 (artifact,)))
+
+
+def fetch_tile(item, tile, artifact):
+    """
+    Returns the content of an artifact of `tile`, reading it through the tile cache (see `tile_key`).
+
+    :param dict item: Item with `mapId` and `tiles` fields; response of Kraken API.
+    :param list tile: Tile coordinates `[z, x, y]`.
+    :param str artifact: File name of the artifact, e.g. `"cars.png"` or `"detections.geojson"`.
+    :return bytes: Content of the artifact.
+
+    :raises requests.RequestException: Raised if the download fails.
+    """
+
+    tile_cache = cache.TileCache.default()
+    key = tile_key(item, tile, artifact)
+
+    data = tile_cache.get(key)
+    if data is not None:
+        return data
+
+    response = transport.default().get(tile_url(item, tile, artifact))
+    if response.status_code != 200:
+        raise requests.RequestException("Failed to download {}: \n{} \n{}".format(
+            artifact, response.status_code, response.content[:1000]))
+
+    tile_cache.put(key, response.content)
+    return response.content
+
+
+def read_tile(item, tile, artifact):
+    """
+    Returns the content of an artifact of `tile` for parsing on the fly. A cached artifact is returned whole, otherwise
+    the response body is streamed - the returned iterator yields it chunk by chunk as it arrives and stores it in the
+    tile cache (see `tile_key`) once it has been read to the end, so the artifact is never held in memory at once.
+
+    :param dict item: Item with `mapId` and `tiles` fields; response of Kraken API.
+    :param list tile: Tile coordinates `[z, x, y]`.
+    :param str artifact: File name of the artifact, e.g. `"detections.geojson"`.
+    :return: Content of the artifact, `bytes` if cached, an iterator of `bytes` chunks otherwise.
+
+    :raises requests.RequestException: Raised if the download fails.
+    """
+
+    tile_cache = cache.TileCache.default()
+    key = tile_key(item, tile, artifact)
+
+    data = tile_cache.get(key)
+    if data is not None:
+        return data
+
+    response = transport.default().get(tile_url(item, tile, artifact), stream=True)
+    if response.status_code != 200:
+        response.close()
+        raise requests.RequestException("Failed to download {}: \n{} \n{}".format(
+            artifact, response.status_code, response.content[:1000]))
+
+    return _stream_to_cache(response, tile_cache, key)
+
+
+def _stream_to_cache(response, tile_cache, key):
+    http = transport.default()
+    os.makedirs(config.TEMP_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=config.TEMP_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in response.iter_content(cache.CHUNK_SIZE):
+                f.write(chunk)
+                http.count("bytes", len(chunk))
+                yield chunk
+        tile_cache.put_file(key, tmp_path)
+    finally:
+        response.close()
+        os.remove(tmp_path)
+
+
+@instrument.timed("download")
+def fetch_images(tiles, map_type, workers=None, start=0, artifact=None):
+    """
+    Downloads images corresponding to collected tiles in PNG format into memory, up to `workers` tiles at once.
 
     :param list tiles: Response object containing a list of items with `mapId` and `tiles` fields;
     response of Kraken API.
-    :param str map_type: Type of the desired map, e.g. 'cars', 'aircraft', 'cows', etc.
+    :param str map_type: Type of the desired map, e.g. 'cars', 'aircraft', 'truecolor', etc.
+    :param int workers: Number of concurrent downloads (default: `config.DOWNLOAD_WORKERS`).
+    :param int start: Scene number `i` of the first item of `tiles`.
+    :param str artifact: Artifact to download instead of the image, e.g. `"detections.geojson"`.
+    :return tuple: Dict mapping `(i, z, x, y)` keys to PNG content, and a list of `(i, tile)` tuples of the tiles
+    which failed to download.
+    """
+
+    workers = config.DOWNLOAD_WORKERS if not workers else workers
+    artifact = map_type + ".png" if not artifact else artifact
+
+    jobs = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, item in enumerate(tiles, start):
+            for tile in item["tiles"]:
+                jobs[executor.submit(fetch_tile, item, tile, artifact)] = (i, tile)
+
+    images, failed = {}, []
+    for future, (i, tile) in jobs.items():
+        try:
+            images[(i,) + tuple(tile)] = future.result()
+        except (requests.RequestException, OSError) as e:
+            print("Warning: failed to download {} tile {} of scene {}: {}".format(map_type, tile, i, e))
+            failed.append((i, tile))
+
+    return images, failed
+
+
+def fetch_map_images(item, map_type, start=0, artifact=None):
+    """
+    Downloads the overlay images of one scene, or its `detections.geojson` files in local overlay mode, see
+    `fetch_images`. A missing overlay image only leaves a hole in the blended output, but a missing detections file
+    would undercount the scene, so the scene fails instead.
+
+    :param dict item: Item with `mapId` and `tiles` fields; response of Kraken API.
+    :param str map_type: Type of the desired map, e.g. 'cars', 'aircraft', etc.
+    :param int start: Scene number `i` of the item.
+    :param str artifact: Artifact to download instead of the image, e.g. `"detections.geojson"`.
+    :return dict: Maps `(i, z, x, y)` keys to the downloaded content.
+
+    :raises requests.RequestException: Raised if a detections file fails to download.
+    """
+
+    images, failed = fetch_images([item], map_type, start=start, artifact=artifact)
+    if failed and artifact == "detections.geojson":
+        raise requests.RequestException("Failed to download detections of {} tiles of scene {}: {}".format(
+            map_type, start, [tile for _, tile in failed]))
+    return images
+
+
+def _blend_pair(fg, bg, out_path):
+    fg = Image.open(io.BytesIO(fg) if isinstance(fg, bytes) else fg)
+    bg = Image.open(io.BytesIO(bg) if isinstance(bg, bytes) else bg)
+    bg.paste(fg, (0, 0), fg)
+    bg.save(out_path)
+
+
+@instrument.timed("blend")
+def blend_tiles(fg_images, bg_images, path, processes=None, executor=None, prefix="blend"):
+    """
+    Pairs foreground and background images with the same key, lays them over each other in a process pool and writes
+    the results to `path` as `{prefix}_{i}_{z}_{x}_{y}.png`.
+
+    :param dict fg_images: Maps `(i, z, x, y)` keys to foreground PNG content or file paths.
+    :param dict bg_images: Maps `(i, z, x, y)` keys to background PNG content or file paths.
+    :param str path: Directory to write blended images to.
+    :param int processes: Number of worker processes (default: `config.BLEND_PROCESSES`).
+    :param concurrent.futures.Executor executor: Optional pool to reuse instead of starting a new one.
+    :param str prefix: File name prefix of the blended images, e.g. `"blend_cars"`.
+    :return list: Keys of foreground images with no matching background image, or whose blending failed.
+    """
+
+    processes = config.BLEND_PROCESSES if not processes else processes
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+
+    unmatched = [key for key in fg_images if key not in bg_images]
+    jobs = {}
+    try:
+        for key, fg in fg_images.items():
+            if key in bg_images:
+                out_path = os.path.join(path, prefix + "_" + "_".join(str(k) for k in key) + ".png")
+                jobs[executor.submit(_blend_pair, fg, bg_images[key], out_path)] = key
+
+        for future, key in jobs.items():
+            try:
+                future.result()
+            except (OSError, ValueError) as e:
+                print("Warning: failed to blend tile {}: {}".format(key, e))
+                unmatched.append(key)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    if unmatched:
+        print("Warning: {} tiles have not been matched: {}".format(len(unmatched), sorted(unmatched)))
+
+    return unmatched
+
+
+@instrument.timed("blend")
+def render_tiles(gjsons, bg_images, map_type, path, processes=None, executor=None, prefix="blend"):
+    """
+    Draws the detections of each tile over its background image in a process pool (see `overlay.render_tile`) and
+    writes the results to `path` as `{prefix}_{i}_{z}_{x}_{y}.png`. This replaces downloading the overlay images and
+    `blend_tiles` when `config.OVERLAY_MODE` is `"local"`; the detections are collected in the same pass.
+
+    :param dict gjsons: Maps `(i, z, x, y)` keys to the content of `detections.geojson` files.
+    :param dict bg_images: Maps `(i, z, x, y)` keys to background PNG content.
+    :param str map_type: Class of the detections to draw, e.g. `"cars"`.
+    :param str path: Directory to write the images to.
+    :param int processes: Number of worker processes (default: `config.BLEND_PROCESSES`).
+    :param concurrent.futures.Executor executor: Optional pool to reuse instead of starting a new one.
+    :param str prefix: File name prefix of the images, e.g. `"blend_cars"`.
+    :return tuple: Detections of all tiles, array of `store.DETECTION_DTYPE`, and keys of detections with no matching
+    background image, or whose rendering failed - these are counted but not drawn.
+
+    :raises exceptions.FieldNotFoundException: Raised if unable to parse a geojson.
+    """
+
+    processes = config.BLEND_PROCESSES if not processes else processes
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+
+    color = config.OVERLAY_COLORS.get(map_type, config.OVERLAY_DEFAULT_COLOR)
+    unmatched = [key for key in gjsons if key not in bg_images]
+    rows = []
+    jobs = {}
+    try:
+        for key, gjson in gjsons.items():
+            if key in bg_images:
+                out_path = os.path.join(path, prefix + "_" + "_".join(str(k) for k in key) + ".png")
+                jobs[executor.submit(overlay.render_tile, bg_images[key], gjson, list(key[1:]), map_type, color,
+                                     out_path, config.OVERLAY_SHADE_ORIENTATION)] = key
+
+        for future, key in jobs.items():
+            try:
+                rows.extend(future.result())
+            except (OSError, ValueError) as e:
+                print("Warning: failed to render tile {}: {}".format(key, e))
+                unmatched.append(key)
+    finally:
+        if own_executor:
+            executor.shutdown()
 
-    :raises requests.RequestException: Raised if image download fails.
+    if unmatched:
+        print("Warning: {} tiles have not been matched: {}".format(len(unmatched), sorted(unmatched)))
+        # Detections do not depend on the background, tiles which could not be drawn are still counted
+        for key in unmatched:
+            rows.extend(tile_detections(gjsons[key], list(key[1:]), [map_type]))
+
+    return np.array(rows, dtype=store.DETECTION_DTYPE), unmatched
+
+
+@instrument.timed("mosaic")
+def stitch_scene(keys, path, prefix, label):
     """
+    Assembles the blended tiles of one scene in `path` into a mosaic `mosaics/{prefix}_{label}.png` and into a tile
+    pyramid `tiles/{prefix}/{label}/{z}/{x}/{y}.png` down to `config.PYRAMID_MIN_ZOOM`, both in `path`.
 
-    base_url = config.KRAK_PATH + "/kraken/grid"
-    for i, item in enumerate(tiles):
-        for tile in item["tiles"]:
-            url = "/".join((base_url, item["mapId"], "-", str(tile[0]), str(tile[1]), str(tile[2]), map_type + ".png"))
-            png = requests.get(url)
-            if png.status_code != 200:
-                raise requests.RequestException("Failed to download image: \n{} \n{}".format(
-                    png.status_code, json.dumps(png.json(), indent=2)))
-            image_path = "./img/" + "_".join((map_type, str(i), str(tile[0]), str(tile[1]), str(tile[2]))) + ".png"
-            with open(image_path, "wb") as f:
-                f.write(png.content)
+    :param iterable keys: `(i, z, x, y)` keys of the tiles of the scene.
+    :param str path: Directory of the blended tiles.
+    :param str prefix: File name prefix of the blended tiles, e.g. `"blend_cars"`.
+    :param str label: Name of the scene in the output, e.g. its datetime.
+    """
 
+    tiles = {}
+    for key in keys:
+        file_path = os.path.join(path, prefix + "_" + "_".join(str(k) for k in key) + ".png")
+        if os.path.isfile(file_path):
+            tiles[tuple(key[1:])] = file_path
+    if not tiles:
+        return
+
+    zoom = max(z for z, _, _ in tiles)
+    os.makedirs(os.path.join(path, "mosaics"), exist_ok=True)
+    mosaic.write_mosaic({(x, y): file_path for (z, x, y), file_path in tiles.items() if z == zoom},
+                        os.path.join(path, "mosaics", prefix + "_" + label + ".png"))
+    mosaic.build_pyramid(tiles, os.path.join(path, "tiles", prefix, label), config.PYRAMID_MIN_ZOOM)
 
+
+def scene_label(scene_datetime):
+    """
+    :param str scene_datetime: Datetime of a scene in form `"%Y-%m-%d %H:%M:%S"`.
+    :return str: Datetime usable in a file name, e.g. `"20180519T235411"`.
+    """
+
+    return scene_datetime.replace("-", "").replace(":", "").replace(" ", "T")
+
+
+@instrument.timed("blend")
 def blend_images(path, map_type_fg, map_type_bg):
     """
     Maps background and foreground images of the same size in `path` into pairs based on their (identifying uniquely
@@ -223,117 +702,771 @@ def blend_images(path, map_type_fg, map_type_bg):
     :param str path: Path to search images in.
     :param str map_type_fg: Map type of the foreground image.
     :param str map_type_bg: Map type of the background image.
+    :return list: Keys of foreground images which have not been blended.
     """
 
-    fg_files = set(f for f in os.listdir(path) if f.startswith(map_type_fg))
-    bg_files = set(f for f in os.listdir(path) if f.startswith(map_type_bg))
-
-    num_blended = 0
-    for fg_file in fg_files:
-        for bg_file in bg_files:
-            fg_id = "_".join(fg_file.split("_")[1:])
-            bg_id = "_".join(bg_file.split("_")[1:])
-            if fg_id == bg_id:
-                fg_path = os.path.join(path, fg_file)
-                bg_path = os.path.join(path, bg_file)
-                fg = Image.open(fg_path)
-                bg = Image.open(bg_path)
-                bg.paste(fg, (0, 0), fg)
-                bg.save(os.path.join(path, "blend_" + fg_id))
-                # bg.show()
-                num_blended += 1
-
-    if num_blended < len(fg_files):
-        print("Warning: {} tiles have not been matched!".format(len(fg_files)-num_blended))
-
-    for file in set.union(fg_files, bg_files):
-        file_path = os.path.join(path, file)
+    fg_files, bg_files = {}, {}
+    for f in os.listdir(path):
+        map_type, _, image_id = f.rpartition(".")[0].partition("_")
+        if map_type == map_type_fg:
+            fg_files[tuple(image_id.split("_"))] = os.path.join(path, f)
+        elif map_type == map_type_bg:
+            bg_files[tuple(image_id.split("_"))] = os.path.join(path, f)
+
+    unmatched = blend_tiles(fg_files, bg_files, path, prefix="blend_" + map_type_fg)
+
+    for file_path in itertools.chain(fg_files.values(), bg_files.values()):
         if os.path.isfile(file_path):
             os.remove(file_path)
 
+    return unmatched
+
+
+@instrument.timed("count")
+def tile_detections(gjson, tile, classes):
+    """
+    :param gjson: Content of the `detections.geojson` file of `tile`, `bytes` or an iterable of `bytes` chunks (see
+    `read_tile`).
+    :param list tile: Tile coordinates `[z, x, y]`.
+    :param list classes: Class names of the detected features, e.g. `["cars"]`.
+    :return list: Detections of the tile as tuples of the fields of `store.DETECTION_DTYPE`.
+
+    :raises exceptions.FieldNotFoundException: Raised if unable to parse the geojson.
+    """
+
+    return [(tile[0], tile[1], tile[2], detection.centroid[0], detection.centroid[1], detection.area or 0.0,
+             detection.orientation or 0.0, detection.count, detection.cls) + detections.bounds(detection.coordinates)
+            for detection in detections.iter_detections(gjson, classes, centroids=True, geometries=True)]
+
 
-def count_detections(tiles, map_type):
+def scene_detections(item, classes, extent=None):
+    """
+    Collects detections of `classes` in the tiles of one scene together with their tile coordinates, centroid, area,
+    orientation and count.
+
+    If `extent` is given, only detections with the centroid inside `extent` are kept, and detections of the same object
+    in neighbouring tiles are kept once (see `spatial.filter_detections`).
+
+    :param dict item: Item with `mapId` and `tiles` fields; response of Kraken API.
+    :param list classes: Class names of the detected features, e.g. `["cars"]`.
+    :param list extent: Optional extent coordinates in form `[[[,], [,], ... , [,]]]`.
+    :return numpy.ndarray: Detections, array of `store.DETECTION_DTYPE`.
+
+    :raises requests.RequestException: Raised if the communication with the endpoint is unsuccessful.
+    :raises exceptions.FieldNotFoundException: Raised if unable to parse the received geojson.
+    """
+
+    rows = []
+    for tile in item["tiles"]:
+        rows.extend(tile_detections(read_tile(item, tile, "detections.geojson"), tile, classes))
+
+    found = np.array(rows, dtype=store.DETECTION_DTYPE)
+    return found if extent is None else clip_detections(found, extent)
+
+
+def clip_detections(found, extent):
+    """
+    Keeps detections of one scene with the centroid inside `extent`, and only one of the pieces of the same object in
+    neighbouring tiles (see `spatial.filter_detections`).
+
+    :param numpy.ndarray found: Detections, array of `store.DETECTION_DTYPE`.
+    :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
+    :return numpy.ndarray: The selected detections.
+    """
+
+    _, groups = np.unique(np.column_stack((found["z"], found["x"], found["y"])), axis=0, return_inverse=True)
+    boxes = np.column_stack((found["west"], found["south"], found["east"], found["north"]))
+    return found[spatial.filter_detections(np.column_stack((found["lon"], found["lat"])), groups, extent,
+                                           boxes=boxes)]
+
+
+@instrument.timed("count")
+def count_classes(tiles, classes, extent=None):
+    """
+    Counts detections of each of `classes` in `tiles` in a single pass over their detections.
+
+    If `extent` is given, only detections with the centroid inside `extent` are counted, and detections of the same
+    object in neighbouring tiles of a scene are counted once (see `scene_detections`).
+
+    :param list tiles: Response object containing a list of items with `mapId` and `tiles` fields; response of Kraken
+    API.
+    :param list classes: Class names of the detected features, e.g. `["cars", "aircraft"]`.
+    :param list extent: Optional extent coordinates in form `[[[,], [,], ... , [,]]]`.
+    :return dict: Maps each of `classes` to its number of detections in `tiles`.
+
+    :raises requests.RequestException: Raised if the communication with the endpoint is unsuccessful.
+    :raises exceptions.FieldNotFoundException: Raised if unable to parse the received geojson.
+    """
+
+    counts = dict.fromkeys(classes, 0)
+    for item in tiles:
+        if extent is None:
+            for tile in item["tiles"]:
+                for cls, count in detections.tally(read_tile(item, tile, "detections.geojson"), classes).items():
+                    counts[cls] += count
+            continue
+
+        found = scene_detections(item, classes, extent)
+        for cls in classes:
+            counts[cls] += int(found["count"][found["cls"] == cls].sum())
+
+    return counts
+
+
+@instrument.timed("count")
+def count_detections(tiles, map_type, extent=None):
     """
     Counts detections of class `map_type` in `tiles`.
 
     :param list tiles: Response object containing a list of items with `mapId` and `tiles` fields; response of Kraken
     API.
     :param str map_type: Class name of the detected feature (corresponds to map type).
+    :param list extent: Optional extent coordinates to clip detections to, see `count_classes`.
     :return int: Number of detections in `tiles`.
 
     :raises requests.RequestException: Raised if the communication with the endpoint is unsuccessful.
     :raises exceptions.FieldNotFoundException: Raised if unable to parse the received geojson.
     """
 
-    base_url = config.KRAK_PATH + "/kraken/grid"
-    detections = 0
-    for i, item in enumerate(tiles):
-        for tile in item["tiles"]:
-            url = "/".join((base_url, item["mapId"], "-", str(tile[0]), str(tile[1]), str(tile[2]),
-                            "detections.geojson"))
-            gjson = requests.get(url)
-            if gjson.status_code != 200:
-                raise requests.RequestException("Failed to get {} detections: \n{} \n{}".format(
-                    map_type, gjson.status_code, json.dumps(gjson.json(), indent=2)))
+    return count_classes(tiles, [map_type], extent)[map_type]
+
 
-            gjson = gjson.json()
+def start_stage(func, inbox, outbox, errors):
+    """
+    Starts a pipeline stage - a thread applying `func` to every job taken from `inbox` and putting the results to
+    `outbox`. The end of the input is marked by `None`, which the stage passes on to `outbox` before it exits. If `func`
+    raises, the exception is appended to `errors` and the rest of the input is drained, so that upstream stages blocked
+    on a full queue are released.
+
+    :param callable func: Function applied to every job.
+    :param queue.Queue inbox: Queue to take jobs from.
+    :param queue.Queue outbox: Queue to put results to, or `None` for the last stage.
+    :param list errors: List collecting exceptions raised by the stages.
+    :return threading.Thread: The started thread.
+    """
+
+    def work():
+        try:
+            for job in iter(inbox.get, None):
+                if errors:
+                    continue
+                result = func(job)
+                if outbox is not None:
+                    outbox.put(result)
+        except BaseException as e:
+            errors.append(e)
+            for _ in iter(inbox.get, None):
+                pass
+        finally:
+            if outbox is not None:
+                outbox.put(None)
+
+    thread = threading.Thread(target=work, daemon=True)
+    thread.start()
+    return thread
+
+
+def unique_map_types(map_types):
+    """
+    :param map_types: Type of the desired map, or a list of them, e.g. `["cars", "aircraft"]`.
+    :return list: The map types without repetitions, in their original order - every map type is collected once per
+    scene, so a repeated one would never be complete.
+    """
 
-            if "features" not in gjson.keys():
-                raise exceptions.FieldNotFoundException("Got invalid {} detections.geojson file - "
-                                                        "missing features field: \n{}".format(map_type,
-                                                                                              json.dumps(gjson,
-                                                                                                         indent=2)))
-            for feature in gjson["features"]:
-                if feature["properties"]["class"] == map_type:
-                    detections += feature["properties"]["count"]
+    return list(collections.OrderedDict.fromkeys([map_types] if isinstance(map_types, str) else map_types))
 
-    return detections
 
+def run(map_types, input_file, resume=False):
 
-def run(map_type, input_file):
+    map_types = unique_map_types(map_types)
 
     print("Reading input file...")
     extent = read_extent(input_file)
 
-    auth_response = get_response(config.AUTH)
+    run_journal = journal.Journal.for_run(extent, map_types, resume)
+
+    auth_token = auth.TokenProvider(lambda: get_response(config.AUTH)["id_token"])
+
+    if run_journal.scene_ids is not None:
+        scene_ids = run_journal.scene_ids
+        print("Resuming run from {}".format(run_journal.path))
+    else:
+        print("Getting scenes...")
+        scene_ids = get_scenes(extent, auth_token)
+        run_journal.record("search", scene_ids=scene_ids)
+
+    if len(scene_ids) > 0:
+        print("Number of eligible scenes found: {}".format(len(scene_ids)))
+    else:
+        print("No eligible scenes found.")
+        return
+
+    index = scene_index.SceneIndex.for_extent(extent)
+    detection_stores = {map_type: store.DetectionStore.for_map_type(map_type, extent) for map_type in map_types}
+    scene_numbers = {scene_id: i for i, scene_id in enumerate(scene_ids)}
+    # Imagery is shared by all map types of a scene
+    collected_types = map_types + ["imagery"]
+
+    # Every scene flows through kraken -> download -> blend -> count on its own, stages are connected by bounded
+    # queues so that a slow stage holds back the ones before it instead of piling up tiles in memory
+    to_download, to_blend, to_count = (queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE) for _ in range(3))
+    errors = []
+    totals = {"detections": dict.fromkeys(map_types, 0), "scenes": 0}
+
+    def report(scene_id, counts, note=""):
+        for map_type in map_types:
+            totals["detections"][map_type] += counts[map_type]
+        totals["scenes"] += 1
+        print("Scene {}/{} ({}): {}{}".format(
+            totals["scenes"], len(scene_ids), index.scenes[scene_id]["datetime"],
+            ", ".join("{} detections of class \'{}\'".format(counts[map_type], map_type) for map_type in map_types),
+            note))
+
+    # In local overlay mode detections are downloaded instead of the overlay images, drawn over the imagery and
+    # counted in one pass
+    local_overlay = config.OVERLAY_MODE == "local"
+    artifact = "detections.geojson" if local_overlay else None
+
+    def download(job):
+        i, scene_id, items = job
+        imag_images, _ = fetch_images([items["imagery"]], "truecolor", start=i)
+        map_images = {map_type: fetch_map_images(items[map_type], map_type, start=i, artifact=artifact)
+                      for map_type in map_types}
+        run_journal.record("downloaded", scene_id=scene_id)
+        return i, scene_id, items, map_images, imag_images
+
+    def blend(job):
+        i, scene_id, items, map_images, imag_images = job
+        rendered = None
+        if local_overlay:
+            rendered = {map_type: render_tiles(map_images[map_type], imag_images, map_type, config.IMG_DIR,
+                                               executor=blend_executor, prefix="blend_" + map_type)[0]
+                        for map_type in map_types}
+        else:
+            for map_type in map_types:
+                blend_tiles(map_images[map_type], imag_images, config.IMG_DIR, executor=blend_executor,
+                            prefix="blend_" + map_type)
+        if config.MOSAIC:
+            for map_type in map_types:
+                stitch_scene(map_images[map_type].keys(), config.IMG_DIR, "blend_" + map_type,
+                             scene_label(index.scenes[scene_id]["datetime"]))
+        run_journal.record("blended", scene_id=scene_id)
+        return i, scene_id, items, rendered
+
+    def count(job):
+        i, scene_id, items, rendered = job
+        counts = {}
+        for map_type in map_types:
+            if rendered is None:
+                found = scene_detections(items[map_type], [map_type], extent)
+            else:
+                found = clip_detections(rendered[map_type], extent)
+            detection_stores[map_type].append(scene_id, index.scenes[scene_id]["datetime"], found)
+            counts[map_type] = int(found["count"].sum())
+            run_journal.record("counted", scene_id=scene_id, map_type=map_type, count=counts[map_type])
+        report(scene_id, counts)
+
+    # Pipeline results are reused on resume as long as their tiles can still be downloaded - either the mapId has not
+    # expired yet, or the tiles are already in the tile cache
+    collected = {}
+    for (scene_id, collected_type), response in run_journal.retrieved.items():
+        if scene_id in scene_numbers and collected_type in collected_types and \
+                (scene_id in run_journal.downloaded or not map_expired(response)):
+            collected.setdefault(scene_id, {})[collected_type] = response
+    in_flight = {key: pipeline_id for key, pipeline_id in run_journal.initiated.items()
+                 if key not in run_journal.retrieved}
+
+    print("Processing {} and imagery tiles...".format(", ".join(map_types)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=config.BLEND_PROCESSES) as blend_executor:
+        stages = [start_stage(download, to_download, to_blend, errors),
+                  start_stage(blend, to_blend, to_count, errors),
+                  start_stage(count, to_count, None, errors)]
+
+        try:
+            remaining = []
+            for scene_id in scene_ids:
+                items = collected.get(scene_id, {})
+                if all((scene_id, map_type) in run_journal.counted for map_type in map_types):
+                    report(scene_id, {map_type: run_journal.counted[(scene_id, map_type)] for map_type in map_types},
+                           " (resumed)")
+                elif scene_id in run_journal.blended and all(map_type in items for map_type in map_types):
+                    to_count.put((scene_numbers[scene_id], scene_id, items, None))
+                elif len(items) == len(collected_types):
+                    to_download.put((scene_numbers[scene_id], scene_id, items))
+                else:
+                    remaining.append(scene_id)
+
+            exclude = set((scene_id, collected_type) for scene_id in remaining
+                          for collected_type in collected.get(scene_id, {}))
+
+            def on_initiate(scene_id, collected_type, pipeline_id):
+                run_journal.record("initiated", scene_id=scene_id, map_type=collected_type, pipeline_id=pipeline_id)
+
+            for scene_id, collected_type, response in instrument.timed_iter("kraken", collect_all_tiles(
+                    extent, auth_token, remaining, collected_types, exclude=exclude, pipeline_ids=in_flight,
+                    on_initiate=on_initiate)):
+                if errors:
+                    break
+                run_journal.record("retrieved", scene_id=scene_id, map_type=collected_type, response=response)
+                collected.setdefault(scene_id, {})[collected_type] = response
+                if len(collected[scene_id]) == len(collected_types):
+                    to_download.put((scene_numbers[scene_id], scene_id, collected.pop(scene_id)))
+        finally:
+            to_download.put(None)
+            for stage in stages:
+                stage.join()
+            run_journal.close()
+
+    if errors:
+        raise errors[0]
+
+    print("Images can be found in {}".format(config.IMG_DIR))
+
+    for map_type in map_types:
+        print("Number of detections of class \'{}\' in selected area in the period from {} to {}:\n{}"
+              .format(map_type, config.SEARCH['PAYLOAD']['startDatetime'], config.SEARCH['PAYLOAD']['endDatetime'],
+                      totals["detections"][map_type]))
+        print("Detections of all scenes are stored in {}".format(detection_stores[map_type].root))
+
+
+def _link(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def run_batch(map_types, source):
+    """
+    Runs the analysis for many extents at once. Extents close to each other (see `config.BATCH_MERGE_DISTANCE`) are
+    merged into a group sharing one imagery search over their bounding box and one Kraken pipeline per scene over all
+    of them, so tiles shared by several extents are downloaded, blended and parsed once. Results are then split out per
+    extent: blended images go to a directory of each extent in `config.IMG_DIR` and detections clipped to each extent
+    go to a detection store of its own.
+
+    :param list map_types: Types of the desired maps, e.g. `["cars", "aircraft"]`.
+    :param str source: Directory of input files or JSONL manifest, see `read_extents`.
+    """
+
+    map_types = unique_map_types(map_types)
+    collected_types = map_types + ["imagery"]
+
+    print("Reading input files...")
+    extents = read_extents(source)
+    names = list(extents.keys())
+
+    auth_token = auth.TokenProvider(lambda: get_response(config.AUTH)["id_token"])
+    start = config.SEARCH["PAYLOAD"]["startDatetime"]
+    end = config.SEARCH["PAYLOAD"]["endDatetime"]
+
+    local_overlay = config.OVERLAY_MODE == "local"
+    artifact = "detections.geojson" if local_overlay else None
+
+    totals = {(map_type, name): 0 for map_type in map_types for name in names}
+    stores = {(map_type, name): store.DetectionStore.for_map_type(map_type, extent)
+              for map_type in map_types for name, extent in extents.items()}
+    boxes = {name: spatial.bounds(extent) for name, extent in extents.items()}
+    for name in names:
+        os.makedirs(os.path.join(config.IMG_DIR, name), exist_ok=True)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=config.BLEND_PROCESSES) as blend_executor:
+        for group in spatial.cluster_extents(list(extents.values()), config.BATCH_MERGE_DISTANCE):
+            group = [names[k] for k in group]
+            search_extent = extents[group[0]] if len(group) == 1 else \
+                spatial.bounding_polygon([extents[name] for name in group])
+
+            print("Getting scenes for {}...".format(", ".join(group)))
+            get_scenes(search_extent, auth_token)
+            index = scene_index.SceneIndex.for_extent(search_extent)
+
+            # Every extent gets its own best scenes, a scene shared by several extents is processed once for all
+            scene_extents = collections.OrderedDict()
+            for name in group:
+                for scene in selection.select_scenes(index.eligible(start, end, extent=extents[name]), extents[name]):
+                    scene_extents.setdefault(scene["sceneId"], []).append(name)
+            scene_ids = sorted(scene_extents, key=lambda scene_id: index.scenes[scene_id]["datetime"], reverse=True)
+            scene_numbers = {scene_id: i for i, scene_id in enumerate(scene_ids)}
+            print("Number of eligible scenes found: {}".format(len(scene_ids)))
+
+            to_download, to_blend, to_count = (queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE) for _ in range(3))
+            errors = []
+
+            def download(job):
+                i, scene_id, items = job
+                # Only tiles overlapping an extent of the scene are used, each of them once
+                tiles_of = {name: [tile for tile in items["imagery"]["tiles"]
+                                   if spatial.bounds_intersect(spatial.tile_bounds(*tile), boxes[name])]
+                            for name in scene_extents[scene_id]}
+                needed = [tile for tile in items["imagery"]["tiles"]
+                          if any(tile in tiles for tiles in tiles_of.values())]
+                items = {collected_type: dict(item, tiles=[tile for tile in item["tiles"] if tile in needed])
+                         for collected_type, item in items.items()}
+                imag_images, _ = fetch_images([items["imagery"]], "truecolor", start=i)
+                map_images = {map_type: fetch_map_images(items[map_type], map_type, start=i, artifact=artifact)
+                              for map_type in map_types}
+                return i, scene_id, items, tiles_of, map_images, imag_images
+
+            def blend(job):
+                i, scene_id, items, tiles_of, map_images, imag_images = job
+                owners = collections.OrderedDict()
+                for name, tiles in tiles_of.items():
+                    for tile in tiles:
+                        owners.setdefault((i,) + tuple(tile), []).append(name)
+                rendered = {map_type: [] for map_type in map_types} if local_overlay else None
+                for map_type in map_types:
+                    prefix = "blend_" + map_type
+                    for name in tiles_of:
+                        owned = {key: map_images[map_type][key] for key, owner in owners.items()
+                                 if owner[0] == name and key in map_images[map_type]}
+                        if local_overlay:
+                            rendered[map_type].append(render_tiles(owned, imag_images, map_type,
+                                                                   os.path.join(config.IMG_DIR, name),
+                                                                   executor=blend_executor, prefix=prefix)[0])
+                        else:
+                            blend_tiles(owned, imag_images, os.path.join(config.IMG_DIR, name),
+                                        executor=blend_executor, prefix=prefix)
+                    for key, owner in owners.items():
+                        file_name = prefix + "_" + "_".join(str(k) for k in key) + ".png"
+                        src = os.path.join(config.IMG_DIR, owner[0], file_name)
+                        if os.path.isfile(src):
+                            for name in owner[1:]:
+                                _link(src, os.path.join(config.IMG_DIR, name, file_name))
+                    if config.MOSAIC:
+                        for name, tiles in tiles_of.items():
+                            stitch_scene([(i,) + tuple(tile) for tile in tiles], os.path.join(config.IMG_DIR, name),
+                                         prefix, scene_label(index.scenes[scene_id]["datetime"]))
+                return scene_id, items, tiles_of, rendered
+
+            def count(job):
+                scene_id, items, tiles_of, rendered = job
+                scene_datetime = index.scenes[scene_id]["datetime"]
+                for map_type in map_types:
+                    if rendered is None:
+                        found = scene_detections(items[map_type], [map_type])
+                    else:
+                        found = np.concatenate(rendered[map_type])
+                    for name in tiles_of:
+                        clipped = clip_detections(found, extents[name])
+                        stores[(map_type, name)].append(scene_id, scene_datetime, clipped)
+                        totals[(map_type, name)] += int(clipped["count"].sum())
+                        print("{} ({}): {} detections of class \'{}\'".format(name, scene_datetime,
+                                                                            int(clipped["count"].sum()), map_type))
+
+            stages = [start_stage(download, to_download, to_blend, errors),
+                      start_stage(blend, to_blend, to_count, errors),
+                      start_stage(count, to_count, None, errors)]
+
+            collected = {}
+            try:
+                for scene_id, collected_type, response in instrument.timed_iter("kraken", collect_all_tiles(
+                        [polygon for name in group for polygon in spatial.multipolygon(extents[name])], auth_token,
+                        scene_ids, collected_types)):
+                    if errors:
+                        break
+                    collected.setdefault(scene_id, {})[collected_type] = response
+                    if len(collected[scene_id]) == len(collected_types):
+                        to_download.put((scene_numbers[scene_id], scene_id, collected.pop(scene_id)))
+            finally:
+                to_download.put(None)
+                for stage in stages:
+                    stage.join()
+
+            if errors:
+                raise errors[0]
+
+    print("Images can be found in {}".format(config.IMG_DIR))
+    for map_type in map_types:
+        print("Number of detections of class \'{}\' per extent in the period from {} to {}:".format(map_type, start,
+                                                                                                   end))
+        for name in names:
+            print("{}  {}".format(name, totals[(map_type, name)]))
+
+
+def process_scene(extent, auth_token, scene_id, scene_datetime, map_types, number, executor=None, overlay_mode=None,
+                  stitch=None):
+    """
+    Runs the whole pipeline for a single scene - collects its Kraken tiles, downloads them, blends (or, in local overlay
+    mode, renders) the overlays into `config.IMG_DIR` and collects the detections inside `extent`. This is the unit of
+    work of the workers of a distributed run, see `work`.
+
+    :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
+    :param auth_token: JWT authorization token, or a callable returning one.
+    :param str scene_id: Hash identifying the scene.
+    :param str scene_datetime: Datetime of the scene in form `"%Y-%m-%d %H:%M:%S"`.
+    :param list map_types: Types of the desired maps, e.g. `["cars", "aircraft"]`.
+    :param int number: Scene number `i` used in the image file names.
+    :param concurrent.futures.Executor executor: Optional process pool for blending.
+    :param str overlay_mode: `"server"` or `"local"` (default: `config.OVERLAY_MODE`).
+    :param bool stitch: Whether to stitch a mosaic of the scene (default: `config.MOSAIC`).
+    :return dict: Maps each of `map_types` to the detections of the scene, array of `store.DETECTION_DTYPE`.
+
+    :raises exceptions.InitiateException: Raised if pipeline initialization fails.
+    :raises exceptions.FatalException: Raised if pipeline processing times out.
+    :raises requests.RequestException: Raised if the communication with the endpoint is unsuccessful.
+    """
+
+    map_types = unique_map_types(map_types)
+    local_overlay = (config.OVERLAY_MODE if overlay_mode is None else overlay_mode) == "local"
+    stitch = config.MOSAIC if stitch is None else stitch
+    artifact = "detections.geojson" if local_overlay else None
+
+    items = {collected_type: response for _, collected_type, response in instrument.timed_iter(
+        "kraken", collect_all_tiles(extent, auth_token, [scene_id], map_types + ["imagery"]))}
+
+    imag_images, _ = fetch_images([items["imagery"]], "truecolor", start=number)
+    found = {}
+    for map_type in map_types:
+        map_images = fetch_map_images(items[map_type], map_type, start=number, artifact=artifact)
+        prefix = "blend_" + map_type
+        if local_overlay:
+            rendered, _ = render_tiles(map_images, imag_images, map_type, config.IMG_DIR, executor=executor,
+                                       prefix=prefix)
+            found[map_type] = clip_detections(rendered, extent)
+        else:
+            blend_tiles(map_images, imag_images, config.IMG_DIR, executor=executor, prefix=prefix)
+            found[map_type] = scene_detections(items[map_type], [map_type], extent)
+        if stitch:
+            stitch_scene(map_images.keys(), config.IMG_DIR, prefix, scene_label(scene_datetime))
+
+    return found
+
+
+def _renew_lease(work_queue, job_id, worker, stop):
+    while not stop.wait(config.LEASE_SECONDS / 3):
+        if not work_queue.renew(job_id, worker):
+            print("Warning: worker {} lost the lease of job {}".format(worker, job_id))
+            return
+
+
+def work(queue_path, worker=None):
+    """
+    Runs a worker of a distributed run (see `coordinate`). Scene jobs are leased from the work queue at `queue_path` one
+    at a time and processed by `process_scene`; the detections of the scene are stored as the result of the job. The
+    lease is renewed in the background while the job is processed, so only the jobs of workers which died are leased
+    again. A job which fails is given back to the queue.
+
+    The worker exits once no job is pending or leased by other workers.
+
+    :param str queue_path: Work queue database shared with the coordinator.
+    :param str worker: Identifier of the worker (default: host name and process id).
+    :return int: Number of jobs completed by the worker.
+    """
+
+    worker = "{}:{}".format(socket.gethostname(), os.getpid()) if worker is None else worker
+    work_queue = workqueue.WorkQueue(queue_path)
+    auth_token = auth.TokenProvider(lambda: get_response(config.AUTH)["id_token"])
+    completed = 0
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=config.BLEND_PROCESSES) as blend_executor:
+        while True:
+            job = work_queue.lease(worker)
+            if job is None:
+                counts = work_queue.counts()
+                if counts["pending"] == 0 and counts["leased"] == 0:
+                    break
+                time.sleep(config.WORKER_POLL_INTERVAL)
+                continue
+
+            payload = job["payload"]
+            print("Worker {}: processing scene {} ({}), attempt {}".format(worker, job["key"], payload["datetime"],
+                                                                          job["attempts"]))
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=_renew_lease, args=(work_queue, job["id"], worker, stop), daemon=True)
+            heartbeat.start()
+            try:
+                found = process_scene(payload["extent"], auth_token, job["key"], payload["datetime"],
+                                      payload["map_types"], payload["number"], executor=blend_executor,
+                                      overlay_mode=payload["overlay_mode"], stitch=payload["mosaic"])
+            except Exception as e:
+                # Any failure gives the job back, it is retried by this or another worker
+                print("Warning: worker {} failed to process scene {}: {!r}".format(worker, job["key"], e))
+                work_queue.fail(job["id"], worker, repr(e))
+                continue
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            work_queue.complete(job["id"], worker, {map_type: rows.tolist() for map_type, rows in found.items()})
+            completed += 1
+
+    print("Worker {} finished, {} scenes processed".format(worker, completed))
+    return completed
+
+
+def coordinate(map_types, input_file, queue_path, workers=0, wait=True):
+    """
+    Runs the coordinator of a distributed run. Scenes are searched for like in `run`, and every scene is put on the work
+    queue at `queue_path` as one job, which a worker (see `work`) takes through all of Kraken, download, blend and
+    count. Workers run as separate processes, on this host or on others sharing the queue file, so the CPU-bound
+    blending and geojson parsing is not limited by a single interpreter, nor pipeline polling by a single host.
+
+    Detections computed by the workers are merged into the detection stores and the totals as they arrive. Jobs of
+    earlier runs over the same extent, map types and period are kept in the queue, so restarting the coordinator only
+    waits for the unfinished ones.
+
+    :param map_types: Type of the desired map, or a list of them, e.g. `["cars", "aircraft"]`.
+    :param str input_file: Input geojson specifying the extent.
+    :param str queue_path: Work queue database shared with the workers.
+    :param int workers: Number of worker processes to start on this host.
+    :param bool wait: Whether to wait for the jobs and merge their results; otherwise only the jobs are queued.
+    """
 
-    auth_token = auth_response["id_token"]
+    map_types = unique_map_types(map_types)
+
+    print("Reading input file...")
+    extent = read_extent(input_file)
+
+    auth_token = auth.TokenProvider(lambda: get_response(config.AUTH)["id_token"])
 
     print("Getting scenes...")
     scene_ids = get_scenes(extent, auth_token)
-
     if len(scene_ids) > 0:
         print("Number of eligible scenes found: {}".format(len(scene_ids)))
     else:
         print("No eligible scenes found.")
         return
 
-    map_tiles, imag_tiles = [], []
+    index = scene_index.SceneIndex.for_extent(extent)
+    start = config.SEARCH["PAYLOAD"]["startDatetime"]
+    end = config.SEARCH["PAYLOAD"]["endDatetime"]
+    run_id = hashlib.sha256(json.dumps([extent, sorted(map_types), start, end]).encode()).hexdigest()[:16]
+
+    work_queue = workqueue.WorkQueue(queue_path)
+    work_queue.put(run_id, {scene_id: {"extent": extent, "map_types": map_types, "number": i,
+                                       "datetime": index.scenes[scene_id]["datetime"],
+                                       "overlay_mode": config.OVERLAY_MODE, "mosaic": config.MOSAIC}
+                            for i, scene_id in enumerate(scene_ids)})
+    print("Scenes queued as run {} in {}".format(run_id, queue_path))
+    if not wait:
+        return
 
-    for i, scene_id in enumerate(scene_ids):
-        print("Collecting {} tiles... {}/{}".format(map_type, i+1, len(scene_ids)))
-        map_tiles.append(collect_tiles(extent, auth_token, scene_id, map_type))
+    processes = [multiprocessing.Process(target=work, args=(queue_path,)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    if not processes:
+        print("Waiting for workers, start them with `sk_ass.py --worker {}`".format(queue_path))
+
+    detection_stores = {map_type: store.DetectionStore.for_map_type(map_type, extent) for map_type in map_types}
+    totals = dict.fromkeys(map_types, 0)
+    merged = set()
+
+    try:
+        finished = False
+        while not finished:
+            # Jobs finishing after this check are merged in the next pass
+            counts = work_queue.counts(run_id)
+            finished = counts["pending"] == 0 and counts["leased"] == 0
+            for scene_id, result in work_queue.results(run_id, exclude=merged):
+                merged.add(scene_id)
+                scene_datetime = index.scenes[scene_id]["datetime"]
+                scene_counts = {}
+                for map_type in map_types:
+                    found = np.array([tuple(row) for row in result[map_type]], dtype=store.DETECTION_DTYPE)
+                    detection_stores[map_type].append(scene_id, scene_datetime, found)
+                    scene_counts[map_type] = int(found["count"].sum())
+                    totals[map_type] += scene_counts[map_type]
+                print("Scene {}/{} ({}): {}".format(
+                    len(merged), len(scene_ids), scene_datetime,
+                    ", ".join("{} detections of class \'{}\'".format(scene_counts[map_type], map_type)
+                              for map_type in map_types)))
+            if not finished:
+                time.sleep(config.WORKER_POLL_INTERVAL)
+    finally:
+        for process in processes:
+            process.join()
+
+    for scene_id, error in work_queue.errors(run_id):
+        print("Warning: scene {} failed after {} attempts: {}".format(scene_id, config.JOB_MAX_ATTEMPTS, error))
+
+    for map_type in map_types:
+        print("Number of detections of class \'{}\' in selected area in the period from {} to {}:\n{}"
+              .format(map_type, start, end, totals[map_type]))
+        print("Detections of all scenes are stored in {}".format(detection_stores[map_type].root))
+
+
+def profile_run(func, *args, **kwargs):
+    """
+    Calls `func` (e.g. `run`) while recording stage wall times, endpoint latencies and poll counts (see `instrument`)
+    and writes them, together with the transport and tile cache counters of the run, as a JSON report to
+    `config.PROFILE_REPORT`. With `config.PROFILE_STAGES` every stage is also profiled by `cProfile`. The report is
+    written even if `func` fails.
+
+    :param callable func: Function to call.
+    :param args: Positional arguments of `func`.
+    :param kwargs: Keyword arguments of `func`.
+    :return: Return value of `func`.
+    """
 
-        print("Collecting imagery tiles... {}/{}".format(i+1, len(scene_ids)))
-        imag_tiles.append(collect_tiles(extent, auth_token, scene_id, "imagery"))
+    recorder = instrument.reset(config.PROFILE_STAGES)
+    baseline = {"transport": transport.default().stats(), "cache": cache.TileCache.default().stats()}
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        counters = {"transport": transport.default().stats(), "cache": cache.TileCache.default().stats()}
+        # Counters are reported as their increase during the run, only the size of the cache as it is
+        for section, values in counters.items():
+            for name in values:
+                if name != "bytes" or section == "transport":
+                    values[name] -= baseline[section].get(name, 0)
+        lookups = counters["cache"]["hits"] + counters["cache"]["misses"]
+        counters["cache"]["hit_rate"] = counters["cache"]["hits"] / lookups if lookups else None
+        recorder.write(config.PROFILE_REPORT, **counters)
+        print("Profile report written to {}".format(config.PROFILE_REPORT))
+
+
+def print_history(map_type, days, extent):
+    """
+    Prints counts of detections of class `map_type` in `extent` per scene and per day over the last `days` days from
+    the detection store, without any network traffic.
 
-    print("Downloading {} images...".format(map_type))
-    download_images(map_tiles, map_type)
+    :param str map_type: Class name of the detected feature (corresponds to map type).
+    :param int days: Length of the period in days.
+    :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
+    """
+
+    since = (datetime.datetime.today() - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    detection_store = store.DetectionStore.for_map_type(map_type, extent)
 
-    print("Downloading truecolor images...")
-    download_images(imag_tiles, "truecolor")
+    print("Detections of class \'{}\' per scene since {}:".format(map_type, since))
+    for scene_id, scene_datetime, count in detection_store.counts_per_scene(since):
+        print("{}  {}  {}".format(scene_datetime, count, scene_id))
 
-    print("Blending images...")
-    blend_images("./img", "cars", "truecolor")
+    print("Mean detections of class \'{}\' per day:".format(map_type))
+    for day, count in detection_store.counts_per_day(since):
+        print("{}  {:.1f}".format(day, count))
 
-    print("Images can be found in ./img/")
 
-    print("Counting detections...")
-    detections = count_detections(map_tiles, map_type)
+def print_changes(map_type, days, extent):
+    """
+    Prints how many objects of class `map_type` in `extent` arrived, departed and stayed between consecutive scenes over
+    the last `days` days from the detection store (see `changes.delta_series`), without any network traffic, and writes
+    the delta series of the extent and of every tile as JSON to `changes/{digest}/{map_type}.json` in
+    `config.TEMP_DIR`, where `digest` names the store of the extent.
+
+    :param str map_type: Class name of the detected feature (corresponds to map type).
+    :param int days: Length of the period in days.
+    :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
+    """
+
+    since = (datetime.datetime.today() - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    detection_store = store.DetectionStore.for_map_type(map_type, extent)
+    series = changes.delta_series(detection_store, since)
+
+    print("Changes of class \'{}\' between consecutive scenes since {}:".format(map_type, since))
+    for delta in series["extent"]:
+        print("{} -> {}  +{} -{} ={}".format(delta["from"], delta["to"], delta["arrived"], delta["departed"],
+                                            delta["stayed"]))
+    print("{} changed tiles compared, {} unchanged tiles skipped".format(series["compared"], series["skipped"]))
+
+    out_path = os.path.join(config.TEMP_DIR, "changes", os.path.basename(detection_store.root), map_type + ".json")
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump(series, f, indent=2)
+    print("Delta series of the extent and of every tile written to {}".format(out_path))
 
-    print("Number of detections of class \'{}\' in selected area in the period from {} to {}:\n{}"
-          .format(map_type, config.SEARCH['PAYLOAD']['startDatetime'], config.SEARCH['PAYLOAD']['endDatetime'],
-                  detections))
 
 if __name__ == '__main__':
     avail_input_files = [
@@ -344,6 +1477,7 @@ if __name__ == '__main__':
 
     supported_map_types = [
         "cars",
+        "aircraft",
     ]
 
     parser = argparse.ArgumentParser("sk_ass",
@@ -353,8 +1487,10 @@ if __name__ == '__main__':
                         help="input geojson specifying the desired extent"
                              "(default: \'{}\')".format(avail_input_files[0]))
 
-    parser.add_argument("-m", dest="map_type", default=supported_map_types[0], type=str, choices=supported_map_types,
-                        help="class of feature to be detected (default: {})".format(supported_map_types[0]))
+    parser.add_argument("-m", dest="map_types", default=supported_map_types[:1], type=str, nargs="+",
+                        choices=supported_map_types,
+                        help="classes of features to be detected, all in a single pass sharing the scene search and "
+                             "imagery (default: {})".format(supported_map_types[0]))
 
     parser.add_argument("-g", action="store_true", dest="debug",
                         help="turns debugging mode on - debugging messages and traffic are printed out"
@@ -366,12 +1502,81 @@ if __name__ == '__main__':
     parser.add_argument("-s", default=config.GSD_LIMIT, dest="gsd_limit", type=float,
                         help="maximum allowable ground sample distance (GSD) (default: {})".format(config.GSD_LIMIT))
 
+    parser.add_argument("-o", dest="overlay_mode", default=config.OVERLAY_MODE, choices=["server", "local"],
+                        help="how detections are drawn over the imagery - 'server' downloads the overlay images "
+                             "rendered by Kraken, 'local' draws the detection polygons itself and saves half of the "
+                             "downloads (default: {})".format(config.OVERLAY_MODE))
+
+    parser.add_argument("--mosaic", action="store_true", dest="mosaic",
+                        help="also stitch the blended tiles of every scene into a single mosaic image and a z/x/y tile "
+                             "pyramid for a local map viewer (default: off)")
+
+    parser.add_argument("--profile", dest="profile_report",
+                        help="write a JSON report of stage wall times, endpoint latencies, poll counts, downloaded "
+                             "bytes and cache hit rate of the run to the given file")
+
+    parser.add_argument("--cprofile", action="store_true", dest="profile_stages",
+                        help="with --profile, also profile every stage with cProfile; the top functions are included "
+                             "in the report and the raw data is written next to it (default: off)")
+
+    parser.add_argument("--resume", action="store_true", dest="resume",
+                        help="resume the last interrupted run over the same extent and map type from its journal "
+                             "(default: off)")
+
+    parser.add_argument("-b", dest="batch",
+                        help="directory of input geojson files or JSONL manifest of extents to analyze in one batch - "
+                             "shared scenes, pipelines and tiles are processed once for all of them")
+
+    parser.add_argument("--changes", dest="changes_days", type=int,
+                        help="print how many objects in the extent of -f arrived, departed and stayed between "
+                             "consecutive scenes over the given number of past days from the detection store, write "
+                             "the delta series of the extent and of every tile to a JSON file, and exit")
+
+    parser.add_argument("--coordinator", dest="coordinator_queue",
+                        help="run as the coordinator of a distributed run - queue one job per scene in the given "
+                             "SQLite work queue, wait for workers to process them and merge their detections")
+
+    parser.add_argument("--workers", default=0, dest="workers", type=int,
+                        help="with --coordinator, number of worker processes to start on this host (default: 0)")
+
+    parser.add_argument("--worker", dest="worker_queue",
+                        help="run as a worker of a distributed run - process scenes from the given work queue, shared "
+                             "with the coordinator, until no job is left")
+
+    parser.add_argument("-t", dest="history_days", type=int,
+                        help="print detections in the extent of -f per scene and per day over the given number of past "
+                             "days from the detection store and exit, without searching for new imagery")
+
     args = parser.parse_args()
 
     config.DEBUG = args.debug
     config.DAYS_BACK = args.days_back
+    config.SEARCH["PAYLOAD"]["startDatetime"] = (datetime.datetime.today() - datetime.timedelta(
+        days=config.DAYS_BACK)).strftime("%Y-%m-%d %H:%M:%S")
     config.GSD_LIMIT = args.gsd_limit
+    config.OVERLAY_MODE = args.overlay_mode
+    config.MOSAIC = args.mosaic
+    config.PROFILE_REPORT = args.profile_report
+    config.PROFILE_STAGES = args.profile_stages
     assert(0.0 <= config.GSD_LIMIT <= 1.0), "Value of -s parameter must be a float in range [0.0, 1.0]"
 
-    run(args.map_type, args.input_file)
+    if args.history_days is not None:
+        for map_type in args.map_types:
+            print_history(map_type, args.history_days, read_extent(args.input_file))
+    elif args.changes_days is not None:
+        for map_type in args.map_types:
+            print_changes(map_type, args.changes_days, read_extent(args.input_file))
+    elif args.worker_queue is not None:
+        work(args.worker_queue)
+    elif args.coordinator_queue is not None:
+        coordinate(args.map_types, args.input_file, args.coordinator_queue, args.workers)
+    elif args.batch is not None:
+        if args.profile_report:
+            profile_run(run_batch, args.map_types, args.batch)
+        else:
+            run_batch(args.map_types, args.batch)
+    elif args.profile_report:
+        profile_run(run, args.map_types, args.input_file, args.resume)
+    else:
+        run(args.map_types, args.input_file, args.resume)
 
@@ -0,0 +1,319 @@
+import collections
+import itertools
+
+import numpy as np
+
+import config
+
+
+EARTH_RADIUS = 6378137.0
+
+
+def points_in_polygon(points, polygon):
+    """
+    Vectorized even-odd point-in-polygon test.
+
+    :param numpy.ndarray points: Array of shape `(n, 2)` of `(lon, lat)` points.
+    :param list polygon: Polygon coordinates in form `[[[,], [,], ... , [,]], ...]` - exterior ring followed by
+    optional holes.
+    :return numpy.ndarray: Boolean array of shape `(n,)`, `True` for points inside the polygon.
+    """
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    px, py = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+
+    for ring in polygon:
+        ring = np.asarray(ring, dtype=np.float64)
+        for (x1, y1), (x2, y2) in zip(ring, np.roll(ring, -1, axis=0)):
+            if y1 == y2:
+                continue
+            crosses = (y1 > py) != (y2 > py)
+            inside ^= crosses & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+
+    return inside
+
+
+def to_metres(points, lat0=None):
+    """
+    Projects `(lon, lat)` points to a local equirectangular plane in metres, which is accurate enough for distances of a
+    few metres within a single scene.
+
+    :param numpy.ndarray points: Array of shape `(n, 2)` of `(lon, lat)` points.
+    :param float lat0: Latitude of the projection origin (default: mean latitude of `points`).
+    :return numpy.ndarray: Array of shape `(n, 2)` of `(x, y)` points in metres.
+    """
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if lat0 is None:
+        lat0 = points[:, 1].mean() if len(points) else 0.0
+    scale = np.radians(1.0) * EARTH_RADIUS
+    return np.column_stack((points[:, 0] * scale * np.cos(np.radians(lat0)), points[:, 1] * scale))
+
+
+def _neighbour_pairs(points, radius):
+    """
+    Yields index arrays `(i, j)` of all pairs of points lying in the same or adjacent cells of a grid with cell size
+    `radius`, which includes every pair closer than `radius`.
+    """
+
+    cells = np.floor(points / radius).astype(np.int64)
+    cx = cells[:, 0] - cells[:, 0].min() + 1
+    cy = cells[:, 1] - cells[:, 1].min() + 1
+    width = cy.max() + 2
+    keys = cx * width + cy
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    indices = np.arange(len(points))
+
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            target = (cx + dx) * width + cy + dy
+            lo = np.searchsorted(sorted_keys, target, side="left")
+            counts = np.searchsorted(sorted_keys, target, side="right") - lo
+            total = counts.sum()
+            if not total:
+                continue
+            starts = np.cumsum(counts) - counts
+            i = np.repeat(indices, counts)
+            j = order[np.repeat(lo, counts) + np.arange(total) - np.repeat(starts, counts)]
+            yield i, j
+
+
+def dedup(points, groups, radius=None, boxes=None, margin=None):
+    """
+    Finds duplicate detections of the same object in neighbouring tiles: a point is a duplicate if a point with a lower
+    index from a different group (tile) lies within `radius`, or if their bounding boxes overlap or are less than
+    `margin` apart - an object crossing a tile border is split into pieces whose centroids can be several metres apart,
+    but which touch along the border. Points of the same group are never merged. Uses a uniform grid index sized by the
+    typical box size, boxes larger than that are matched through their own extent, so the cost is linear in the number
+    of points for a bounded density.
+
+    :param numpy.ndarray points: Array of shape `(n, 2)` of `(x, y)` points in metres.
+    :param numpy.ndarray groups: Integer array of shape `(n,)` identifying the tile of each point.
+    :param float radius: Distance in metres under which points are considered the same object
+    (default: `config.DEDUP_RADIUS`).
+    :param numpy.ndarray boxes: Optional array of shape `(n, 4)` of `(xmin, ymin, xmax, ymax)` bounding boxes of the
+    detections in metres; empty boxes (e.g. all zero) are ignored.
+    :param float margin: Largest gap in metres between boxes of the same object (default: `config.DEDUP_MARGIN`).
+    :return numpy.ndarray: Boolean array of shape `(n,)`, `False` for duplicates.
+    """
+
+    radius = config.DEDUP_RADIUS if radius is None else radius
+    margin = config.DEDUP_MARGIN if margin is None else margin
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    groups = np.asarray(groups)
+    keep = np.ones(len(points), dtype=bool)
+    if len(points) < 2:
+        return keep
+
+    reach = radius
+    large = np.zeros(len(points), dtype=bool)
+    if boxes is not None:
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        valid = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+        sizes = np.where(valid, (boxes[:, 2:] - boxes[:, :2]).max(axis=1), 0.0)
+        if valid.any():
+            # Centroids of pieces with touching boxes are at most a box size plus the margin apart. The grid follows
+            # the typical box size, so that a single large box does not put every point into the same cell
+            reach = max(radius, np.quantile(sizes[valid], config.DEDUP_BOX_QUANTILE) + margin)
+            large = sizes + margin > reach
+
+    def discard(i, j):
+        duplicate = (j < i) & (groups[i] != groups[j])
+        i, j = i[duplicate], j[duplicate]
+        close = ((points[i] - points[j]) ** 2).sum(axis=1) <= radius ** 2
+        if boxes is not None:
+            close |= valid[i] & valid[j] & \
+                (boxes[i, 0] <= boxes[j, 2] + margin) & (boxes[j, 0] <= boxes[i, 2] + margin) & \
+                (boxes[i, 1] <= boxes[j, 3] + margin) & (boxes[j, 1] <= boxes[i, 3] + margin)
+        keep[i[close]] = False
+
+    for i, j in _neighbour_pairs(points, reach):
+        discard(i, j)
+
+    if large.any():
+        # Large boxes are matched through their own extent - a point closer than `radius` or of a smaller box
+        # touching a large one lies within `reach` of the large box
+        order = np.argsort(points[:, 0], kind="stable")
+        xs = points[order, 0]
+        others = np.flatnonzero(large)
+        for k in others:
+            lo = np.searchsorted(xs, boxes[k, 0] - reach, side="left")
+            hi = np.searchsorted(xs, boxes[k, 2] + reach, side="right")
+            j = order[lo:hi]
+            j = np.union1d(j[(points[j, 1] >= boxes[k, 1] - reach) & (points[j, 1] <= boxes[k, 3] + reach)], others)
+            i = np.full(len(j), k)
+            discard(i, j)
+            discard(j, i)
+
+    return keep
+
+
+def match_points(a, b, radius):
+    """
+    Pairs points of `a` with points of `b` one to one, closest pairs first, leaving points with no counterpart within
+    `radius` unpaired. Candidate pairs are found through the same grid index as in `dedup`.
+
+    :param numpy.ndarray a: Array of shape `(n, 2)` of `(x, y)` points in metres.
+    :param numpy.ndarray b: Array of shape `(m, 2)` of `(x, y)` points in metres.
+    :param float radius: Largest distance in metres of paired points.
+    :return tuple: Boolean arrays of shapes `(n,)` and `(m,)`, `True` for the paired points of `a` and `b`.
+    """
+
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 2)
+    paired_a, paired_b = np.zeros(len(a), dtype=bool), np.zeros(len(b), dtype=bool)
+    if not len(a) or not len(b):
+        return paired_a, paired_b
+
+    points = np.concatenate((a, b))
+    candidates = []
+    for i, j in _neighbour_pairs(points, radius):
+        across = (i < len(a)) & (j >= len(a))
+        i, j = i[across], j[across]
+        distances = ((points[i] - points[j]) ** 2).sum(axis=1)
+        close = distances <= radius ** 2
+        candidates.append((distances[close], i[close], j[close] - len(a)))
+
+    distances, i, j = (np.concatenate(column) for column in zip(*candidates))
+    for k in np.argsort(distances, kind="stable"):
+        if not paired_a[i[k]] and not paired_b[j[k]]:
+            paired_a[i[k]] = paired_b[j[k]] = True
+
+    return paired_a, paired_b
+
+
+def filter_detections(centroids, groups, extent, radius=None, boxes=None):
+    """
+    Selects detections whose centroid lies within `extent` and which are not duplicates of a detection in a
+    neighbouring tile (see `dedup`).
+
+    :param numpy.ndarray centroids: Array of shape `(n, 2)` of `(lon, lat)` centroids.
+    :param numpy.ndarray groups: Integer array of shape `(n,)` identifying the tile of each detection.
+    :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
+    :param float radius: Deduplication distance in metres (default: `config.DEDUP_RADIUS`).
+    :param numpy.ndarray boxes: Optional array of shape `(n, 4)` of `(west, south, east, north)` bounding boxes of the
+    detections.
+    :return numpy.ndarray: Boolean array of shape `(n,)`, `True` for the detections to count.
+    """
+
+    centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+    keep = points_in_polygon(centroids, extent)
+    selected = np.flatnonzero(keep)
+    if not len(selected):
+        return keep
+
+    lat0 = centroids[selected, 1].mean()
+    if boxes is not None:
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)[selected]
+        boxes = np.column_stack((to_metres(boxes[:, :2], lat0), to_metres(boxes[:, 2:], lat0)))
+    keep[selected] = dedup(to_metres(centroids[selected], lat0), np.asarray(groups)[selected], radius, boxes)
+    return keep
+
+
+def multipolygon(extent):
+    """
+    :param list extent: Coordinates of a `Polygon` (`[[[,], [,], ... , [,]]]`) or a `MultiPolygon`.
+    :return list: Coordinates of the equivalent `MultiPolygon`.
+    """
+
+    return extent if isinstance(extent[0][0][0], list) else [extent]
+
+
+def bounds(extent):
+    """
+    :param list extent: Coordinates of a `Polygon` or `MultiPolygon`.
+    :return tuple: Bounding box `(west, south, east, north)` of `extent`.
+    """
+
+    points = np.array([point for polygon in multipolygon(extent) for ring in polygon for point in ring],
+                      dtype=np.float64)
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+
+def bounds_intersect(a, b, margin=0.0):
+    """
+    :param tuple a: Bounding box `(west, south, east, north)`.
+    :param tuple b: Bounding box `(west, south, east, north)`.
+    :param float margin: Distance in degrees by which the boxes may be apart and still intersect.
+    :return bool: Whether the bounding boxes intersect.
+    """
+
+    return a[0] <= b[2] + margin and b[0] <= a[2] + margin and a[1] <= b[3] + margin and b[1] <= a[3] + margin
+
+
+def bounding_polygon(extents):
+    """
+    :param list extents: Coordinates of `Polygon`s or `MultiPolygon`s.
+    :return list: Coordinates of the rectangular `Polygon` bounding all of `extents`.
+    """
+
+    boxes = np.array([bounds(extent) for extent in extents])
+    west, south = boxes[:, 0].min(), boxes[:, 1].min()
+    east, north = boxes[:, 2].max(), boxes[:, 3].max()
+    return [[[west, south], [east, south], [east, north], [west, north], [west, south]]]
+
+
+def intersects(a, b):
+    """
+    Approximate intersection test of two areas: they intersect if a vertex of one of them lies inside the other. Misses
+    only crossings of edges with all vertices outside, which does not matter for extents much smaller than a scene.
+
+    :param list a: Coordinates of a `Polygon` or `MultiPolygon`.
+    :param list b: Coordinates of a `Polygon` or `MultiPolygon`.
+    :return bool: Whether `a` and `b` intersect.
+    """
+
+    if not bounds_intersect(bounds(a), bounds(b)):
+        return False
+    for first, second in ((a, b), (b, a)):
+        vertices = np.array([point for polygon in multipolygon(first) for point in polygon[0]], dtype=np.float64)
+        if any(points_in_polygon(vertices, polygon).any() for polygon in multipolygon(second)):
+            return True
+    return False
+
+
+def cluster_extents(extents, distance):
+    """
+    Groups extents whose bounding boxes are at most `distance` apart, transitively.
+
+    :param list extents: Coordinates of `Polygon`s or `MultiPolygon`s.
+    :param float distance: Maximum distance in degrees between the bounding boxes of extents of the same group.
+    :return list: Groups of indices into `extents`, in order of their first member.
+    """
+
+    boxes = [bounds(extent) for extent in extents]
+    parent = list(range(len(extents)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in itertools.combinations(range(len(extents)), 2):
+        if bounds_intersect(boxes[i], boxes[j], distance):
+            parent[root(j)] = root(i)
+
+    groups = collections.OrderedDict()
+    for i in range(len(extents)):
+        groups.setdefault(root(i), []).append(i)
+    return list(groups.values())
+
+
+def tile_bounds(z, x, y):
+    """
+    :param int z: Zoom level of a Web Mercator (slippy map) tile.
+    :param int x: Column of the tile.
+    :param int y: Row of the tile.
+    :return tuple: Bounding box `(west, south, east, north)` of the tile in degrees.
+    """
+
+    n = 2 ** z
+
+    def lat(row):
+        return float(np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * row / n)))))
+
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
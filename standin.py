@@ -0,0 +1,277 @@
+import base64
+import copy
+import datetime
+import http.server
+import io
+import json
+import math
+import os
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+
+from PIL import Image
+
+import config
+import spatial
+
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "json", "templates")
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def make_jwt(claims):
+    """
+    :param dict claims: Payload of the token.
+    :return str: Unsigned JWT carrying `claims`.
+    """
+
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    return encode({"typ": "JWT", "alg": "none"}) + "." + encode(claims) + ".stand-in"
+
+
+def _png(mode, color):
+    buffer = io.BytesIO()
+    Image.new(mode, (256, 256), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class StandInServer:
+    """
+    Local stand-in for the SpaceKnow API serving the fixtures in `json/templates`, so that whole runs can be measured
+    without network access or credentials. Imitates the auth endpoint, `/imagery/search` and
+    `/kraken/release/{map type}/geojson` initiate/retrieve pipelines and the `/kraken/grid` tile endpoints.
+
+    Search results are synthesized from the fixture scene - one scene per day going back from the end of the requested
+    window, each with a footprint covering the requested extent. Kraken pipelines return a grid of `tiles` tiles
+    starting at the north-west corner of the extent, and every tile serves one of the fixture `detections.geojson`
+    files.
+    """
+
+    def __init__(self, scenes=10, tiles=4, pipeline_delay=0.0, latency=0.0, error_rate=0.0, page_size=10, seed=0):
+        """
+        :param int scenes: Number of scenes returned by a search.
+        :param int tiles: Number of tiles of every Kraken pipeline.
+        :param float pipeline_delay: Seconds until a pipeline is processed; retrieving it earlier answers
+        `PIPELINE-NOT-PROCESSED`.
+        :param float latency: Seconds added to every response.
+        :param float error_rate: Fraction of tile requests answered with status 503.
+        :param int page_size: Number of search results per page, further pages are linked by a cursor.
+        :param int seed: Seed of the error generator.
+        """
+
+        self.scenes = scenes
+        self.tiles = tiles
+        self.pipeline_delay = pipeline_delay
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.pipelines = {}
+        self.counters = {"requests": 0, "errors": 0, "tiles": 0}
+
+        with open(os.path.join(TEMPLATES_DIR, "search_response.json"), "r") as f:
+            self.scene_template = json.load(f)["results"][4]
+        kraken_dir = os.path.join(TEMPLATES_DIR, "kraken")
+        self.detections = []
+        for file_name in sorted(os.listdir(kraken_dir)):
+            with open(os.path.join(kraken_dir, file_name), "rb") as f:
+                self.detections.append(f.read())
+        self.images = {"truecolor": _png("RGB", (40, 60, 80)), "overlay": _png("RGBA", (255, 0, 0, 128))}
+
+        self.httpd = _Server(("127.0.0.1", 0), self._handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        """:return str: Base URL of the server."""
+
+        return "http://{}:{}".format(*self.httpd.server_address[:2])
+
+    def start(self):
+        """Starts serving in a background thread."""
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the socket."""
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def configure(self):
+        """
+        Points `config` at the server. Rate limits configured for SpaceKnow endpoints apply to the corresponding
+        endpoints of the server.
+
+        :return dict: Previous values, to be passed to `restore`.
+        """
+
+        saved = {"AUTH_PATH": config.AUTH_PATH, "IMAG_PATH": config.IMAG_PATH, "KRAK_PATH": config.KRAK_PATH,
+                 "RATE_LIMITS": config.RATE_LIMITS, "AUTH": config.AUTH, "SEARCH": config.SEARCH,
+                 "KRAKEN": config.KRAKEN}
+
+        config.AUTH_PATH = config.IMAG_PATH = config.KRAK_PATH = self.url
+        config.AUTH = dict(config.AUTH, ENDPOINT=self.url + "/oauth/ro")
+        config.SEARCH = dict(config.SEARCH, ENDPOINT=self.url + "/imagery/search")
+        config.KRAKEN = dict(config.KRAKEN, ENDPOINT=self.url + "/kraken/release")
+        host = urllib.parse.urlsplit(self.url).netloc
+        config.RATE_LIMITS = {host + "/" + key.partition("/")[2]: limit for key, limit in saved["RATE_LIMITS"].items()}
+        return saved
+
+    @staticmethod
+    def restore(saved):
+        """
+        :param dict saved: Values returned by `configure`.
+        """
+
+        for name, value in saved.items():
+            setattr(config, name, value)
+
+    def stats(self):
+        """:return dict: Copy of the request, error and tile counters."""
+
+        with self.lock:
+            return dict(self.counters)
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _initiate(self, kind, payload):
+        with self.lock:
+            pipeline_id = "standin{:06d}".format(len(self.pipelines))
+            self.pipelines[pipeline_id] = {"kind": kind, "payload": payload, "ready_at": time.time() +
+                                           self.pipeline_delay}
+        return {"pipelineId": pipeline_id, "status": "NEW"}
+
+    def _search_results(self, payload):
+        end = datetime.datetime.strptime(payload["endDatetime"], DATETIME_FORMAT)
+        start = datetime.datetime.strptime(payload["startDatetime"], DATETIME_FORMAT)
+        west, south, east, north = spatial.bounds(payload["extent"]["geometries"][0]["coordinates"])
+        footprint = {"type": "MultiPolygon", "coordinates": [[[[west - 0.1, south - 0.1], [east + 0.1, south - 0.1],
+                                                               [east + 0.1, north + 0.1], [west - 0.1, north + 0.1],
+                                                               [west - 0.1, south - 0.1]]]]}
+        results = []
+        for i in range(self.scenes):
+            scene_datetime = end - datetime.timedelta(days=i, hours=1)
+            if scene_datetime < start:
+                break
+            scene = copy.deepcopy(self.scene_template)
+            scene.update(sceneId="standin-scene-{:05d}".format(i), datetime=scene_datetime.strftime(DATETIME_FORMAT),
+                         footprint=footprint)
+            results.append(scene)
+        return results
+
+    def _retrieve(self, kind, payload):
+        with self.lock:
+            pipeline = self.pipelines.get(payload.get("pipelineId"))
+        if pipeline is None or pipeline["kind"] != kind:
+            return 404, {"error": "PIPELINE-NOT-FOUND"}
+        if time.time() < pipeline["ready_at"]:
+            return 409, {"error": "PIPELINE-NOT-PROCESSED"}
+
+        request = pipeline["payload"]
+        if kind == "search":
+            results = self._search_results(request)
+            offset = int(request.get("cursor") or 0) if request.get("cursor") != "first" else 0
+            cursor = offset + self.page_size if offset + self.page_size < len(results) else None
+            return 200, {"results": results[offset:offset + self.page_size],
+                         "cursor": None if cursor is None else str(cursor)}
+
+        map_type = kind.partition("/")[2]
+        west, _, _, north = spatial.bounds(request["extent"]["coordinates"])
+        n = 2 ** 16
+        x0 = int((west + 180.0) / 360.0 * n)
+        y0 = int((1.0 - math.log(math.tan(math.radians(north)) + 1.0 / math.cos(math.radians(north))) / math.pi) /
+                 2.0 * n)
+        side = int(math.ceil(math.sqrt(self.tiles)))
+        tiles = [[16, x0 + k % side, y0 + k // side] for k in range(self.tiles)]
+        map_id = make_jwt({"mapId": request["sceneId"], "mapType": map_type, "geometryId": "standin",
+                           "exp": int(time.time()) + 3600})
+        return 200, {"mapId": map_id, "maxZoom": 19, "tiles": tiles}
+
+    def _tile(self, path):
+        # /kraken/grid/{mapId}/-/{z}/{x}/{y}/{artifact}
+        parts = path.split("/")
+        if len(parts) != 9:
+            return 404, "application/json", json.dumps({"error": "NOT-FOUND"}).encode()
+        z, x, y, artifact = int(parts[5]), int(parts[6]), int(parts[7]), parts[8]
+        self._count("tiles")
+        if artifact == "detections.geojson":
+            return 200, "application/geo+json", self.detections[(x * 31 + y + z) % len(self.detections)]
+        if artifact == "truecolor.png":
+            return 200, "image/png", self.images["truecolor"]
+        return 200, "image/png", self.images["overlay"]
+
+    def _handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                server._count("requests")
+                time.sleep(server.latency)
+                if not self.path.startswith("/kraken/grid/"):
+                    return self._send(404, {"error": "NOT-FOUND"})
+                with server.lock:
+                    failed = server.random.random() < server.error_rate
+                if failed:
+                    server._count("errors")
+                    return self._send(503, {"error": "UNAVAILABLE"})
+                status, content_type, body = server._tile(self.path)
+                self._send(status, body, content_type)
+
+            def do_POST(self):
+                server._count("requests")
+                time.sleep(server.latency)
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+
+                if self.path == "/oauth/ro":
+                    return self._send(200, {"id_token": make_jwt({"exp": int(time.time()) + 3600})})
+                if self.path.startswith("/imagery/search/"):
+                    kind = "search"
+                elif self.path.startswith("/kraken/release/") and "/geojson/" in self.path:
+                    kind = "kraken/" + self.path.split("/")[3]
+                else:
+                    return self._send(404, {"error": "NOT-FOUND"})
+
+                if self.path.endswith("/initiate"):
+                    return self._send(200, server._initiate(kind, payload))
+                if self.path.endswith("/retrieve"):
+                    return self._send(*server._retrieve(kind, payload))
+                self._send(404, {"error": "NOT-FOUND"})
+
+        return Handler
@@ -0,0 +1,226 @@
+import calendar
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import config
+
+
+# Detections of one scene as returned by `sk_ass.scene_detections`
+DETECTION_DTYPE = np.dtype([
+    ("z", "<i4"), ("x", "<i4"), ("y", "<i4"),
+    ("lon", "<f8"), ("lat", "<f8"),
+    ("area", "<f4"), ("orientation", "<f4"),
+    ("count", "<i4"),
+    ("cls", "U32"),
+    # Bounding box of the detection polygon, all zero if not known
+    ("west", "<f8"), ("south", "<f8"), ("east", "<f8"), ("north", "<f8"),
+])
+
+# Columns persisted by `DetectionStore`, each in its own little-endian binary file
+COLUMNS = (
+    ("scene", "<i4"), ("time", "<i8"),
+    ("z", "<i4"), ("x", "<i4"), ("y", "<i4"),
+    ("lon", "<f8"), ("lat", "<f8"),
+    ("area", "<f4"), ("orientation", "<f4"),
+    ("count", "<i4"),
+)
+
+# Columns whose content identifies the detections of a tile, see `tile_index`
+TILE_DIGEST_COLUMNS = ("lon", "lat", "area", "orientation", "count")
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def to_timestamp(value):
+    """
+    :param str value: UTC datetime in form `"%Y-%m-%d %H:%M:%S"`.
+    :return int: Unix timestamp.
+    """
+
+    return calendar.timegm(datetime.datetime.strptime(value, DATETIME_FORMAT).timetuple())
+
+
+def tile_index(rows, offset=0):
+    """
+    Indexes detections sorted by tile. Every tile gets a digest of its detections, so that tiles which have not changed
+    between two scenes can be recognized without reading their rows.
+
+    :param rows: Detections sorted by `z`, `x` and `y`, array of `DETECTION_DTYPE` or a dict of columns.
+    :param int offset: Row number of the first of `rows`.
+    :return dict: Maps `"z/x/y"` keys to lists `[digest, count, start, stop]`, where `count` is the number of detected
+    objects and `start` and `stop` are the row range of the tile.
+    """
+
+    z, x, y = (np.asarray(rows[name]) for name in ("z", "x", "y"))
+    if not len(z):
+        return {}
+
+    boundaries = np.flatnonzero((z[1:] != z[:-1]) | (x[1:] != x[:-1]) | (y[1:] != y[:-1])) + 1
+    index = {}
+    for start, stop in zip(np.concatenate(([0], boundaries)), np.concatenate((boundaries, [len(z)]))):
+        digest = hashlib.sha1()
+        for name in TILE_DIGEST_COLUMNS:
+            digest.update(np.ascontiguousarray(rows[name][start:stop], dtype=dict(COLUMNS)[name]).tobytes())
+        index["{}/{}/{}".format(z[start], x[start], y[start])] = [
+            digest.hexdigest()[:16], int(np.asarray(rows["count"][start:stop]).sum()), offset + int(start),
+            offset + int(stop)]
+    return index
+
+
+class DetectionStore:
+    """
+    Append-only columnar store of detections of one map type over one extent. Every column is a flat binary file which
+    is read through a memory map, and `scenes.json` indexes the contiguous row range, `sceneId` and datetime of every
+    scene, so that time-series queries only touch the rows of the selected scenes and need neither the network nor any
+    geojson.
+
+    Rows are appended before the index is updated; rows not covered by the index (left behind by an interrupted append)
+    are ignored and overwritten by the next append.
+    """
+
+    def __init__(self, root):
+        """
+        :param str root: Directory of the store, created if it does not exist.
+        """
+
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+        self.index_path = os.path.join(root, "scenes.json")
+        self.scenes = []
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.scenes = json.load(f)
+        self.scene_numbers = {scene["sceneId"]: i for i, scene in enumerate(self.scenes)}
+
+    @classmethod
+    def for_map_type(cls, map_type, extent):
+        """
+        Returns the store of `map_type` over `extent` in `detections` in `config.TEMP_DIR`. Every extent has a store of
+        its own, as scenes of different extents are not comparable.
+
+        :param str map_type: Map type, e.g. `"cars"`.
+        :param list extent: Extent coordinates in form `[[[,], [,], ... , [,]]]`.
+        :return DetectionStore: Store of the map type over the extent.
+        """
+
+        digest = hashlib.sha256(json.dumps(extent).encode()).hexdigest()[:16]
+        return cls(os.path.join(config.TEMP_DIR, "detections", map_type, digest))
+
+    def __len__(self):
+        return self.scenes[-1]["stop"] if self.scenes else 0
+
+    def _column_path(self, name):
+        return os.path.join(self.root, name + ".bin")
+
+    def has_scene(self, scene_id):
+        """
+        :param str scene_id: Hash identifying the scene.
+        :return bool: Whether detections of the scene are stored.
+        """
+
+        return scene_id in self.scene_numbers
+
+    def append(self, scene_id, scene_datetime, found):
+        """
+        Stores detections of a scene. Scenes already in the store are skipped.
+
+        :param str scene_id: Hash identifying the scene.
+        :param str scene_datetime: Datetime of the scene in form `"%Y-%m-%d %H:%M:%S"`.
+        :param numpy.ndarray found: Detections of the scene, array of `DETECTION_DTYPE`.
+        """
+
+        if self.has_scene(scene_id):
+            return
+
+        # Rows of a tile are kept together, see `tiles`
+        found = found[np.lexsort((found["y"], found["x"], found["z"]))]
+        start = len(self)
+        number = len(self.scenes)
+        values = {
+            "scene": np.full(len(found), number),
+            "time": np.full(len(found), to_timestamp(scene_datetime)),
+        }
+
+        for name, dtype in COLUMNS:
+            column = values[name] if name in values else found[name]
+            with open(self._column_path(name), "ab") as f:
+                f.truncate(start * np.dtype(dtype).itemsize)
+                np.ascontiguousarray(column, dtype=dtype).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.scenes.append({"sceneId": scene_id, "datetime": scene_datetime, "start": start,
+                            "stop": start + len(found), "tiles": tile_index(found, start)})
+        self.scene_numbers[scene_id] = number
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.scenes, f)
+        os.replace(tmp_path, self.index_path)
+
+    def column(self, name):
+        """
+        :param str name: Column name, one of `COLUMNS`.
+        :return numpy.ndarray: Read-only memory map of the indexed rows of the column.
+        """
+
+        dtype = dict(COLUMNS)[name]
+        if not len(self):
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._column_path(name), dtype=dtype, mode="r", shape=(len(self),))
+
+    def tiles(self, scene):
+        """
+        :param dict scene: Index record of a scene, see `select`.
+        :return dict: Maps `"z/x/y"` keys of the tiles with detections in the scene to tuples `(digest, count, rows)`,
+        where `rows` is the slice of the rows of the tile in the columns.
+        """
+
+        return {key: (digest, count, slice(start, stop)) for key, (digest, count, start, stop)
+                in scene["tiles"].items()}
+
+    def select(self, since=None, until=None, scene_ids=None):
+        """
+        Returns index records of scenes in a time range, oldest first.
+
+        :param str since: Optional start of the range, `"%Y-%m-%d %H:%M:%S"` or a prefix of it, e.g. `"2018-05-01"`.
+        :param str until: Optional end of the range, in the same form.
+        :param iterable scene_ids: Optional subset of scenes.
+        :return list: Dicts with `sceneId`, `datetime`, `start` and `stop` (row range) fields, and `tiles` (see
+        `tile_index`).
+        """
+
+        scene_ids = None if scene_ids is None else set(scene_ids)
+        return sorted((scene for scene in self.scenes
+                       if (since is None or scene["datetime"] >= since) and
+                       (until is None or scene["datetime"][:len(until)] <= until) and
+                       (scene_ids is None or scene["sceneId"] in scene_ids)),
+                      key=lambda scene: scene["datetime"])
+
+    def counts_per_scene(self, since=None, until=None):
+        """
+        :param str since: Optional start of the range, see `select`.
+        :param str until: Optional end of the range, see `select`.
+        :return list: Tuples `(scene_id, datetime, count)`, oldest first.
+        """
+
+        counts = self.column("count")
+        return [(scene["sceneId"], scene["datetime"], int(counts[scene["start"]:scene["stop"]].sum()))
+                for scene in self.select(since, until)]
+
+    def counts_per_day(self, since=None, until=None):
+        """
+        :param str since: Optional start of the range, see `select`.
+        :param str until: Optional end of the range, see `select`.
+        :return list: Tuples `(date, count)`, oldest first, where `count` is the mean count of the scenes of that day.
+        """
+
+        days = {}
+        for _, scene_datetime, count in self.counts_per_scene(since, until):
+            days.setdefault(scene_datetime[:10], []).append(count)
+        return [(day, sum(counts) / len(counts)) for day, counts in sorted(days.items())]
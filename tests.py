@@ -1,10 +1,38 @@
 import ast
+import base64
+import io
+import os
+import shutil
+import sys
+import time
+import tempfile
 import unittest
 from unittest import mock
 import json as jsn
+import requests
 
+import numpy as np
+from PIL import Image
+
+import auth
+import benchmark
+import cache
+import changes
 import config
+import detections
+import exceptions
+import instrument
+import mosaic
+import overlay
+import polling
+import scene_index
+import selection
 import sk_ass
+import store
+import spatial
+import standin
+import transport
+import workqueue
 
 
 class MockResponse:
@@ -12,13 +40,21 @@ class MockResponse:
     def __init__(self, json_data, status_code):
         self.json_data = json_data
         self.status_code = status_code
+        self.content = jsn.dumps(json_data).encode()
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
 
     def json(self):
         return self.json_data
 
 
-def mock_request_happy_path(method, endpoint, headers, json):
-    """Used to mock requests.request in happy path scenarios."""
+def mock_request_happy_path(method, endpoint, headers=None, json=None, **kwargs):
+    """Used to mock requests.Session.request in happy path scenarios."""
     if endpoint.endswith("/initiate"):
         return MockResponse({"pipelineId": "3g4PovfhGxmymQolpgvv", "status": "NEW"}, 200)
     if endpoint == config.SEARCH["ENDPOINT"] + "/retrieve":
@@ -31,8 +67,8 @@ def mock_request_happy_path(method, endpoint, headers, json):
     return MockResponse(None, 404)
 
 
-def mock_get_count_detections(url):
-    """Used to mock requests.get in count_detections method."""
+def mock_get_count_detections(method, url, **kwargs):
+    """Used to mock requests.Session.request in count_detections method."""
     url_parts = url.split("/")
     if url_parts[-1] == "detections.geojson":
         file_name = "-".join(["cars", str(mock_get_count_detections.counter // 4)] + list(map(str, url_parts[-4:-1]))) \
@@ -46,9 +82,64 @@ def mock_get_count_detections(url):
 mock_get_count_detections.counter = 0
 
 
+def mock_request_run(method, url, headers=None, json=None, **kwargs):
+    """Used to mock requests.Session.request in a whole run."""
+    if url == config.AUTH["ENDPOINT"]:
+        return MockResponse({"id_token": "token"}, 200)
+    if url.startswith(config.KRAKEN["ENDPOINT"]) and url.endswith("/geojson/retrieve"):
+        url = config.KRAKEN["ENDPOINT"] + "/cars/geojson/retrieve"
+    if url.endswith(".png"):
+        buffer = io.BytesIO()
+        if url.endswith("/truecolor.png"):
+            Image.new("RGB", (256, 256), (0, 0, 255)).save(buffer, "PNG")
+        else:
+            Image.new("RGBA", (256, 256), (255, 0, 0, 128)).save(buffer, "PNG")
+        response = MockResponse(None, 200)
+        response.content = buffer.getvalue()
+        return response
+    if url.endswith("/detections.geojson"):
+        with open("./json/templates/kraken/cars-0-" + "-".join(url.split("/")[-4:-1]) + ".geojson") as f:
+            return MockResponse(jsn.load(f), 200)
+    return mock_request_happy_path(method, url, headers, json)
+
+
+def make_jwt(claims):
+    payload = base64.urlsafe_b64encode(jsn.dumps(claims).encode()).decode().rstrip("=")
+    return "header." + payload + ".signature"
+
+
 class HappyPathTestCase(unittest.TestCase):
 
-    @mock.patch('requests.request', side_effect=mock_request_happy_path)
+    def setUp(self):
+        self.saved_config = {k: getattr(config, k) for k in ("TEMP_DIR", "IMG_DIR", "POLL_MIN_INTERVAL",
+                                                             "HTTP_RETRY_BACKOFF", "RATE_LIMIT",
+                                                             "SELECTION_BUCKET_HOURS", "OVERLAY_MODE",
+                                                             "MOSAIC", "PROFILE_REPORT", "PROFILE_STAGES")}
+        self.saved_window = {k: config.SEARCH["PAYLOAD"][k] for k in ("startDatetime", "endDatetime")}
+        config.TEMP_DIR = tempfile.mkdtemp()
+        config.IMG_DIR = os.path.join(config.TEMP_DIR, "img")
+        os.mkdir(config.IMG_DIR)
+        config.POLL_MIN_INTERVAL = 0
+        config.HTTP_RETRY_BACKOFF = 0
+        config.RATE_LIMIT = (1000, 1000)
+        # Keep every eligible scene of the fixture, selection is covered by SelectionTestCase
+        config.SELECTION_BUCKET_HOURS = 0
+        transport_patcher = mock.patch.object(transport, "_default", None)
+        transport_patcher.start()
+        self.addCleanup(transport_patcher.stop)
+        config.SEARCH["PAYLOAD"].update(startDatetime="2017-08-01 00:00:00", endDatetime="2018-08-01 00:00:00")
+
+    def tearDown(self):
+        shutil.rmtree(config.TEMP_DIR)
+        for k, v in self.saved_config.items():
+            setattr(config, k, v)
+        config.SEARCH["PAYLOAD"].update(self.saved_window)
+
+    @staticmethod
+    def detection_store(map_type, input_file="./json/inputs/brisbane_airport_staff_parking_lot.geojson"):
+        return store.DetectionStore.for_map_type(map_type, sk_ass.read_extent(input_file))
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_happy_path)
     def test_get_scenes(self, _):
         extent = [[[153.105222, -27.390124], [153.103551, -27.392584], [153.105318, -27.393370],
                   [153.106794, -27.390879], [153.105222, -27.390124]]]
@@ -60,7 +151,25 @@ class HappyPathTestCase(unittest.TestCase):
         self.assertEqual(scenes[-1], 'GuoBFqtuBllGqZWHb395VXytBgtnXKV7fnsqIjQ8xRzjq9S2kgUg6ogLyVO826ccyuqdi6e9OxcpXJtV')
         self.assertEqual(len(scenes), 10)
 
-    @mock.patch('requests.request', side_effect=mock_request_happy_path)
+    @mock.patch('requests.Session.request', side_effect=mock_request_happy_path)
+    def test_get_scenes_incremental(self, request):
+        extent = [[[153.105222, -27.390124], [153.103551, -27.392584], [153.105318, -27.393370],
+                  [153.106794, -27.390879], [153.105222, -27.390124]]]
+        auth_token = "hmWJcfhRouDOaJK2L8asREMlMrv3jFE1"
+        sk_ass.get_scenes(extent, auth_token)
+
+        self.assertEqual(request.call_args_list[0][1]["json"]["startDatetime"], "2017-08-01 00:00:00")
+
+        config.GSD_LIMIT, saved_gsd_limit = 0.45, config.GSD_LIMIT
+        try:
+            scenes = sk_ass.get_scenes(extent, auth_token)
+        finally:
+            config.GSD_LIMIT = saved_gsd_limit
+
+        self.assertEqual(request.call_args_list[2][1]["json"]["startDatetime"], "2018-07-12 23:55:02")
+        self.assertEqual(len(scenes), 1)
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_happy_path)
     def test_collect_tiles(self, _):
         extent = [[[153.105222, -27.390124], [153.103551, -27.392584], [153.105318, -27.39337],
                   [153.106794, -27.390879], [153.105222, -27.390124]]]
@@ -84,8 +193,24 @@ class HappyPathTestCase(unittest.TestCase):
         self.assertIsNotNone(response)
         self.assertDictEqual(response, tiles)
 
-    @mock.patch('requests.get', side_effect=mock_get_count_detections)
+    @mock.patch('requests.Session.request', side_effect=mock_request_happy_path)
+    def test_collect_all_tiles(self, _):
+        extent = [[[153.105222, -27.390124], [153.103551, -27.392584], [153.105318, -27.39337],
+                  [153.106794, -27.390879], [153.105222, -27.390124]]]
+        auth_token = "hmWJcfhRouDOaJK2L8asREMlMrv3jFE1"
+        scene_ids = ["scene_a", "scene_b", "scene_c"]
+
+        results = list(sk_ass.collect_all_tiles(extent, auth_token, scene_ids, ["cars"], max_pending=2))
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(sorted(r[0] for r in results), scene_ids)
+        for _, map_type, tiles in results:
+            self.assertEqual(map_type, "cars")
+            self.assertEqual(len(tiles["tiles"]), 4)
+
+    @mock.patch('requests.Session.request', side_effect=mock_get_count_detections)
     def test_count_detections(self, _):
+        mock_get_count_detections.counter = 0
         with open("./json/templates/kraken/tiles.txt", "r") as f:
             s = f.read()
 
@@ -95,7 +220,849 @@ class HappyPathTestCase(unittest.TestCase):
 
         self.assertEqual(detections, 7237)
 
+    @mock.patch('requests.Session.request', side_effect=mock_get_count_detections)
+    def test_count_detections_cached(self, request):
+        mock_get_count_detections.counter = 0
+        with open("./json/templates/kraken/tiles.txt", "r") as f:
+            tiles = ast.literal_eval(f.read())
+
+        self.assertEqual(sk_ass.count_detections(tiles, "cars"), 7237)
+        self.assertEqual(request.call_count, 24)
+        self.assertEqual(sk_ass.count_detections(tiles, "cars"), 7237)
+        self.assertEqual(request.call_count, 24)
+
+    @mock.patch('requests.Session.request', side_effect=mock_get_count_detections)
+    def test_count_detections_streamed(self, request):
+        mock_get_count_detections.counter = 0
+        with open("./json/templates/kraken/tiles.txt", "r") as f:
+            tiles = ast.literal_eval(f.read())
+
+        # Downloaded detections are parsed as they arrive and cached once complete, without leaving partial files
+        with mock.patch.object(detections, "_parse_features", side_effect=AssertionError("parsed in memory")):
+            self.assertEqual(sk_ass.count_detections(tiles, "cars"), 7237)
+        self.assertTrue(all(c[1].get("stream") for c in request.call_args_list))
+        self.assertFalse([f for f in os.listdir(config.TEMP_DIR) if f.endswith(".part")])
+
+        self.assertEqual(sk_ass.count_detections(tiles, "cars"), 7237)
+        self.assertEqual(request.call_count, 24)
+
+    @mock.patch('requests.Session.request', side_effect=mock_get_count_detections)
+    def test_tile_cache_keyed_by_geometry(self, request):
+        with open("./json/templates/kraken/tiles.txt", "r") as f:
+            tiles = ast.literal_eval(f.read())
+        scenes = [sk_ass.map_scene(item) for item in tiles]
+
+        def reissue(**claims):
+            mock_get_count_detections.counter = 0
+            for item, (scene, map_type) in zip(tiles, scenes):
+                item["mapId"] = make_jwt(dict(claims, mapId=scene, mapType=map_type))
+            sk_ass.count_detections(tiles, "cars")
+
+        # A new mapId of the same scene and geometry is served from the cache, one of another geometry is not
+        reissue(geometryId="a", version=1, exp=1)
+        reissue(geometryId="a", version=1, exp=2)
+        self.assertEqual(request.call_count, 24)
+        reissue(geometryId="b", version=1, exp=2)
+        self.assertEqual(request.call_count, 48)
+
+    @mock.patch('requests.Session.request', side_effect=mock_get_count_detections)
+    def test_count_detections_in_extent(self, _):
+        mock_get_count_detections.counter = 0
+        with open("./json/templates/kraken/tiles.txt", "r") as f:
+            tiles = ast.literal_eval(f.read())
+        extent = sk_ass.read_extent("./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+
+        self.assertEqual(sk_ass.count_detections(tiles, "cars", extent), 7121)
+
+    def test_fetch_images(self):
+        with open("./json/templates/kraken/tiles.txt", "r") as f:
+            tiles = ast.literal_eval(f.read())[:2]
+
+        def mock_get_png(method, url, **kwargs):
+            response = MockResponse(None, 503 if url.split("/")[-2] == "37956" else 200)
+            response.content = url.encode()
+            return response
+
+        with mock.patch('requests.Session.request', side_effect=mock_get_png):
+            images, failed = sk_ass.fetch_images(tiles, "cars", workers=4)
+
+        self.assertEqual(sorted(failed), [(0, [16, 60639, 37956]), (0, [16, 60640, 37956]),
+                                          (1, [16, 60639, 37956]), (1, [16, 60640, 37956])])
+        self.assertEqual(sorted(images), [(0, 16, 60639, 37955), (0, 16, 60640, 37955), (1, 16, 60639, 37955),
+                                          (1, 16, 60640, 37955)])
+        self.assertTrue(images[(1, 16, 60639, 37955)].endswith(b"/16/60639/37955/cars.png"))
+
+    def test_blend_tiles(self):
+        def png(color, mode):
+            buffer = io.BytesIO()
+            Image.new(mode, (4, 4), color).save(buffer, "PNG")
+            return buffer.getvalue()
+
+        fg = {(0, 16, 1, 1): png((255, 0, 0, 255), "RGBA"), (0, 16, 1, 2): png((255, 0, 0, 0), "RGBA"),
+              (1, 16, 1, 1): png((255, 0, 0, 255), "RGBA")}
+        bg = {(0, 16, 1, 1): png((0, 0, 255), "RGB"), (0, 16, 1, 2): png((0, 0, 255), "RGB")}
+
+        unmatched = sk_ass.blend_tiles(fg, bg, config.TEMP_DIR, processes=2)
+
+        self.assertEqual(unmatched, [(1, 16, 1, 1)])
+        self.assertEqual(sorted(f for f in os.listdir(config.TEMP_DIR) if f.startswith("blend_")),
+                         ["blend_0_16_1_1.png", "blend_0_16_1_2.png"])
+        self.assertEqual(Image.open(os.path.join(config.TEMP_DIR, "blend_0_16_1_1.png")).getpixel((0, 0)), (255, 0, 0))
+        self.assertEqual(Image.open(os.path.join(config.TEMP_DIR, "blend_0_16_1_2.png")).getpixel((0, 0)), (0, 0, 255))
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_run)
+    def test_run(self, _):
+        sk_ass.run("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+
+        self.assertEqual(len(os.listdir(config.IMG_DIR)), 40)
+        counts = self.detection_store("cars").counts_per_scene()
+        self.assertEqual(len(counts), 10)
+        self.assertEqual(set(count for _, _, count in counts), {924})
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_run)
+    def test_run_several_map_types(self, request):
+        sk_ass.run(["cars", "aircraft"], "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+
+        urls = [c[0][1] for c in request.call_args_list]
+        self.assertEqual(urls.count(config.SEARCH["ENDPOINT"] + "/initiate"), 1)
+        self.assertEqual(urls.count(config.KRAKEN["ENDPOINT"] + "/imagery/geojson/initiate"), 10)
+        self.assertEqual(urls.count(config.KRAKEN["ENDPOINT"] + "/aircraft/geojson/initiate"), 10)
+        truecolor = [url for url in urls if url.endswith("/truecolor.png")]
+        self.assertEqual(len(truecolor), len(set(truecolor)))
+
+        images = os.listdir(config.IMG_DIR)
+        self.assertEqual(len([f for f in images if f.startswith("blend_cars_")]), 40)
+        self.assertEqual(len([f for f in images if f.startswith("blend_aircraft_")]), 40)
+        self.assertEqual(set(count for _, _, count in self.detection_store("cars").counts_per_scene()),
+                         {924})
+        self.assertEqual(len(self.detection_store("aircraft").counts_per_scene()), 10)
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_run)
+    def test_run_repeated_map_type(self, request):
+        sk_ass.run(["cars", "cars"], "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+
+        urls = [c[0][1] for c in request.call_args_list]
+        self.assertEqual(urls.count(config.KRAKEN["ENDPOINT"] + "/cars/geojson/initiate"), 10)
+        counts = self.detection_store("cars").counts_per_scene()
+        self.assertEqual(len(counts), 10)
+        self.assertEqual(set(count for _, _, count in counts), {924})
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_run)
+    def test_run_several_extents(self, _):
+        sk_ass.run("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+        sk_ass.run("cars", "./json/inputs/brisbane_andrews_airport_parking.geojson")
+
+        # Scenes are shared by both extents, but each extent keeps its own detections of them
+        lot = self.detection_store("cars").counts_per_scene()
+        andrews = self.detection_store("cars", "./json/inputs/brisbane_andrews_airport_parking.geojson")
+        self.assertEqual(len(lot), 10)
+        self.assertEqual(set(count for _, _, count in lot), {924})
+        self.assertEqual(len(andrews.counts_per_scene()), 6)
+        self.assertEqual(set(count for _, _, count in andrews.counts_per_scene()), {0})
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_run)
+    def test_run_local_overlay(self, request):
+        config.OVERLAY_MODE = "local"
+        sk_ass.run("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+
+        urls = [c[0][1] for c in request.call_args_list]
+        self.assertFalse(any(url.endswith("/cars.png") for url in urls))
+        self.assertEqual(len(os.listdir(config.IMG_DIR)), 40)
+        counts = self.detection_store("cars").counts_per_scene()
+        self.assertEqual(set(count for _, _, count in counts), {924})
+
+    def test_run_local_overlay_missing_tiles(self):
+        config.OVERLAY_MODE = "local"
+
+        # A missing background is not drawn, but its detections are still counted
+        def missing_background(method, url, **kwargs):
+            if url.endswith("/16/60639/37955/truecolor.png"):
+                return MockResponse({"error": "not found"}, 404)
+            return mock_request_run(method, url, **kwargs)
+
+        with mock.patch('requests.Session.request', side_effect=missing_background):
+            sk_ass.run("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+
+        self.assertEqual(len(os.listdir(config.IMG_DIR)), 30)
+        counts = self.detection_store("cars").counts_per_scene()
+        self.assertEqual(set(count for _, _, count in counts), {924})
+
+    def test_run_local_overlay_missing_detections(self):
+        config.OVERLAY_MODE = "local"
+
+        # Missing detections would undercount the scene, which fails instead
+        def missing_detections(method, url, **kwargs):
+            if url.endswith("/16/60639/37955/detections.geojson"):
+                return MockResponse({"error": "not found"}, 404)
+            return mock_request_run(method, url, **kwargs)
+
+        with mock.patch('requests.Session.request', side_effect=missing_detections):
+            with self.assertRaises(requests.RequestException):
+                sk_ass.run("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+
+        self.assertEqual(len(self.detection_store("cars").scenes), 0)
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_run)
+    def test_run_mosaic(self, _):
+        config.MOSAIC = True
+        sk_ass.run("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+
+        mosaics = os.listdir(os.path.join(config.IMG_DIR, "mosaics"))
+        self.assertEqual(len(mosaics), 10)
+        self.assertEqual(Image.open(os.path.join(config.IMG_DIR, "mosaics", mosaics[0])).size, (512, 512))
+        pyramid = os.path.join(config.IMG_DIR, "tiles", "blend_cars", mosaics[0][len("blend_cars_"):-len(".png")])
+        self.assertTrue(os.path.isfile(os.path.join(pyramid, "16", "60639", "37955.png")))
+        self.assertTrue(os.path.isfile(os.path.join(pyramid, str(config.PYRAMID_MIN_ZOOM), "3789", "2372.png")))
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_run)
+    def test_profile_run(self, _):
+        config.PROFILE_REPORT = os.path.join(config.TEMP_DIR, "profile.json")
+        config.PROFILE_STAGES = True
+        self.addCleanup(instrument.reset)
+        sk_ass.profile_run(sk_ass.run, "cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+
+        with open(config.PROFILE_REPORT) as f:
+            report = jsn.load(f)
+        self.assertTrue({"search", "kraken", "download", "blend", "count"} <= set(report["stages"]))
+        self.assertEqual(report["polls"]["kraken/cars"]["pipelines"], 10)
+        grid = report["endpoints"]["spaceknow-kraken.appspot.com/kraken/grid"]
+        self.assertEqual(sum(grid["histogram"]), grid["requests"])
+        self.assertGreater(report["transport"]["bytes"], 0)
+        self.assertGreater(report["cache"]["hit_rate"], 0.5)
+        self.assertIn("search", report["profiles"])
+        self.assertTrue(os.path.isfile(config.PROFILE_REPORT + ".search.pstats"))
+
+    def test_run_resume(self):
+        calls = []
+
+        # Retrieving fails persistently after a while, outlasting the retries of the transport
+        def failing_request(method, url, **kwargs):
+            calls.append(url)
+            if url.endswith("/geojson/retrieve") and len([c for c in calls if c.endswith("/retrieve")]) > 8:
+                return MockResponse({"error": "unavailable"}, 500)
+            return mock_request_run(method, url, **kwargs)
+
+        with mock.patch('requests.Session.request', side_effect=failing_request):
+            with self.assertRaises(requests.RequestException):
+                sk_ass.run("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+
+        self.assertLess(len(self.detection_store("cars").scenes), 10)
+
+        with mock.patch('requests.Session.request', side_effect=mock_request_run) as request:
+            sk_ass.run("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson", resume=True)
+
+        urls = [c[0][1] for c in request.call_args_list]
+        self.assertFalse(any(url.startswith(config.SEARCH["ENDPOINT"]) for url in urls))
+        self.assertLess(len([url for url in urls if url.endswith("/initiate")]), 20)
+        self.assertEqual(len(self.detection_store("cars").scenes), 10)
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_run)
+    def test_run_batch(self, request):
+        manifest = os.path.join(config.TEMP_DIR, "batch.jsonl")
+        with open(manifest, "w") as f:
+            for name, west, east in (("west", 153.1035, 153.1050), ("east", 153.1045, 153.1068)):
+                ring = [[west, -27.3934], [east, -27.3934], [east, -27.3901], [west, -27.3901], [west, -27.3934]]
+                f.write(jsn.dumps({"name": name, "coordinates": [ring]}) + "\n")
+            f.write(jsn.dumps({"file": os.path.abspath("./json/inputs/brisbane_alpha_airport_parking.geojson")})
+                    + "\n")
+
+        sk_ass.run_batch("cars", manifest)
+
+        urls = [c[0][1] for c in request.call_args_list]
+        self.assertEqual(urls.count(config.AUTH["ENDPOINT"]), 1)
+        self.assertEqual(urls.count(config.SEARCH["ENDPOINT"] + "/initiate"), 1)
+        self.assertEqual(len([url for url in urls if url.endswith("/geojson/initiate")]), 20)
+        tile_urls = [url for url in urls if url.startswith(config.KRAK_PATH + "/kraken/grid")]
+        self.assertEqual(len(tile_urls), len(set(tile_urls)))
+
+        west = os.path.join(config.IMG_DIR, "west")
+        self.assertEqual(len(os.listdir(west)), 20)
+        # One of the scenes covers only a part of the eastern extent and is not selected for it
+        self.assertEqual(len(os.listdir(os.path.join(config.IMG_DIR, "east"))), 36)
+        self.assertEqual(os.listdir(os.path.join(config.IMG_DIR, "brisbane_alpha_airport_parking")), [])
+        self.assertEqual(os.stat(os.path.join(west, "blend_cars_0_16_60639_37955.png")).st_nlink, 2)
+
+        extents = sk_ass.read_extents(manifest)
+        counts = {name: store.DetectionStore.for_map_type("cars", extents[name]).counts_per_scene()
+                  for name in ("west", "east", "brisbane_alpha_airport_parking")}
+        self.assertEqual([len(c) for c in counts.values()], [10, 9, 6])
+        self.assertTrue(all(count > 0 for _, _, count in counts["west"] + counts["east"]))
+        self.assertEqual(sum(count for _, _, count in counts["brisbane_alpha_airport_parking"]), 0)
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_run)
+    def test_coordinate(self, _):
+        queue_path = os.path.join(config.TEMP_DIR, "queue.sqlite")
+        sk_ass.coordinate("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson", queue_path, wait=False)
+
+        # A worker dies holding the lease of the first scene
+        work_queue = workqueue.WorkQueue(queue_path)
+        self.assertIsNotNone(work_queue.lease("dead", duration=0))
+        time.sleep(0.01)
+
+        self.assertEqual(sk_ass.work(queue_path, "alive"), 10)
+        self.assertEqual(work_queue.counts(), {"pending": 0, "leased": 0, "done": 10, "failed": 0})
+        self.assertEqual(len(os.listdir(config.IMG_DIR)), 40)
+
+        sk_ass.coordinate("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson", queue_path)
+        counts = self.detection_store("cars").counts_per_scene()
+        self.assertEqual(len(counts), 10)
+        self.assertEqual(set(count for _, _, count in counts), {924})
+
+    @mock.patch('requests.Session.request', side_effect=mock_request_run)
+    def test_changes(self, _):
+        sk_ass.run("cars", "./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+        extent = sk_ass.read_extent("./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+        sk_ass.print_changes("cars", 3650, extent)
+
+        changes_dir = os.path.join(config.TEMP_DIR, "changes")
+        with open(os.path.join(changes_dir, os.listdir(changes_dir)[0], "cars.json")) as f:
+            series = jsn.load(f)
+        # Every scene of the fixture has the same detections
+        self.assertEqual(len(series["extent"]), 9)
+        self.assertTrue(all((delta["arrived"], delta["departed"], delta["stayed"]) == (0, 0, 924)
+                            for delta in series["extent"]))
+        self.assertEqual(series["compared"], 0)
+        self.assertEqual(series["skipped"], 9 * len(series["tiles"]))
+
+
+class DetectionsTestCase(unittest.TestCase):
+
+    def test_streaming_matches_full_parse(self):
+        with open("./json/templates/kraken/cars-0-16-60639-37955.geojson", "rb") as f:
+            data = f.read()
+        features = jsn.loads(data)["features"]
+
+        chunks = [data[i:i + 1000] for i in range(0, len(data), 1000)]
+        found = list(detections.iter_detections(chunks, ["cars"], centroids=True))
+
+        self.assertEqual(len(found), len(features))
+        self.assertEqual(sum(d.count for d in found), sum(f["properties"]["count"] for f in features))
+        ring = features[0]["geometry"]["coordinates"][0][:-1]
+        self.assertAlmostEqual(found[0].centroid[0], sum(p[0] for p in ring) / len(ring))
+        self.assertEqual(found[0].orientation, features[0]["properties"]["orientation"])
+
+    def test_tally_several_classes(self):
+        data = jsn.dumps({"features": [
+            {"geometry": None, "properties": {"class": "cars", "count": 2}},
+            {"properties": {"class": "aircraft", "count": 1}, "geometry": {"type": "Point", "coordinates": [1, 2]}},
+            {"properties": {"class": "cows}", "count": 5}},
+        ]}).encode()
+
+        self.assertEqual(detections.tally([data], ["cars", "aircraft"]), {"cars": 2, "aircraft": 1})
+
+    def test_in_memory_matches_streaming(self):
+        with open("./json/templates/kraken/cars-0-16-60639-37955.geojson", "rb") as f:
+            data = f.read()
+
+        self.assertEqual(list(detections.iter_detections(data, ["cars"], centroids=True, geometries=True)),
+                         list(detections.iter_detections([data], ["cars"], centroids=True, geometries=True)))
+        self.assertEqual(detections.tally(data, ["cars"]), detections.tally([data], ["cars"]))
+
+    def test_malformed(self):
+        for data in (b'[{"features": []}]', b'{"type": "FeatureCollection"}', b'{"features": [{"properties": {',
+                     b'{"features": [{"geometry": null}]}'):
+            for content in (data, [data]):
+                with self.assertRaises(exceptions.FieldNotFoundException):
+                    detections.tally(content, ["cars"])
+
+
+class SpatialTestCase(unittest.TestCase):
+
+    def test_points_in_polygon(self):
+        square = [[[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]], [[0.5, 0.5], [1, 0.5], [1, 1], [0.5, 1], [0.5, 0.5]]]
+        inside = spatial.points_in_polygon([[1.5, 1.5], [0.75, 0.75], [3, 1], [-1, 1]], square)
+
+        self.assertEqual(inside.tolist(), [True, False, False, False])
+
+    def test_dedup_across_tiles(self):
+        points = [[0, 0], [0.5, 0], [-0.8, 0], [10, 10], [10.5, 10]]
+        groups = [0, 1, 0, 0, 0]
+
+        self.assertEqual(spatial.dedup(points, groups, radius=1.0).tolist(), [True, False, True, True, True])
+
+    def test_filter_detections(self):
+        extent = [[[153.0, -27.5], [153.1, -27.5], [153.1, -27.4], [153.0, -27.4], [153.0, -27.5]]]
+        centroids = [[153.05, -27.45], [153.05 + 5e-6, -27.45], [153.2, -27.45]]
+
+        self.assertEqual(spatial.filter_detections(centroids, [0, 1, 1], extent).tolist(), [True, False, False])
+
+    def test_dedup_border_pieces(self):
+        # Pieces of cars crossing the border of two tiles of a fixture scene, their centroids are over 1.5 m apart
+        rows = []
+        for group, x in enumerate((60639, 60640)):
+            with open("./json/templates/kraken/cars-0-16-{}-37955.geojson".format(x), "rb") as f:
+                for detection in detections.iter_detections(f.read(), ["cars"], centroids=True, geometries=True):
+                    rows.append((group,) + detection.centroid + detections.bounds(detection.coordinates))
+        rows = np.array(rows)
+        extent = [[[153.0, -27.5], [153.2, -27.5], [153.2, -27.3], [153.0, -27.3], [153.0, -27.5]]]
+
+        keep = spatial.filter_detections(rows[:, 1:3], rows[:, 0], extent, boxes=rows[:, 3:])
+        self.assertEqual(rows[~keep, 1:3].round(6).tolist(), [[153.105471, -27.390357], [153.105488, -27.390422]])
+        self.assertTrue(spatial.filter_detections(rows[:, 1:3], rows[:, 0], extent).all())
+
+    def test_dedup_large_box(self):
+        # A single huge box must neither change the grid cell size nor be missed
+        grid = np.arange(40) * 5.0
+        points = np.array([(300.0, 300.0)] + [(x, y) for x in grid for y in grid])
+        boxes = np.column_stack((points - 1.0, points + 1.0))
+        boxes[0] = (150.0, 150.0, 450.0, 450.0)
+        groups = np.arange(len(points)) % 2
+
+        with mock.patch("spatial._neighbour_pairs", wraps=spatial._neighbour_pairs) as neighbour_pairs:
+            keep = spatial.dedup(points, groups, radius=1.0, boxes=boxes, margin=0.5)
+        self.assertEqual(neighbour_pairs.call_args[0][1], 2.5)
+
+        overlap = (boxes[:, None, :2] <= boxes[None, :, 2:] + 0.5).all(axis=2) & \
+            (boxes[None, :, :2] <= boxes[:, None, 2:] + 0.5).all(axis=2)
+        duplicate = np.tril(overlap & (groups[:, None] != groups[None, :]), -1).any(axis=1)
+        self.assertEqual(keep.tolist(), (~duplicate).tolist())
+        self.assertEqual((~keep).sum(), 50)
+
+    def test_match_points(self):
+        paired_a, paired_b = spatial.match_points([[0, 0], [10, 0], [20, 0]], [[0.9, 0], [0.5, 0], [30, 0]], 1.0)
+
+        self.assertEqual(paired_a.tolist(), [True, False, False])
+        self.assertEqual(paired_b.tolist(), [False, True, False])
+
+    def test_cluster_extents(self):
+        extents = [sk_ass.read_extent("./json/inputs/" + name + ".geojson") for name in (
+            "brisbane_airport_staff_parking_lot", "brisbane_alpha_airport_parking", "brisbane_andrews_airport_parking")]
+
+        self.assertEqual(spatial.cluster_extents(extents, 0.05), [[0, 1, 2]])
+        self.assertEqual(spatial.cluster_extents(extents, 0.002), [[0], [1, 2]])
+        self.assertEqual(spatial.cluster_extents(extents, 0.001), [[0], [1], [2]])
+
+
+class OverlayTestCase(unittest.TestCase):
+
+    def test_to_pixels(self):
+        west, south, east, north = spatial.tile_bounds(16, 60639, 37955)
+        pixels = overlay.to_pixels([[west, north], [east, south]], 16, 60639, 37955)
+
+        np.testing.assert_allclose(pixels, [[0, 0], [256, 256]], atol=1e-6)
+
+    def test_render_tile(self):
+        with open("./json/templates/kraken/cars-0-16-60639-37955.geojson", "rb") as f:
+            gjson = f.read()
+        buffer = io.BytesIO()
+        Image.new("RGB", (256, 256), (0, 0, 255)).save(buffer, "PNG")
+        out_path = os.path.join(tempfile.mkdtemp(), "blend.png")
+        self.addCleanup(shutil.rmtree, os.path.dirname(out_path))
+
+        rows = overlay.render_tile(buffer.getvalue(), gjson, [16, 60639, 37955], "cars", (255, 0, 0, 255), out_path)
+
+        self.assertEqual(len(rows), len(jsn.loads(gjson.decode())["features"]))
+        column, row = overlay.to_pixels([rows[0][3:5]], 16, 60639, 37955)[0]
+        self.assertEqual(Image.open(out_path).getpixel((int(column), int(row))), (255, 0, 0))
+        self.assertEqual(Image.open(out_path).getpixel((0, 0)), (0, 0, 255))
+
+    def test_shade(self):
+        self.assertEqual(overlay.shade((255, 0, 0, 128), 0), (255, 0, 0, 128))
+        self.assertEqual(overlay.shade((255, 0, 0, 128), 60), (0, 255, 0, 128))
+
+
+def png_tile(color, size=256):
+    buffer = io.BytesIO()
+    Image.new("RGB", (size, size), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class InstrumentTestCase(unittest.TestCase):
+
+    def test_nested_stage_counted_once(self):
+        recorder = instrument.Recorder()
+        with recorder.stage("blend"):
+            with recorder.stage("blend"):
+                with recorder.stage("mosaic"):
+                    pass
+
+        self.assertEqual(recorder.report()["stages"]["blend"]["calls"], 1)
+        self.assertEqual(recorder.report()["stages"]["mosaic"]["calls"], 1)
+
+    def test_latency_histogram(self):
+        recorder = instrument.Recorder()
+        for seconds in (0.01, 0.2, 0.2, 100):
+            recorder.add_latency("host/a/b", seconds)
+
+        histogram = recorder.report()["endpoints"]["host/a/b"]["histogram"]
+        self.assertEqual(histogram[0], 1)
+        self.assertEqual(histogram[config.LATENCY_BUCKETS.index(0.25)], 2)
+        self.assertEqual(histogram[-1], 1)
+
+    def test_timed_iter(self):
+        with mock.patch.object(instrument, "_default", instrument.Recorder()):
+            self.assertEqual(list(instrument.timed_iter("kraken", range(3))), [0, 1, 2])
+            self.assertEqual(instrument.default().report()["stages"]["kraken"]["calls"], 1)
+
+
+class MosaicTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_write_mosaic(self):
+        out_path = os.path.join(self.path, "mosaic.png")
+        tiles = {(10, 20): png_tile((255, 0, 0)), (11, 20): png_tile((0, 255, 0)), (10, 21): png_tile((0, 0, 255))}
+
+        self.assertEqual(mosaic.write_mosaic(tiles, out_path), (512, 512))
+        image = Image.open(out_path)
+        self.assertEqual([image.getpixel(p) for p in ((0, 0), (300, 10), (10, 300), (300, 300))],
+                         [(255, 0, 0), (0, 255, 0), (0, 0, 255), (0, 0, 0)])
+
+    def test_pyramid_rebuilds_changed_tiles(self):
+        tiles = {(2, x, y): png_tile((60 * x, 60 * y, 0)) for x in (0, 1) for y in (0, 1)}
+
+        self.assertEqual(mosaic.build_pyramid(tiles, self.path, 0), 6)
+        self.assertEqual(Image.open(os.path.join(self.path, "1", "0", "0.png")).getpixel((200, 200))[:3], (60, 60, 0))
+        self.assertEqual(mosaic.build_pyramid(tiles, self.path, 0), 0)
+
+        tiles[(2, 1, 1)] = png_tile((255, 255, 255))
+        self.assertEqual(mosaic.build_pyramid(tiles, self.path, 0), 3)
+        self.assertEqual(Image.open(os.path.join(self.path, "1", "0", "0.png")).getpixel((200, 200))[:3],
+                         (255, 255, 255))
+
+
+class SelectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.extent = sk_ass.read_extent("./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+        index = scene_index.SceneIndex(os.path.join(tempfile.mkdtemp(), "scenes.json"))
+        self.addCleanup(shutil.rmtree, os.path.dirname(index.path))
+        with open("json/templates/search_response.json") as f:
+            index.merge(jsn.load(f)["results"])
+        self.scenes = index.eligible("2017-08-01 00:00:00", "2018-08-01 00:00:00", 0.55, 0.05)
+
+    def test_coverage(self):
+        points = selection.sample_points(self.extent)
+        west, south, east, north = spatial.bounds(self.extent)
+        middle = (west + east) / 2
+        half = {"type": "Polygon", "coordinates": [[[west - 1, south - 1], [middle, south - 1], [middle, north + 1],
+                                                    [west - 1, north + 1], [west - 1, south - 1]]]}
+
+        self.assertEqual(selection.coverage(self.scenes[0]["footprint"], points), 1.0)
+        self.assertAlmostEqual(selection.coverage(half, points), 0.5, delta=0.1)
+
+    def test_one_scene_per_day(self):
+        selected = selection.select_scenes(self.scenes, self.extent, bucket_hours=24)
+        days = [scene["datetime"][:10] for scene in selected]
+
+        self.assertEqual(len(self.scenes), 10)
+        self.assertEqual(days, ["2018-05-19", "2018-04-30", "2018-04-23", "2018-03-17", "2018-02-18"])
+        may = [scene for scene in self.scenes if scene["datetime"].startswith("2018-05-19")]
+        best = max(may, key=lambda scene: selection.quality(dict(scene, coverage=1.0)))
+        self.assertEqual(selected[0]["sceneId"], best["sceneId"])
+
+    def test_limit_keeps_best(self):
+        selected = selection.select_scenes(self.scenes, self.extent, limit=2, bucket_hours=0)
+
+        self.assertEqual(sorted(scene["offNadir"] for scene in selected), [7.4, 20.6])
+
+
+class DetectionStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    @staticmethod
+    def detections(counts):
+        found = np.zeros(len(counts), dtype=store.DETECTION_DTYPE)
+        found["count"] = counts
+        found["lon"] = 153.1
+        return found
+
+    def test_time_series(self):
+        detection_store = store.DetectionStore(self.root)
+        detection_store.append("b", "2018-05-19 23:55:16", self.detections([1, 2]))
+        detection_store.append("a", "2018-05-19 23:54:11", self.detections([1, 1, 1]))
+        detection_store.append("c", "2018-07-12 23:55:02", self.detections([]))
+        detection_store.append("a", "2018-05-19 23:54:11", self.detections([5]))
+
+        detection_store = store.DetectionStore(self.root)
+        self.assertEqual(detection_store.counts_per_scene(), [("a", "2018-05-19 23:54:11", 3),
+                                                              ("b", "2018-05-19 23:55:16", 3),
+                                                              ("c", "2018-07-12 23:55:02", 0)])
+        self.assertEqual(detection_store.counts_per_day("2018-06-01"), [("2018-07-12", 0.0)])
+        self.assertEqual(detection_store.column("scene").tolist(), [0, 0, 1, 1, 1])
+        self.assertEqual(detection_store.column("lon")[4], 153.1)
+
+    def test_interrupted_append(self):
+        detection_store = store.DetectionStore(self.root)
+        detection_store.append("a", "2018-05-19 23:54:11", self.detections([1]))
+        with open(os.path.join(self.root, "count.bin"), "ab") as f:
+            f.write(b"\xff" * 12)
+
+        detection_store = store.DetectionStore(self.root)
+        detection_store.append("b", "2018-05-19 23:55:16", self.detections([2]))
+        self.assertEqual(detection_store.column("count").tolist(), [1, 2])
+
+    def test_delta_series(self):
+        def scene(*tiles):
+            found = np.zeros(sum(len(points) for _, points in tiles), dtype=store.DETECTION_DTYPE)
+            rows = [(16, 60639, y, lon, lat) for y, points in tiles for lon, lat in points]
+            for name, values in zip(("z", "x", "y", "lon", "lat"), zip(*rows)):
+                found[name] = values
+            found["count"] = 1
+            return found
+
+        parked = (37955, [(153.1040, -27.3920), (153.1041, -27.3920)])
+        detection_store = store.DetectionStore(self.root)
+        detection_store.append("a", "2018-05-19 23:54:11", scene(parked, (37956, [(153.1040, -27.3930)])))
+        # One car moves by less than a metre, another one arrives
+        detection_store.append("b", "2018-06-19 23:54:11", scene(
+            parked, (37956, [(153.104005, -27.3930), (153.1045, -27.3935)])))
+        # Parked cars depart
+        detection_store.append("c", "2018-07-19 23:54:11", scene(
+            (37956, [(153.104005, -27.3930), (153.1045, -27.3935)])))
+
+        series = changes.delta_series(store.DetectionStore(self.root))
+        self.assertEqual([(delta["arrived"], delta["departed"], delta["stayed"]) for delta in series["extent"]],
+                         [(1, 0, 3), (0, 2, 2)])
+        self.assertEqual([(delta["arrived"], delta["departed"], delta["stayed"])
+                          for delta in series["tiles"]["16/60639/37955"]], [(0, 0, 2), (0, 2, 0)])
+        self.assertEqual((series["compared"], series["skipped"]), (2, 2))
+
+
+class PollerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = polling.PollStats(tempfile.mktemp())
+
+    def tearDown(self):
+        if os.path.isfile(self.stats.path):
+            os.remove(self.stats.path)
+
+    def test_backoff_is_bounded(self):
+        poller = polling.Poller("kraken/cars", timeout=1000, stats=self.stats)
+        intervals = []
+        for _ in range(20):
+            poller.reschedule()
+            intervals.append(poller.due_at - time.monotonic())
+
+        self.assertLess(intervals[0], intervals[5])
+        self.assertLessEqual(max(intervals), config.POLL_MAX_INTERVAL * (1 + config.POLL_JITTER) + 1)
+
+    def test_learns_completion_time(self):
+        self.assertIsNone(self.stats.expected("search"))
+        self.stats.record("search", 10.0)
+        self.stats.record("search", 20.0)
+
+        self.assertAlmostEqual(polling.PollStats(self.stats.path).expected("search"),
+                               10.0 + config.POLL_STATS_WEIGHT * 10.0)
+        poller = polling.Poller("search", stats=self.stats)
+        self.assertGreater(poller.due_at - poller.started, config.POLL_MIN_INTERVAL)
+
+    def test_backoff_seeded_from_expected_time(self):
+        self.stats.record("search", 200.0)
+        poller = polling.Poller("search", stats=self.stats)
+        self.assertAlmostEqual(poller.due_at - poller.started, config.POLL_MAX_INTERVAL)
+
+        with mock.patch("time.monotonic", return_value=poller.due_at):
+            poller.reschedule()
+        self.assertGreaterEqual(poller.due_at - poller.started,
+                                config.POLL_MAX_INTERVAL * (2 - config.POLL_JITTER) - 1e-6)
+
+        with mock.patch("time.monotonic", return_value=poller.started + 200.0):
+            poller.reschedule()
+        self.assertLessEqual(poller.due_at - poller.started - 200.0,
+                             config.POLL_MIN_INTERVAL * (1 + config.POLL_JITTER) + 1e-6)
+
+    def test_deadline(self):
+        poller = polling.Poller("search", timeout=0, stats=self.stats)
+        with self.assertRaises(exceptions.FatalException):
+            poller.reschedule()
+
+
+class TileCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_lru_eviction(self):
+        tile_cache = cache.TileCache(self.root, max_bytes=3 * (100 + cache.DIGEST_SIZE))
+        keys = [tile_cache.key("scene", "cars", 16, x, 1, "cars.png") for x in range(4)]
+        for i, key in enumerate(keys[:3]):
+            tile_cache.put(key, bytes([i]) * 100)
+            os.utime(tile_cache._path(key), (i, i))
+
+        self.assertEqual(tile_cache.get(keys[0]), bytes([0]) * 100)
+        tile_cache.put(keys[3], b"3" * 100)
+
+        self.assertIsNone(tile_cache.get(keys[1]))
+        self.assertIsNotNone(tile_cache.get(keys[0]))
+        self.assertIsNotNone(tile_cache.get(keys[3]))
+        self.assertLessEqual(tile_cache.size, tile_cache.max_bytes)
+
+    def test_eviction_to_low_watermark(self):
+        tile_cache = cache.TileCache(self.root, max_bytes=10 * (100 + cache.DIGEST_SIZE))
+        with mock.patch.object(config, "CACHE_LOW_WATERMARK", 0.9):
+            for x in range(11):
+                tile_cache.put(tile_cache.key("scene", "cars", 16, x, 1, "cars.png"), bytes([x]) * 100)
+            self.assertEqual(tile_cache.stats()["evictions"], 2)
+
+            with mock.patch.object(tile_cache, "evict") as evict:
+                tile_cache.put(tile_cache.key("scene", "cars", 16, 11, 1, "cars.png"), b"\x0b" * 100)
+            evict.assert_not_called()
+
+    def test_corrupted_entry(self):
+        tile_cache = cache.TileCache(self.root)
+        key = tile_cache.key("scene", "cars", 16, 1, 1, "detections.geojson")
+        tile_cache.put(key, b"{}")
+        with open(tile_cache._path(key), "ab") as f:
+            f.write(b"garbage")
+
+        self.assertIsNone(tile_cache.get(key))
+        self.assertFalse(os.path.isfile(tile_cache._path(key)))
+
+
+class TransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_backoff = config.HTTP_RETRY_BACKOFF
+        config.HTTP_RETRY_BACKOFF = 0
+
+    def tearDown(self):
+        config.HTTP_RETRY_BACKOFF = self.saved_backoff
+
+    @mock.patch('requests.Session.request', side_effect=[MockResponse({"error": "x"}, 503), MockResponse({}, 200)])
+    def test_get_retried(self, _):
+        t = transport.Transport(max_retries=2)
+        response = t.get(config.KRAK_PATH + "/kraken/grid/map/-/16/1/1/truecolor.png")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(t.stats(), {"requests": 2, "retries": 1, "bytes": 2})
+
+    @mock.patch('requests.Session.request', side_effect=[MockResponse({"error": "x"}, 503), MockResponse({}, 200)])
+    def test_post_not_retried(self, _):
+        t = transport.Transport(max_retries=2)
+        response = t.request("POST", config.AUTH["ENDPOINT"])
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(t.stats()["retries"], 0)
+
+    @mock.patch('requests.Session.request', side_effect=[MockResponse({"error": "x"}, 503),
+                                                         MockResponse({"results": []}, 200)])
+    def test_retrieve_retried(self, request):
+        with mock.patch.object(transport, "_default", transport.Transport(max_retries=2)):
+            response = sk_ass.get_response(config.SEARCH, payload={"pipelineId": "id"}, suffix="/retrieve")
+
+        self.assertEqual(response, {"results": []})
+        self.assertEqual(request.call_count, 2)
+
+    def test_endpoint_key(self):
+        self.assertEqual(transport.Transport.endpoint_key(config.KRAKEN["ENDPOINT"] + "/cars/geojson/retrieve"),
+                         "spaceknow-kraken.appspot.com/kraken/release")
+
+
+class TokenProviderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "token.json")
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_token_reused(self):
+        login = mock.Mock(return_value=make_jwt({"exp": time.time() + 3600}))
+
+        self.assertEqual(auth.TokenProvider(login, self.path)(), login.return_value)
+        self.assertEqual(auth.TokenProvider(login, self.path)(), login.return_value)
+        self.assertEqual(login.call_count, 1)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_token_refreshed(self):
+        login = mock.Mock(side_effect=[make_jwt({"exp": time.time() + 60}), make_jwt({"exp": time.time() + 3600})])
+        provider = auth.TokenProvider(login, self.path, margin=300)
+
+        first = provider()
+        second = provider()
+        self.assertNotEqual(second, first)
+        self.assertEqual(provider(), second)
+        self.assertEqual(login.call_count, 2)
+
+
+class WorkQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.queue = workqueue.WorkQueue(os.path.join(self.temp_dir, "queue.sqlite"))
+        self.queue.put("run", {"a": {"n": 1}, "b": {"n": 2}})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_lease_and_complete(self):
+        job = self.queue.lease("w1")
+        self.assertEqual((job["key"], job["payload"], job["attempts"]), ("a", {"n": 1}, 1))
+        self.assertEqual(self.queue.lease("w2")["key"], "b")
+        self.assertIsNone(self.queue.lease("w3"))
+        self.assertTrue(self.queue.renew(job["id"], "w1"))
+        self.assertFalse(self.queue.renew(job["id"], "w2"))
+
+        self.queue.complete(job["id"], "w1", {"count": 3})
+        self.queue.put("run", {"a": {"n": 3}})
+        self.assertEqual(self.queue.results("run"), [("a", {"count": 3})])
+        self.assertEqual(self.queue.results("run", exclude={"a"}), [])
+        self.assertEqual(self.queue.counts("run"), {"pending": 0, "leased": 1, "done": 1, "failed": 0})
+
+    def test_expired_lease_taken_over(self):
+        with mock.patch.object(config, "JOB_MAX_ATTEMPTS", 2):
+            job = self.queue.lease("dead", duration=-1)
+            taken = self.queue.lease("w1", duration=-1)
+            self.assertEqual((taken["key"], taken["attempts"]), ("a", 2))
+            self.assertFalse(self.queue.renew(job["id"], "dead"))
+            # Out of attempts
+            self.assertEqual(self.queue.lease("w2")["key"], "b")
+            self.assertEqual(self.queue.counts()["failed"], 1)
+            self.assertEqual(self.queue.errors("run"), [("a", "lease expired")])
+
+    def test_failed_job_retried(self):
+        with mock.patch.object(config, "JOB_MAX_ATTEMPTS", 2):
+            for attempt in (1, 2):
+                job = self.queue.lease("w1")
+                self.assertEqual((job["key"], job["attempts"]), ("a", attempt))
+                self.queue.fail(job["id"], "w1", "boom")
+            self.assertEqual(self.queue.errors("run"), [("a", "boom")])
+            self.assertEqual(self.queue.lease("w1")["key"], "b")
+
+
+class StandInTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_backoff = config.HTTP_RETRY_BACKOFF
+        config.HTTP_RETRY_BACKOFF = 0
+
+    def tearDown(self):
+        config.HTTP_RETRY_BACKOFF = self.saved_backoff
+
+    def test_search_pages(self):
+        with standin.StandInServer(scenes=25, page_size=10) as server:
+            saved = server.configure()
+            self.addCleanup(standin.StandInServer.restore, saved)
+            with mock.patch.object(transport, "_default", None), mock.patch.object(config, "POLL_MIN_INTERVAL", 0), \
+                    mock.patch.object(config, "TEMP_DIR", tempfile.mkdtemp()) as temp_dir:
+                self.addCleanup(shutil.rmtree, temp_dir)
+                extent = sk_ass.read_extent("./json/inputs/brisbane_airport_staff_parking_lot.geojson")
+                scenes = sk_ass.get_scenes(extent, "token")
+
+            self.assertEqual(len(scenes), config.SCENES_LIMIT)
+            self.assertEqual(server.stats()["requests"], 6)
+
+    def test_benchmark(self):
+        result = benchmark.bench(scenes=2, tiles=4, pipeline_delay=0.05, error_rate=0.1, seed=1)
+
+        self.assertEqual(result["stages"]["download"]["items"], 16)
+        self.assertGreater(result["errors"], 0)
+        self.assertGreater(result["tiles_per_second"], 0)
+        self.assertEqual(config.KRAK_PATH, "https://spaceknow-kraken.appspot.com")
+
 
 if __name__ == '__main__':
-    suite = unittest.TestLoader().loadTestsFromTestCase(HappyPathTestCase)
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     unittest.TextTestRunner(verbosity=2).run(suite)
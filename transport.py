@@ -0,0 +1,173 @@
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+import config
+import instrument
+
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` requests per second with bursts of up to `burst` requests."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Transport:
+    """
+    HTTP transport shared by all calls to the SpaceKnow API. Keeps a pool of keep-alive connections per host, retries
+    idempotent requests failing with a transient error, rate limits requests per endpoint and counts requests, retries
+    and downloaded bytes. The latency of every request is recorded by `instrument`.
+    """
+
+    def __init__(self, pool_size=None, max_retries=None, rate_limits=None):
+        """
+        :param int pool_size: Maximum number of pooled connections per host (default: `config.HTTP_POOL_SIZE`).
+        :param int max_retries: Maximum number of retries of an idempotent request (default: `config.HTTP_RETRIES`).
+        :param dict rate_limits: Maps endpoint keys (see `endpoint_key`) to `(rate, burst)` tuples
+        (default: `config.RATE_LIMITS`). Endpoints not listed are limited by `config.RATE_LIMIT`.
+        """
+
+        pool_size = config.HTTP_POOL_SIZE if pool_size is None else pool_size
+        self.max_retries = config.HTTP_RETRIES if max_retries is None else max_retries
+        self.rate_limits = config.RATE_LIMITS if rate_limits is None else rate_limits
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "bytes": 0}
+
+    @staticmethod
+    def endpoint_key(url):
+        """
+        Returns the key identifying the endpoint of `url` for the purpose of rate limiting - its host and the first two
+        path segments, e.g. `"spaceknow-kraken.appspot.com/kraken/grid"`.
+
+        :param str url: Request URL.
+        :return str: Endpoint key.
+        """
+
+        parsed = urllib.parse.urlsplit(url)
+        return parsed.netloc + "/".join(parsed.path.split("/")[:3])
+
+    def _bucket(self, url):
+        key = self.endpoint_key(url)
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(*self.rate_limits.get(key, config.RATE_LIMIT))
+            return self.buckets[key]
+
+    def count(self, counter, value=1):
+        """
+        Increments `counter` by `value`.
+
+        :param str counter: One of `"requests"`, `"retries"`, `"bytes"`.
+        :param int value: Increment.
+        """
+
+        with self.lock:
+            self.counters[counter] += value
+
+    def request(self, method, url, retriable=None, **kwargs):
+        """
+        Sends a request. Idempotent requests failing with a connection error or a status code in `RETRY_STATUS_CODES`
+        are retried with exponential backoff. Bytes of streamed responses are not counted here, the caller is expected
+        to call `count("bytes", ...)` while consuming them.
+
+        :param str method: HTTP method.
+        :param str url: Request URL.
+        :param bool retriable: Whether the request may be retried (default: whether `method` is idempotent), e.g. for
+        read-only calls sent as a POST.
+        :param kwargs: Passed to `requests.Session.request`.
+        :return requests.Response: Response to the last attempt.
+
+        :raises requests.RequestException: Raised if the last attempt fails with a connection error.
+        """
+
+        kwargs.setdefault("timeout", config.HTTP_TIMEOUT)
+        endpoint = self.endpoint_key(url)
+        bucket = self._bucket(url)
+        retriable = method.upper() in IDEMPOTENT_METHODS if retriable is None else retriable
+
+        attempt = 0
+        while True:
+            bucket.acquire()
+            self.count("requests")
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                instrument.default().add_latency(endpoint, time.monotonic() - started)
+                if not retriable or attempt >= self.max_retries:
+                    raise
+            else:
+                instrument.default().add_latency(endpoint, time.monotonic() - started)
+                if not retriable or attempt >= self.max_retries or response.status_code not in RETRY_STATUS_CODES:
+                    if not kwargs.get("stream"):
+                        self.count("bytes", len(response.content or b""))
+                    return response
+                response.close()
+
+            self.count("retries")
+            time.sleep(config.HTTP_RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        """Sends a GET request, see `request`."""
+
+        return self.request("GET", url, **kwargs)
+
+    def stats(self):
+        """
+        :return dict: Copy of the request, retry and byte counters.
+        """
+
+        with self.lock:
+            return dict(self.counters)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default():
+    """
+    Returns the transport shared by the whole process, creating it on first use.
+
+    :return Transport: Shared transport.
+    """
+
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Transport()
+        return _default
@@ -0,0 +1,190 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    run TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    UNIQUE (run, key)
+)
+"""
+
+
+class WorkQueue:
+    """
+    Persistent work queue in an SQLite database shared by a coordinator and any number of worker processes, on one host
+    or on several hosts sharing the file (SQLite locking requires a file system with working POSIX locks).
+
+    A worker leases a job for a limited time and keeps renewing the lease while working on it. A job whose lease has
+    expired, e.g. because its worker died, is leased again by the next worker, up to `config.JOB_MAX_ATTEMPTS` times.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: Database file, created if it does not exist.
+        """
+
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.local = threading.local()
+        with self._connect() as connection:
+            connection.execute(SCHEMA)
+
+    def _connect(self):
+        # One connection per thread, sqlite3 connections must not be shared between threads
+        if getattr(self.local, "connection", None) is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return _Transaction(self.local.connection)
+
+    def put(self, run, jobs):
+        """
+        Adds jobs of a run; jobs already in the queue are left as they are.
+
+        :param str run: Identifier of the run.
+        :param dict jobs: Maps job keys, unique within the run, to JSON-serializable payloads.
+        """
+
+        with self._connect() as connection:
+            connection.executemany("INSERT OR IGNORE INTO jobs (run, key, payload) VALUES (?, ?, ?)",
+                                   [(run, key, json.dumps(payload)) for key, payload in jobs.items()])
+
+    def lease(self, worker, duration=None):
+        """
+        Leases the oldest job which is pending or whose lease has expired.
+
+        :param str worker: Identifier of the worker.
+        :param float duration: Length of the lease in seconds (default: `config.LEASE_SECONDS`).
+        :return dict: Job with `id`, `run`, `key`, `payload` and `attempts` fields, or `None` if there is no job to
+        lease.
+        """
+
+        duration = config.LEASE_SECONDS if duration is None else duration
+        now = time.time()
+        with self._connect() as connection:
+            self._expire(connection, now)
+            row = connection.execute("SELECT * FROM jobs WHERE state = 'pending' OR (state = 'leased' AND "
+                                     "lease_until < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, "
+                               "attempts = attempts + 1 WHERE id = ?", (worker, now + duration, row["id"]))
+        return {"id": row["id"], "run": row["run"], "key": row["key"], "payload": json.loads(row["payload"]),
+                "attempts": row["attempts"] + 1}
+
+    def renew(self, job_id, worker, duration=None):
+        """
+        Extends the lease of a job.
+
+        :param int job_id: `id` of the leased job.
+        :param str worker: Identifier of the worker holding the lease.
+        :param float duration: Length of the lease from now in seconds (default: `config.LEASE_SECONDS`).
+        :return bool: Whether the worker still holds the lease.
+        """
+
+        duration = config.LEASE_SECONDS if duration is None else duration
+        with self._connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND "
+                                        "state = 'leased'", (time.time() + duration, job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result):
+        """
+        Stores the result of a job. The result of a worker which has lost its lease in the meantime is still accepted
+        unless the job has been completed by another worker.
+
+        :param int job_id: `id` of the leased job.
+        :param str worker: Identifier of the worker.
+        :param result: JSON-serializable result.
+        """
+
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET state = 'done', worker = ?, result = ?, error = NULL "
+                               "WHERE id = ? AND state != 'done'", (worker, json.dumps(result), job_id))
+
+    def fail(self, job_id, worker, error):
+        """
+        Gives a job back after a failure, to be leased again unless it has run out of attempts.
+
+        :param int job_id: `id` of the leased job.
+        :param str worker: Identifier of the worker holding the lease.
+        :param str error: Description of the failure.
+        """
+
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                               "error = ?, lease_until = NULL WHERE id = ? AND worker = ? AND state = 'leased'",
+                               (config.JOB_MAX_ATTEMPTS, error, job_id, worker))
+
+    def counts(self, run=None):
+        """
+        :param str run: Optional identifier of a run (default: all runs).
+        :return dict: Numbers of jobs per state - `"pending"`, `"leased"`, `"done"` and `"failed"`.
+        """
+
+        with self._connect() as connection:
+            self._expire(connection, time.time())
+            rows = connection.execute("SELECT state, COUNT(*) AS n FROM jobs" + (" WHERE run = ?" if run else "") +
+                                      " GROUP BY state", (run,) if run else ())
+            counts = {row["state"]: row["n"] for row in rows}
+        return {state: counts.get(state, 0) for state in ("pending", "leased", "done", "failed")}
+
+    @staticmethod
+    def _expire(connection, now):
+        # Jobs whose last lease expired without any attempts left are not leased again
+        connection.execute("UPDATE jobs SET state = 'failed', error = COALESCE(error, 'lease expired') "
+                           "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                           (now, config.JOB_MAX_ATTEMPTS))
+
+    def results(self, run, exclude=()):
+        """
+        :param str run: Identifier of the run.
+        :param exclude: Keys of jobs to leave out, e.g. because their results have been processed already.
+        :return list: Tuples `(key, result)` of the completed jobs of the run.
+        """
+
+        with self._connect() as connection:
+            rows = connection.execute("SELECT key, result FROM jobs WHERE run = ? AND state = 'done' ORDER BY id",
+                                      (run,)).fetchall()
+        return [(row["key"], json.loads(row["result"])) for row in rows if row["key"] not in exclude]
+
+    def errors(self, run):
+        """
+        :param str run: Identifier of the run.
+        :return list: Tuples `(key, error)` of the failed jobs of the run.
+        """
+
+        with self._connect() as connection:
+            rows = connection.execute("SELECT key, error FROM jobs WHERE run = ? AND state = 'failed'", (run,))
+            return [(row["key"], row["error"]) for row in rows]
+
+
+class _Transaction:
+    """Runs the statements of a `with` block in one immediate (write-locking) transaction."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, *exc_info):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False